@@ -0,0 +1,353 @@
+#----------------------------------------------------------------------------
+# Copyright 2018, FittedCloud, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+#----------------------------------------------------------------------------
+
+# offline benchmarks for costreporter.py.  run as
+#
+#     python benchmark.py [rows,rows,...] [--suite micro|pipeline|all]
+#                         [--save results.json] [--baseline results.json]
+#
+# no AWS access is needed, all input rows are synthetic.  the micro suite
+# times single functions on prebuilt rows, the pipeline suite runs
+# get_costs() against the local Cost Explorer stand-in in fakece.py and
+# streams the rows through each consolidation and output path.
+#
+# --save writes the timings to a file, --baseline compares against such a
+# file and exits with 1 if anything got more than 25% slower or bigger.
+
+from __future__ import print_function
+
+import argparse
+import collections
+import json
+import os
+import sys
+import time
+
+try:
+    import tracemalloc # python 3 only
+except ImportError:
+    tracemalloc = None
+
+import costreporter
+
+# default row counts to benchmark
+BENCH_SIZES = [1000, 10000, 100000]
+BENCH_PIPELINE_SIZES = [1000, 100000, 1000000]
+
+# the pipeline suite fetches DAILY costs over this range, grouped by service
+# and one tag with BENCH_TAGS values, so n rows take n / (20 x 10) services
+BENCH_START = "2018-01-01"
+BENCH_END = "2018-01-21"
+BENCH_DAYS = 20
+BENCH_TAGS = 10
+BENCH_GROUPBYS = [{"Type":"DIMENSION", "Key":"SERVICE"}, {"Type":"TAG", "Key":"env"}]
+
+# memory budget of the external (spilling) consolidation, small enough that
+# the larger sizes spill
+BENCH_MEMORY_BUDGET = 16 * 1048576
+
+# a timing or peak size this much over the baseline is a regression.
+# timings under BENCH_MIN_WALL seconds are too noisy to compare
+BENCH_REGRESSION = 1.25
+BENCH_MIN_WALL = 0.05
+
+# the pre-index consolidation is O(rows x groups), so it is only timed for
+# inputs up to this many rows
+BENCH_LEGACY_MAX_ROWS = 30000
+
+# builds n synthetic DAILY cost rows spread over about n/30 groups keyed by
+# usage type and service
+def make_cost_rows(n):
+    groups = max(1, n // 30)
+    rows = []
+    for i in range(0, n):
+        g = i % groups
+        day = 1 + (i // groups) % 28
+        rows.append({
+            "region": "us-east-1",
+            "estimated": False,
+            "start_time": "2018-01-%02d" %day,
+            "end_time": "2018-01-%02d" %(day + 1),
+            "group": ["UsageType-%d" %g, "Service %d" %(g % 50)],
+            "blended_cost": {"Amount": "%.10f" %(0.37 * (g + 1)), "Unit": "USD"},
+            "unblended_cost": {"Amount": "%.10f" %(0.35 * (g + 1)), "Unit": "USD"},
+            "usage_quantity": {"Amount": "%.10f" %(1.5 * day), "Unit": "Hrs"}
+        })
+    return rows
+
+# consolidate_costs_by_group() as it was before it was indexed, kept as
+# the baseline.  it only keys on the first group key
+def legacy_consolidate_costs_by_group(costs):
+    out = []
+    for cost in costs:
+        found = 0
+        for i in range(0, len(out)):
+            if out[i]['group'] == cost['group'][0]:
+                found = 1
+                out[i]['values']['unblended_cost'] += \
+                        float(cost['unblended_cost']['Amount'])
+                out[i]['values']['usage_quantity'] += \
+                        float(cost['usage_quantity']['Amount'])
+                break
+        if found == 0:
+            tmp = {'group':cost['group'][0], 'values':{}}
+            tmp['values'] = {'unblended_cost': float(cost['unblended_cost']['Amount']),
+                             'unblended_unit': cost['unblended_cost']['Unit'],
+                             'usage_quantity': float(cost['usage_quantity']['Amount']),
+                             'usage_unit': cost['usage_quantity']['Unit']}
+            out.append(tmp)
+    return out
+
+# consolidate_costs_by_group() as it was before amounts were summed as exact
+# integers, kept to measure what exactness costs
+def float_consolidate_costs_by_group(costs, depth=None):
+    index = {}
+    order = []
+    for cost in costs:
+        keys = tuple(cost['group'][:depth])
+        values = index.get(keys)
+        if values is None:
+            values = {'blended_cost': float(cost['blended_cost']['Amount']),
+                      'unblended_cost': float(cost['unblended_cost']['Amount']),
+                      'usage_quantity': float(cost['usage_quantity']['Amount']),
+                      'regions': [cost['region']]}
+            index[keys] = values
+            order.append(keys)
+        else:
+            values['blended_cost'] += float(cost['blended_cost']['Amount'])
+            values['unblended_cost'] += float(cost['unblended_cost']['Amount'])
+            values['usage_quantity'] += float(cost['usage_quantity']['Amount'])
+            if cost['region'] not in values['regions']:
+                values['regions'].append(cost['region'])
+    return [index[keys] for keys in order]
+
+# returns the wall time of fn(*args) in seconds
+def timed(fn, *args):
+    start = time.time()
+    fn(*args)
+    return time.time() - start
+
+# results of the current run as {benchmark: {rows: {"wall": s, "peak": bytes}}}
+RESULTS = collections.OrderedDict()
+
+def record(name, n, wall, peak=None):
+    RESULTS.setdefault(name, collections.OrderedDict())[str(n)] = {"wall": wall, "peak": peak}
+
+def bench_consolidate(sizes):
+    print("%-10s %10s %14s %14s %14s %14s" %("rows", "groups", "legacy (s)", "float (s)",
+                                             "full key (s)", "rollup 1 (s)"))
+    for n in sizes:
+        rows = make_cost_rows(n)
+        groups = len(costreporter.consolidate_costs_by_group(rows))
+        if n <= BENCH_LEGACY_MAX_ROWS:
+            wall = timed(legacy_consolidate_costs_by_group, rows)
+            record("consolidate/legacy", n, wall)
+            legacy = "%14.4f" %wall
+        else:
+            legacy = "%14s" %"skipped"
+        fsum = timed(float_consolidate_costs_by_group, rows)
+        full = timed(costreporter.consolidate_costs_by_group, rows)
+        rollup = timed(costreporter.consolidate_costs_by_group, rows, 1)
+        record("consolidate/float", n, fsum)
+        record("consolidate/full", n, full)
+        record("consolidate/rollup", n, rollup)
+        print("%-10d %10d %s %14.4f %14.4f %14.4f" %(n, groups, legacy, fsum, full, rollup))
+
+# returns (result of fn(*args), bytes allocated by it and still alive), or
+# None for the size if tracemalloc is not available
+def allocated(fn, *args):
+    if tracemalloc is None:
+        return fn(*args), None
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = fn(*args)
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return result, size
+
+def format_size(size):
+    if size is None:
+        return "n/a"
+    return "%.1f MB" %(size / 1048576.0)
+
+# row dicts vs CostTable: memory held and time to aggregate by full key
+def bench_columnar(sizes):
+    if costreporter.load_numpy() is None:
+        print("numpy not installed, skipping columnar benchmark")
+        return
+    print("%-10s %12s %12s %14s %14s %14s" %("rows", "row dicts", "table", "load (s)",
+                                             "dicts agg (s)", "table agg (s)"))
+    for n in sizes:
+        rows, rows_size = allocated(make_cost_rows, n)
+        table, table_size = allocated(costreporter.CostTable.from_rows, iter(rows))
+        load = timed(costreporter.CostTable.from_rows, iter(rows))
+        dicts = timed(costreporter.consolidate_costs_by_group, rows)
+        table.consolidate() # warm up numpy
+        columns = timed(table.consolidate)
+        record("columnar/rows", n, dicts, rows_size)
+        record("columnar/load", n, load, table_size)
+        record("columnar/consolidate", n, columns)
+        print("%-10d %12s %12s %14.4f %14.4f %14.4f" %(n, format_size(rows_size),
+              format_size(table_size), load, dicts, columns))
+
+# summing amounts as floats vs as exact parse_amount() integers, and how far
+# the float total drifts from the exact one
+def bench_amounts(sizes):
+    print("%-10s %14s %14s %18s" %("rows", "float (s)", "exact (s)", "float drift"))
+    for n in sizes:
+        amounts = [row['unblended_cost']['Amount'] for row in make_cost_rows(n)]
+        start = time.time()
+        total = sum([float(a) for a in amounts])
+        fsum = time.time() - start
+        start = time.time()
+        exact = sum([costreporter.parse_amount(a) for a in amounts])
+        isum = time.time() - start
+        drift = total - costreporter.amount_value(exact)
+        record("amounts/float", n, fsum)
+        record("amounts/exact", n, isum)
+        print("%-10d %14.4f %14.4f %18.10f" %(n, fsum, isum, drift))
+
+# recursive flatten() vs the flattener compiled from the cost schema
+def bench_flatten(sizes):
+    names, paths = costreporter.cost_schema([{"Type":"DIMENSION", "Key":"USAGE_TYPE"},
+                                             {"Type":"DIMENSION", "Key":"SERVICE"}])
+    flat = costreporter.compile_flattener(paths)
+    print("%-10s %14s %14s" %("rows", "flatten (s)", "compiled (s)"))
+    for n in sizes:
+        rows = make_cost_rows(n)
+        recursive = timed(lambda: [costreporter.flatten(r) for r in rows])
+        compiled = timed(lambda: [flat(r) for r in rows])
+        record("flatten/recursive", n, recursive)
+        record("flatten/compiled", n, compiled)
+        print("%-10d %14.4f %14.4f" %(n, recursive, compiled))
+
+# returns (wall time, peak bytes allocated) of fn().  the peak comes from a
+# second, traced run, since tracing slows everything down
+def measure(fn, memory=True):
+    wall = timed(fn)
+    if tracemalloc is None or memory == False:
+        return wall, None
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return wall, peak
+
+# points costreporter at a fake Cost Explorer sized for about n rows
+def use_fake_ce(n):
+    groups = max(1, n // (BENCH_DAYS * BENCH_TAGS))
+    os.environ[costreporter.FC_FAKE_CE_ENV] = "groups=%d,tags=%d" %(groups, BENCH_TAGS)
+    costreporter.CE_CLIENTS.clear()
+    return groups * BENCH_TAGS * BENCH_DAYS
+
+def fetch_rows():
+    return costreporter.get_costs("bench", "bench", ["us-east-1"], BENCH_START, BENCH_END,
+                                  "SERVICE", "env", "DAILY")
+
+# runs print_cost_results() with stdout sent to /dev/null
+def render(**kwargs):
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        costreporter.print_cost_results(fetch_rows(), start=BENCH_START, end=BENCH_END,
+                                        groupbys=BENCH_GROUPBYS, **kwargs)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+# render() with the fetch and parse stages in threads of their own (--pipeline)
+def render_pipelined(**kwargs):
+    costreporter.PIPELINE_DEPTH = costreporter.FC_PIPELINE_DEPTH
+    try:
+        render(**kwargs)
+    finally:
+        costreporter.PIPELINE_DEPTH = None
+
+# every stage streams from a fresh get_costs(), the way the command line
+# runs, so all timings include the fetch.  subtract the fetch column to get
+# the cost of the stage itself
+def bench_pipeline(sizes, memory=True):
+    stages = [("fetch", lambda: collections.deque(fetch_rows(), maxlen=0)),
+              ("consolidate", lambda: costreporter.consolidate_costs_by_group(fetch_rows())),
+              ("external", lambda: collections.deque(costreporter.consolidate_costs_external(
+                  fetch_rows(), budget=BENCH_MEMORY_BUDGET), maxlen=0)),
+              ("flatten", lambda: collections.deque((costreporter.flatten(r) for r in fetch_rows()),
+                                                    maxlen=0)),
+              ("text", lambda: render()),
+              ("csv", lambda: render(use_csv=True)),
+              ("csv/pipe", lambda: render_pipelined(use_csv=True)),
+              ("json", lambda: render(use_json=True)),
+              ("jsonl", lambda: render(use_jsonl=True))]
+    print("%-10s %-12s %12s %12s" %("rows", "stage", "wall (s)", "peak"))
+    for n in sizes:
+        rows = use_fake_ce(n)
+        for (name, fn) in stages:
+            wall, peak = measure(fn, memory)
+            record("pipeline/" + name, rows, wall, peak)
+            print("%-10d %-12s %12.4f %12s" %(rows, name, wall, format_size(peak)))
+
+# prints every benchmark that is more than BENCH_REGRESSION times slower or
+# bigger than in the baseline file.  returns the number of regressions
+def compare(path):
+    with open(path) as f:
+        baseline = json.load(f)
+    regressions = 0
+    for name, sizes in RESULTS.items():
+        for n, now in sizes.items():
+            before = baseline.get(name, {}).get(n)
+            if before is None:
+                continue
+            if before["wall"] >= BENCH_MIN_WALL and now["wall"] > before["wall"] * BENCH_REGRESSION:
+                print("REGRESSION %s (%s rows): %.4f s -> %.4f s"
+                      %(name, n, before["wall"], now["wall"]))
+                regressions += 1
+            if before["peak"] and now["peak"] and now["peak"] > before["peak"] * BENCH_REGRESSION:
+                print("REGRESSION %s (%s rows): %s -> %s peak"
+                      %(name, n, format_size(before["peak"]), format_size(now["peak"])))
+                regressions += 1
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("sizes", nargs="?", default=None)
+    parser.add_argument("--suite", choices=["micro", "pipeline", "all"], default="all")
+    parser.add_argument("--no-memory", action="store_true",
+                        help="skip the traced runs that measure peak memory")
+    parser.add_argument("--save", default=None)
+    parser.add_argument("--baseline", default=None)
+    args = parser.parse_args()
+
+    sizes = BENCH_SIZES
+    pipeline_sizes = BENCH_PIPELINE_SIZES
+    if args.sizes is not None:
+        sizes = pipeline_sizes = [int(n) for n in args.sizes.split(",")]
+    if args.suite in ("micro", "all"):
+        bench_consolidate(sizes)
+        print("")
+        bench_columnar(sizes)
+        print("")
+        bench_flatten(sizes)
+        print("")
+        bench_amounts(sizes)
+        print("")
+    if args.suite in ("pipeline", "all"):
+        bench_pipeline(pipeline_sizes, not args.no_memory)
+        print("")
+    if args.save is not None:
+        with open(args.save, "w") as f:
+            json.dump(RESULTS, f, indent=2)
+    if args.baseline is not None and compare(args.baseline) > 0:
+        sys.exit(1)
@@ -16,6 +16,8 @@
 #Author: Gregory Fedynyshyn (greg@fittedcloud.com)
 #----------------------------------------------------------------------------
 
+from __future__ import print_function
+
 import sys
 import os
 import re
@@ -26,14 +28,66 @@ import traceback
 import argparse
 import csv
 import json
-import boto3
-import botocore
-import pprint # pretty printing!
+import itertools
+import threading
+import multiprocessing
+import hashlib
+import sqlite3
+import random
+import array
+import functools
+import types
+import heapq
+import tempfile
+import decimal
+import math
+import difflib
+import mmap
+import struct
+import glob
 
 from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+try:
+    from collections.abc import MutableMapping
+except ImportError: # python 2.7
+    from collections import MutableMapping
+
+try:
+    import configparser
+except ImportError: # python 2.7
+    import ConfigParser as configparser
+
+try:
+    import queue
+except ImportError: # python 2.7
+    import Queue as queue
+
+try:
+    import cPickle as pickle # python 2.7
+except ImportError:
+    import pickle
+
+try:
+    import resource # not available on windows, peak RSS is not reported there
+except ImportError:
+    resource = None
+
+# numpy is optional, only needed for --columnar.  imported by load_numpy()
+numpy = None
+
+# PyYAML is optional, only needed for YAML batch files.  imported by load_yaml()
+yaml = None
+
+# pyarrow is optional, cost --export writes Parquet with it and the native
+# archive layout without it.  imported by load_pyarrow()
+pyarrow = None
 
 FC_AWS_ENV = "AWS_DEFAULT_PROFILE"
 
+FC_DATE_FORMAT = "%Y-%m-%d"
+
 # simple sanity check for start/end dates.  exceptions will occur with anything
 # more complicatedly wrong
 FC_MATCH_DATE = "[0-9]{4}-[0-1][0-9]-[0-3][0-9]"
@@ -44,8 +98,37 @@ FC_INTERVALS = ["MONTHLY", "DAILY"]
 # supported RI recommendation services are EC2 and RDS
 FC_RI_SERVICES = ["EC2", "RDS"]
 
+# Cost Explorer names of the services above.  other names are passed as is
+FC_RI_SERVICE_NAMES = {"EC2": "Amazon Elastic Compute Cloud - Compute",
+                       "RDS": "Amazon Relational Database Service"}
+
+# valid RI recommendation terms, payment options and lookback periods
+FC_RI_TERMS = ["ONE_YEAR", "THREE_YEARS"]
+FC_RI_PAYMENT_OPTIONS = ["NO_UPFRONT", "PARTIAL_UPFRONT", "ALL_UPFRONT"]
+FC_RI_LOOKBACKS = ["SEVEN_DAYS", "THIRTY_DAYS", "SIXTY_DAYS"]
+
+# columns of the recommendation comparison of several combinations
+FC_RI_MATRIX_COLUMNS = ["service", "term", "payment_option", "lookback", "recommendations",
+                        "instances", "upfront_cost", "monthly_savings", "savings_percentage",
+                        "currency"]
+
+# leading CSV columns of recommendation details, the rest are sorted
+FC_RI_DETAIL_COLUMNS = ["account", "AccountScope", "TermInYears", "PaymentOption",
+                        "LookbackPeriodInDays"]
+
 # valid commands in the form of {<command name>: <command description>}
-FC_COMMANDS = {"cost": "Report cost data", "recommend": "Report reserved instance recommendations", "coverage": "Report reservation coverage"}
+FC_COMMANDS = collections.OrderedDict([
+    ("cost", "Report cost data"),
+    ("coverage", "Report reservation coverage"),
+    ("recommend", "Report reserved instance recommendations"),
+    ("sync", "Sync daily cost data into the local store"),
+    ("serve", "Serve cost, coverage and recommend queries as JSON over HTTP"),
+    ("query", "Report costs from the local store, re-aggregated locally"),
+    ("catalog", "List the cached dimension values and tag keys and values"),
+    ("batch", "Run the reports of a batch file, fetching shared requests once"),
+    ("anomalies", "Report days on which the cost of a group deviates from its trend"),
+    ("read", "Report costs from files of cost --export, reading only the row groups needed"),
+    ("compare", "Compare the costs of every group between two time ranges")])
 
 # a list of currently available dimensions by which to group
 GROUP_DIMENSIONS = ["AZ",
@@ -69,6 +152,190 @@ GROUP_DIMENSIONS = ["AZ",
                     "CACHE_ENGINE",
                     "INSTANCE_TYPE_FAMILY"]
 
+# cost metrics requested from Cost Explorer and the row fields they are
+# stored in
+FC_COST_METRICS = [("BlendedCost", "blended_cost"),
+                   ("UnblendedCost", "unblended_cost"),
+                   ("UsageQuantity", "usage_quantity")]
+
+# coverage hours returned for every coverage group
+FC_COVERAGE_HOURS = ["OnDemandHours", "ReservedHours", "TotalRunningHours",
+                     "CoverageHoursPercentage"]
+
+# default size of the time windows used by sharded fetches, either MONTH
+# (calendar months) or a number of days
+FC_SHARD_WINDOW = "MONTH"
+
+# on-disk response cache.  closed periods are cached forever, estimated or
+# still open periods and recommendations for FC_CACHE_TTL seconds
+FC_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".costreporter")
+FC_CACHE_FILE = "cache.db"
+FC_CACHE_TTL = 3600
+
+# dimension values, tag keys and tag values of every account are kept in a
+# local catalog for FC_CATALOG_TTL seconds.  they are listed for the last
+# FC_CATALOG_DAYS days.  stale entries are used while a background thread
+# fetches them again
+FC_CATALOG_FILE = "catalog.db"
+FC_CATALOG_TTL = 86400
+FC_CATALOG_DAYS = 365
+
+# local store of DAILY cost rows kept up to date by the sync command.  without
+# -t, sync keeps the last FC_SYNC_DAYS days
+FC_STORE_FILE = "store.db"
+FC_SYNC_DAYS = 90
+
+# anomalies command.  the daily cost of every group is tracked as an
+# exponentially weighted moving mean and variance (weight FC_ANOMALY_ALPHA
+# for the newest day) in a local state file, so every run only reads the
+# days since the last one.  a day is flagged for a group once the state has
+# seen FC_ANOMALY_WARMUP days, if it is more than --threshold standard
+# deviations and --min-change away from the mean.  a new state starts
+# FC_ANOMALY_DAYS ago unless -t says otherwise
+FC_ANOMALY_FILE = "anomalies.db"
+FC_ANOMALY_ALPHA = 0.1
+FC_ANOMALY_WARMUP = 14
+FC_ANOMALY_THRESHOLD = 3.0
+FC_ANOMALY_MIN_CHANGE = 1.0
+FC_ANOMALY_DAYS = 90
+
+# sync passes of --grain.  Cost Explorer allows two GroupBy keys per request,
+# so the finest grain is fetched as several two-key passes that the query
+# command can pick from
+FC_GRAIN_PASSES = ["SERVICE,USAGE_TYPE", "SERVICE,REGION", "SERVICE,LINKED_ACCOUNT"]
+
+# date rollups of the query command as SQL expressions of the day of a row.
+# weeks are labeled with their Monday
+FC_QUERY_PERIODS = collections.OrderedDict([
+    ("DAY", "start"),
+    ("WEEK", "date(start, '-6 days', 'weekday 1')"),
+    ("MONTH", "substr(start, 1, 7)"),
+    ("TOTAL", "''")])
+
+# metrics of the query command and their store columns
+FC_QUERY_METRICS = collections.OrderedDict([
+    ("unblended", "unblended"),
+    ("blended", "blended"),
+    ("usage", "usage")])
+
+# the same metrics as fields of cost rows, for cost --top
+FC_ROW_METRICS = {"unblended": "unblended_cost", "blended": "blended_cost",
+                  "usage": "usage_quantity"}
+
+# cost --top tracks the sums of FC_TOP_FACTOR x <n> groups, but at least
+# FC_TOP_MIN_CAPACITY, so memory grows with <n> and not with the number of
+# groups
+FC_TOP_FACTOR = 20
+FC_TOP_MIN_CAPACITY = 1000
+
+# with --memory-budget, cost reports sort and aggregate in sorted runs that
+# are spilled to temporary files (in $TMPDIR) whenever the estimated size of
+# the rows or groups held in memory reaches the budget.  a group takes about
+# FC_SPILL_GROUP_BYTES, a row its pickled size plus FC_SPILL_ROW_OVERHEAD.
+# once there are FC_SPILL_MAX_RUNS runs they are merged into one, so the
+# number of open files stays bounded
+FC_SPILL_GROUP_BYTES = 1024
+FC_SPILL_ROW_OVERHEAD = 256
+FC_SPILL_MAX_RUNS = 64
+
+# with --pipeline, pages are fetched and turned into rows in threads of their
+# own, FC_PIPELINE_DEPTH pages or batches of FC_PIPELINE_BATCH rows ahead of
+# the output
+FC_PIPELINE_DEPTH = 8
+FC_PIPELINE_BATCH = 1000
+
+# money and usage amounts are summed as integers in units of
+# 10^-FC_AMOUNT_DIGITS, enough for every digit Cost Explorer returns, so
+# totals are exact.  they are only turned into decimal text when printed
+FC_AMOUNT_DIGITS = 10
+FC_AMOUNT_POWERS = [10 ** n for n in range(0, FC_AMOUNT_DIGITS + 1)]
+FC_AMOUNT_SCALE = FC_AMOUNT_POWERS[FC_AMOUNT_DIGITS]
+
+# array typecode of the int64 amount columns of --columnar tables.  python 2
+# arrays have no 'q', its 'l' is 64 bits on 64 bit unix
+FC_ARRAY_INT64 = "q" if "q" in getattr(array, "typecodes", "") else "l"
+
+# coverage has no Estimated flag, so consider a period closed once it ended
+# this many days ago
+FC_CACHE_SETTLE_DAYS = 3
+
+# Cost Explorer allows very few requests per second.  all requests of a run,
+# across threads and account processes, share one token bucket that starts
+# at FC_RATE_LIMIT requests per second.  the rate is halved whenever a
+# request is throttled and grows back by FC_RATE_INCREASE after every
+# successful request
+FC_RATE_LIMIT = 5.0
+FC_RATE_MIN = 0.2
+FC_RATE_INCREASE = 0.1
+FC_RATE_BURST = 5.0
+
+# retries of throttled and transient failures, with exponential backoff
+# (full jitter) starting at FC_RETRY_BASE seconds, capped at FC_RETRY_CAP
+FC_MAX_RETRIES = 6
+FC_RETRY_BASE = 0.5
+FC_RETRY_CAP = 20.0
+
+# error codes and exception class names that are worth retrying
+FC_THROTTLE_ERRORS = ["ThrottlingException", "Throttling", "LimitExceededException",
+                      "RequestLimitExceeded", "TooManyRequestsException"]
+FC_TRANSIENT_ERRORS = ["InternalError", "InternalFailure", "InternalServerError",
+                       "ServiceUnavailable", "ServiceUnavailableException",
+                       "RequestTimeout", "RequestTimeoutException",
+                       "ConnectionError", "HTTPClientError"] # botocore network errors
+
+# maximum number of accounts fetched at once with --profiles/--all-profiles
+FC_ACCOUNT_PROCESSES = 8
+
+# recommendation combinations fetched at once, unless -w asks for more
+FC_RI_WORKERS = 6
+
+# coverage --series intervals fetched at once, unless -w asks for more
+FC_SERIES_WORKERS = 8
+
+# serve command defaults, and the query parameters of every endpoint with
+# their defaults.  parameters without a default are required
+FC_SERVE_HOST = "127.0.0.1"
+FC_SERVE_PORT = 8080
+FC_SERVE_LRU_SIZE = 256
+FC_SERVE_PARAMS = {
+    "cost": {"start": None, "end": None, "dimension": "", "tag": "", "interval": "MONTHLY",
+             "view": "rows", "rollup": ""},
+    "coverage": {"start": None, "end": None, "dimension": "", "tag": "", "interval": "MONTHLY",
+                 "series": "0"},
+    "recommend": {"service": "EC2", "lookback": "SIXTY_DAYS", "term": "ONE_YEAR",
+                  "payment_option": "PARTIAL_UPFRONT"}
+}
+
+# commands a batch report can run, and the options it can set by their long
+# names.  everything else is taken from the batch command line
+FC_BATCH_COMMANDS = ["cost", "coverage", "recommend"]
+FC_BATCH_OPTIONS = ["timerange", "dimension", "tag", "interval", "json", "csv", "jsonl", "rollup",
+                    "columnar", "memory_budget", "abbreviate", "top", "metric", "series",
+                    "service", "lookback", "term", "payment_option"]
+
+# unique batch requests fetched at once, unless -w asks for more
+FC_BATCH_WORKERS = 4
+
+# calendar month windows of the two compare ranges fetched at once, unless
+# -w asks for more
+FC_COMPARE_WORKERS = 4
+
+# rows per row group of cost --export archives, and the last bytes of an
+# archive in the native layout (see NativeArchiveWriter)
+FC_ARCHIVE_ROW_GROUP = 65536
+FC_ARCHIVE_MAGIC = b"FCCOST01"
+
+# size of the HTTP connection pool of each Cost Explorer client, enough for
+# the shard workers sharing it
+FC_CLIENT_POOL_SIZE = 25
+
+# counters reported by --stats, always listed even when zero
+FC_STATS_COUNTERS = ["api_calls", "pages", "response_bytes", "rows", "retries", "throttles"]
+
+# when set, Cost Explorer calls go to the local stand-in in fakece.py,
+# configured by the value of this variable.  see fakece.py
+FC_FAKE_CE_ENV = "COSTREPORTER_FAKE_CE"
+
 # We dynamically update regions in our software, but for the
 # purposes of this script, hardcoding is fine.
 AWS_REGIONS = [
@@ -108,20 +375,204 @@ ABBRV = {
     "Refund": "Ref" # everyone's favorite
 } 
 
-# simple check to see if string can be converted to float
-def isfloat(value):
+# Cost Explorer clients, reused for all requests of a run.  one boto3
+# session per credential set and one client per credentials and region.
+# clients are thread safe, sessions are not, so creation is serialized
+CLIENT_LOCK = threading.Lock()
+CE_SESSIONS = {}
+CE_CLIENTS = {}
+
+# set up in main unless --no-cache is given
+RESPONSE_CACHE = None
+
+# set up in main, shared with account worker processes
+RATE_LIMITER = None
+
+# raised when fetching fails part way through, so a report is never
+# silently built from partial data
+class IncompleteResultsError(Exception):
+    pass
+
+# set up in main when --stats or --stats-json is given
+STATS = None
+
+# queue depth of the fetch and parse stages, set up in main when --pipeline
+# is given.  None runs every stage in the calling thread
+PIPELINE_DEPTH = None
+
+# cpu time of the calling thread where python can tell, else of the process
+if hasattr(time, "thread_time"):
+    thread_cpu_time = time.thread_time
+else: # python 2.7
+    thread_cpu_time = lambda: sum(os.times()[0:2])
+
+# peak resident set size of this process in bytes, or None if unknown
+def peak_rss():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != "darwin": # linux reports kilobytes, macOS bytes
+        rss *= 1024
+    return rss
+
+# counters and per-phase timings for --stats.  phases nest per thread, and
+# the time of a phase does not include the phases started inside it, so the
+# phases of one thread add up to the time it spent in them.  phases of
+# fetch threads overlap the main thread, so their sum can exceed the wall time
+class Stats(object):
+    def __init__(self):
+        self.start = time.time()
+        self.cpu_start = sum(os.times()[0:2])
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.phases = collections.OrderedDict() # name: [calls, wall, cpu]
+        self.counters = collections.OrderedDict((n, 0) for n in FC_STATS_COUNTERS)
+        self.worker_rss = None # largest peak RSS of account worker processes
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def enter(self, name):
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = []
+        # [name, wall start, cpu start, wall of nested phases, cpu of nested phases]
+        stack.append([name, time.time(), thread_cpu_time(), 0.0, 0.0])
+
+    # a phase counts as one call however often it is re-entered by iterate()
+    def exit(self, call=True):
+        stack = self.local.stack
+        name, wall_start, cpu_start, nested_wall, nested_cpu = stack.pop()
+        wall = time.time() - wall_start
+        cpu = thread_cpu_time() - cpu_start
+        if len(stack) > 0:
+            stack[-1][3] += wall
+            stack[-1][4] += cpu
+        with self.lock:
+            phase = self.phases.setdefault(name, [0, 0.0, 0.0])
+            phase[0] += 1 if call else 0
+            phase[1] += wall - nested_wall
+            phase[2] += cpu - nested_cpu
+
+    # times every step of an iterator as the phase name and counts the items
+    # it yields under counter, if given
+    def iterate(self, items, name, counter=None):
+        while True:
+            self.enter(name)
+            try:
+                item = next(items)
+            except StopIteration:
+                return
+            finally:
+                self.exit(False)
+            if counter is not None:
+                self.count(counter)
+            yield item
+
+    def snapshot(self):
+        with self.lock:
+            return {"phases": dict((n, list(p)) for (n, p) in self.phases.items()),
+                    "counters": dict(self.counters),
+                    "peak_rss": peak_rss()}
+
+    # adds the snapshot of an account worker process
+    def merge(self, snapshot):
+        with self.lock:
+            for name, (calls, wall, cpu) in snapshot["phases"].items():
+                phase = self.phases.setdefault(name, [0, 0.0, 0.0])
+                phase[0] += calls
+                phase[1] += wall
+                phase[2] += cpu
+            for name, n in snapshot["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + n
+            if snapshot["peak_rss"] is not None:
+                self.worker_rss = max(self.worker_rss or 0, snapshot["peak_rss"])
+
+    def report(self):
+        out = collections.OrderedDict()
+        out["wall"] = time.time() - self.start
+        out["cpu"] = sum(os.times()[0:2]) - self.cpu_start
+        out["peak_rss"] = peak_rss()
+        out["worker_peak_rss"] = self.worker_rss
+        out["phases"] = collections.OrderedDict(
+            (n, {"calls": c, "wall": w, "cpu": u}) for (n, (c, w, u)) in self.phases.items())
+        out["counters"] = self.counters
+        if RESPONSE_CACHE is not None:
+            out["cache"] = {"hits": RESPONSE_CACHE.hits, "misses": RESPONSE_CACHE.misses}
+        return out
+
+# decorator that times calls of a get_* or print_* function as a --stats
+# phase.  returned generators are timed as they are consumed, and their
+# items counted under counter.  calls straight through when stats are off
+def stats_phase(name, counter=None):
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if STATS is None:
+                return fn(*args, **kwargs)
+            STATS.enter(name)
+            try:
+                result = fn(*args, **kwargs)
+            finally:
+                STATS.exit()
+            if isinstance(result, types.GeneratorType):
+                return STATS.iterate(result, name, counter)
+            return result
+        return wrapper
+    return decorate
+
+# value as a float, or None if it is not a number
+def to_float(value):
   try:
-    # have to cast to string first, else isfloat will return True for booleans
-    float(str(value))
-    return True
+    # have to cast to string first, else booleans would be numbers
+    return float(str(value))
   except ValueError:
-    return False
+    return None
+
+# parses a decimal amount like "12.3456" into an integer number of
+# 10^-FC_AMOUNT_DIGITS units.  the common case is a single int() of the
+# digits, exponents and longer fractions go through Decimal (rounded half
+# to even)
+def parse_amount(amount):
+    point = amount.find(".")
+    digits = len(amount) - point - 1 if point >= 0 else 0
+    if digits <= FC_AMOUNT_DIGITS:
+        try:
+            return int(amount.replace(".", "", 1)) * FC_AMOUNT_POWERS[FC_AMOUNT_DIGITS - digits]
+        except ValueError: # e.g. 1E-7
+            pass
+    exact = decimal.Decimal(amount).scaleb(FC_AMOUNT_DIGITS)
+    return int(exact.to_integral_value(decimal.ROUND_HALF_EVEN))
+
+# formats a parsed amount with places decimals, rounded half to even like
+# "%.2f" does
+def format_amount(n, places=2):
+    if places == FC_AMOUNT_DIGITS: # nothing to round
+        digits = "%0*d" %(FC_AMOUNT_DIGITS + 1, abs(n))
+        return "%s%s.%s" %("-" if n < 0 else "", digits[:-FC_AMOUNT_DIGITS],
+                           digits[-FC_AMOUNT_DIGITS:])
+    q = FC_AMOUNT_POWERS[FC_AMOUNT_DIGITS - places]
+    units, rest = divmod(abs(n), q)
+    if rest * 2 > q or (rest * 2 == q and units % 2 == 1):
+        units += 1
+    whole, fraction = divmod(units, FC_AMOUNT_POWERS[places])
+    if places == 0:
+        return "%s%d" %("-" if n < 0 else "", whole)
+    return "%s%d.%0*d" %("-" if n < 0 else "", whole, places, fraction)
+
+# a parsed amount as the closest float, for JSON output
+def amount_value(n):
+    return float(decimal.Decimal(n).scaleb(-FC_AMOUNT_DIGITS))
+
+# a float in parse_amount() units.  only as exact as the float
+def float_amount(x):
+    return int(round(x * FC_AMOUNT_SCALE))
 
 # simple abbreviation scheme:
 #
 # strip off beginning "Amazon" and "AWS" from service name
 # then just use remaining uppercase letters to form abbreviation.
-# currently not in use
 def simple_abbreviation(string, suffix=""):
     abbr = ""
     if string.find("AWS") == 0:
@@ -129,211 +580,2361 @@ def simple_abbreviation(string, suffix=""):
     elif string.find("Amazon") == 0:
         string = string[6:]
     for letter in string:
-        if letter.isupper() or letter.isnumeric(): # numerals are okay too
+        if letter.isupper() or letter.isdigit(): # numerals are okay too
             abbr += letter
 
     return abbr 
 
-# currently not in use.  originally, would be used to generate abbreviations
-# for better printing on the screen, but not really needed.
-def build_abbreviations(a, s, r, start, end):
-    abbrv = {}
+# returns the shared Cost Explorer client for a credential set and region.
+# boto3 is imported on first use, so -h and argument errors don't pay for it
+@stats_phase("client")
+def get_ce_client(a, s, r):
+    with CLIENT_LOCK:
+        ce = CE_CLIENTS.get((a, s, r))
+        if ce is None and os.environ.get(FC_FAKE_CE_ENV):
+            import fakece
+            ce = fakece.from_spec(os.environ[FC_FAKE_CE_ENV], a)
+            CE_CLIENTS[(a, s, r)] = ce
+        elif ce is None:
+            import boto3
+            import botocore.config
+            session = CE_SESSIONS.get((a, s))
+            if session is None:
+                session = boto3.session.Session(aws_access_key_id=a,
+                                                aws_secret_access_key=s)
+                CE_SESSIONS[(a, s)] = session
+            config = botocore.config.Config(max_pool_connections=FC_CLIENT_POOL_SIZE)
+            ce = session.client('ce', region_name=r, config=config)
+            CE_CLIENTS[(a, s, r)] = ce
+        return ce
 
-    try:
-        ce = boto3.client('ce',
-                          aws_access_key_id=a,
-                          aws_secret_access_key=s,
-                          region_name=r) # not sure if region matters
-        res = ce.get_dimension_values(SearchString="",
-                                      TimePeriod={"Start":start, "End":end},
-                                      Dimension="SERVICE",
-                                      Context="COST_AND_USAGE")
-        # TODO make sure there are no duplicates
-        dims = res['DimensionValues']
-        for k in dims:
-            ab = simple_abbreviation(k['Value'])
-            abbrv[k['Value']] = ab # FIXME duplicates will overwrite values here...
-    except:
-        e = sys.exc_info()
-        print("ERROR: exception region=%s, error=%s" %(r, str(e)))
-        traceback.print_exc()
+# imports numpy on first use.  returns None if it is not installed
+def load_numpy():
+    global numpy
+    if numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+    return numpy
+
+# imports pyarrow and pyarrow.parquet on first use.  returns None if they are
+# not installed
+def load_pyarrow():
+    global pyarrow
+    if pyarrow is None:
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            pyarrow = None
+    return pyarrow
+
+# imports PyYAML on first use.  returns None if it is not installed
+def load_yaml():
+    global yaml
+    if yaml is None:
+        try:
+            import yaml
+        except ImportError:
+            yaml = None
+    return yaml
+
+# abbreviations of service names for --abbreviate, built from every service
+# in the catalog.  the defaults in ABBRV come first, the rest are made by
+# simple_abbreviation() in sorted order.  an abbreviation that is already
+# taken gets a number appended, so no two services share one and the same
+# catalog always gives the same abbreviations
+def build_abbreviations(services):
+    abbrv = {}
+    taken = set()
+    for service in services:
+        if service in ABBRV:
+            abbrv[service] = ABBRV[service]
+            taken.add(ABBRV[service])
+    for service in sorted(set(services)):
+        if service in abbrv:
+            continue
+        base = simple_abbreviation(service) or service.strip()[0:3].upper()
+        ab = base
+        n = 2
+        while ab in taken:
+            ab = "%s%d" %(base, n)
+            n += 1
+        abbrv[service] = ab
+        taken.add(ab)
     return abbrv
 
 # "get res recs" uses lookback instead of start/end time.
 # currently, supported services are EC2 and RDS
-def get_reserve_instance_recs(a, s, service="EC2", lookback="SIXTY_DAYS"):
-
-    if service == "EC2":
-        service = "Amazon Elastic Compute Cloud - Compute"
-    elif service == "RDS":
-        service = "Amazon Relational Database Service"
-    ce = boto3.client('ce',
-                      aws_access_key_id=a,
-                      aws_secret_access_key=s,
-                      region_name="us-east-1") # not sure if region matters
-    res = ce.get_reservation_purchase_recommendation(
-        Service=service,
-        LookbackPeriodInDays=lookback,
-        TermInYears="ONE_YEAR",
-        )
+def get_reserve_instance_recs(a, s, service="EC2", lookback="SIXTY_DAYS", term="ONE_YEAR",
+                              payment="PARTIAL_UPFRONT"):
+    service = FC_RI_SERVICE_NAMES.get(service, service)
+    ce = get_ce_client(a, s, "us-east-1") # not sure if region matters
+    res = None
+    for page in get_pages(ce, a, "get_reservation_purchase_recommendation",
+                          Service=service,
+                          LookbackPeriodInDays=lookback,
+                          TermInYears=term,
+                          PaymentOption=payment):
+        if res is None:
+            res = page
+        else:
+            res['Recommendations'].extend(page.get('Recommendations', []))
     #pprint.pprint(res, indent=1)
     return res
 
-def get_reservation_coverage(a, s, rlist, start, end, dims, tags, granularity="MONTHLY"):
-    covs = []
+# every (service, term, payment option, lookback) combination of the comma
+# separated option values, in the order given
+def ri_combinations(services, terms, payments, lookbacks):
+    return list(itertools.product(services.split(","), terms.split(","),
+                                  payments.split(","), lookbacks.split(",")))
+
+# fetches the recommendations of every combination on a pool of at most
+# workers threads.  returns [(combination, response)] in combination order.
+# raises IncompleteResultsError if any combination fails
+def get_ri_recs_matrix(a, s, combos, workers=FC_RI_WORKERS):
+    def fetch(combo):
+        service, term, payment, lookback = combo
+        try:
+            return combo, get_reserve_instance_recs(a, s, service, lookback, term, payment)
+        except Exception as e:
+            raise IncompleteResultsError("recommendations for %s are incomplete, %s: %s"
+                                         %(" ".join(combo), type(e).__name__, e))
+
+    pool = ThreadPool(max(1, min(workers, len(combos))))
+    try:
+        return pool.map(fetch, combos)
+    finally:
+        pool.terminate()
+
+# one comparison row per combination of get_ri_recs_matrix(): the number of
+# recommendations, instances to buy, upfront cost and estimated monthly
+# savings summed over all of them.  the savings percentage is recomputed
+# from the summed savings and on-demand costs
+def ri_matrix_rows(matrix):
+    rows = []
+    for (combo, res) in matrix:
+        row = collections.OrderedDict(zip(FC_RI_MATRIX_COLUMNS[0:4], combo))
+        count = 0
+        instances = upfront = savings = on_demand = 0.0
+        currency = ""
+        for rec in (res or {}).get('Recommendations', []):
+            for detail in rec.get('RecommendationDetails', []):
+                count += 1
+                instances += float(detail.get('RecommendedNumberOfInstancesToPurchase', 0))
+                upfront += float(detail.get('UpfrontCost', 0))
+            summary = rec.get('RecommendationSummary', {})
+            amount = float(summary.get('TotalEstimatedMonthlySavingsAmount', 0))
+            percentage = float(summary.get('TotalEstimatedMonthlySavingsPercentage', 0))
+            savings += amount
+            if percentage > 0:
+                on_demand += amount * 100.0 / percentage
+            currency = summary.get('CurrencyCode', currency)
+        row["recommendations"] = count
+        row["instances"] = instances
+        row["upfront_cost"] = round(upfront, 2)
+        row["monthly_savings"] = round(savings, 2)
+        row["savings_percentage"] = round(savings * 100.0 / on_demand, 2) if on_demand > 0 else 0.0
+        row["currency"] = currency
+        rows.append(row)
+    return rows
+
+# builds the GroupBy list for cost and coverage requests out of the comma
+# separated -d and -g option values.  groups by default_key if neither is set
+def build_groupbys(dims, tags, default_key):
+    groupbys = []
+    if len(dims) > 0 or len(tags) > 0:
+        dims = dims.split(",")
+        if len(dims) > 0 and dims != [""]:
+            for d in dims:
+                groupbys.append({"Type":"DIMENSION", "Key":d})
+
+        tags = tags.split(",")
+        if len(tags) > 0 and tags != [""]:
+            for t in tags:
+                groupbys.append({"Type":"TAG", "Key":t})
+
+    if len(groupbys) == 0:
+        groupbys.append({"Type":"DIMENSION", "Key":default_key})
+    return groupbys
+
+# calls a Cost Explorer API method and follows NextPageToken until the last
+# page, yielding every response page
+def fetch_pages(ce, operation, kwargs):
+    kwargs = dict(kwargs)
+    while True:
+        res = ce_call(ce, operation, kwargs)
+        yield res
+        token = res.get('NextPageToken')
+        if not token:
+            break
+        kwargs['NextPageToken'] = token
+
+# token bucket shared by all threads and processes of a run.  state lives in
+# shared memory, so the limiter can be handed to pool worker processes
+class RateLimiter(object):
+    def __init__(self, rate=FC_RATE_LIMIT, burst=FC_RATE_BURST):
+        self.max_rate = rate
+        self.burst = burst
+        self.lock = multiprocessing.Lock()
+        # current rate, available tokens, time of last refill
+        self.state = multiprocessing.Array('d', [rate, burst, time.time()], lock=False)
+
+    # blocks until a request may be sent
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                rate = self.state[0]
+                tokens = min(self.burst, self.state[1] + (now - self.state[2]) * rate)
+                self.state[2] = now
+                if tokens >= 1.0:
+                    self.state[1] = tokens - 1.0
+                    return
+                self.state[1] = tokens
+                wait = (1.0 - tokens) / rate
+            time.sleep(wait)
+
+    def throttled(self):
+        with self.lock:
+            self.state[0] = max(FC_RATE_MIN, self.state[0] / 2.0)
+            self.state[1] = 0.0
+
+    def succeeded(self):
+        with self.lock:
+            self.state[0] = min(self.max_rate, self.state[0] + FC_RATE_INCREASE)
+
+# returns "throttle", "transient" or None for errors that are not worth
+# retrying.  only looks at error codes and class names, so it works for any
+# client that raises botocore style errors
+def classify_error(e):
+    response = getattr(e, "response", None)
+    if isinstance(response, dict):
+        code = response.get("Error", {}).get("Code", "")
+        if code in FC_THROTTLE_ERRORS:
+            return "throttle"
+        status = response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0)
+        if code in FC_TRANSIENT_ERRORS or status >= 500:
+            return "transient"
+        return None
+    for cls in type(e).__mro__:
+        if cls.__name__ in FC_TRANSIENT_ERRORS:
+            return "transient"
+    return None
+
+# every Cost Explorer request goes through here: waits for the shared rate
+# limiter, and retries throttled or transient failures with exponential
+# backoff and full jitter.  other errors, or running out of retries, raise
+def ce_call(ce, operation, kwargs):
+    call = getattr(ce, operation)
+    stats = STATS
+    attempt = 0
+    while True:
+        if RATE_LIMITER is not None:
+            if stats is not None:
+                stats.enter("rate limit wait")
+            RATE_LIMITER.acquire()
+            if stats is not None:
+                stats.exit()
+        if stats is not None:
+            stats.count("api_calls")
+            stats.enter("api " + operation)
+        try:
+            res = call(**kwargs)
+        except Exception as e:
+            kind = classify_error(e)
+            if stats is not None:
+                stats.exit()
+                if kind == "throttle":
+                    stats.count("throttles")
+            if kind is None or attempt >= FC_MAX_RETRIES:
+                raise
+            if kind == "throttle" and RATE_LIMITER is not None:
+                RATE_LIMITER.throttled()
+            if stats is not None:
+                stats.count("retries")
+                stats.enter("retry backoff")
+            time.sleep(random.uniform(0, min(FC_RETRY_CAP, FC_RETRY_BASE * (2 ** attempt))))
+            if stats is not None:
+                stats.exit()
+            attempt += 1
+            continue
+        if stats is not None:
+            stats.exit()
+            stats.count("response_bytes", response_size(res))
+        if RATE_LIMITER is not None:
+            RATE_LIMITER.succeeded()
+        return res
+
+# size of a response body in bytes, from the HTTP headers when botocore
+# recorded them, else of the response as JSON
+def response_size(res):
+    headers = res.get('ResponseMetadata', {}).get('HTTPHeaders', {})
+    if "content-length" in headers:
+        return int(headers["content-length"])
+    return len(json.dumps(res, default=str))
+
+# all Cost Explorer requests for a report go through here.  a is the access
+# key the client was created with, used to keep cache entries per account
+def get_pages(ce, a, operation, **kwargs):
+    if RESPONSE_CACHE is not None:
+        pages = RESPONSE_CACHE.pages(ce, a, operation, kwargs)
+    else:
+        pages = fetch_pages(ce, operation, kwargs)
+    if STATS is not None:
+        pages = STATS.iterate(pages, "fetch", "pages")
+    if PIPELINE_DEPTH is not None:
+        pages = pipelined(pages, PIPELINE_DEPTH, "wait for pages")
+    return pages
+
+# iterates items in a thread of its own and yields them through a queue of at
+# most depth items, so the caller works on one item while the next ones are
+# produced.  a full queue blocks the producer, which bounds memory.  errors of
+# the producer are raised to the caller in order, and closing the generator
+# stops the producer.  time the caller spends waiting on an empty queue is
+# reported as phase name by --stats
+def pipelined(items, depth, name="pipeline wait"):
+    q = queue.Queue(depth)
+    stop = threading.Event()
+
+    def put(entry):
+        while not stop.is_set():
+            try:
+                q.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put((True, item)):
+                    return
+            put((False, None))
+        except BaseException as e:
+            put((False, e))
+        finally:
+            if hasattr(items, "close"):
+                items.close()
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            if STATS is not None and q.empty():
+                STATS.enter(name)
+                try:
+                    ok, item = q.get()
+                finally:
+                    STATS.exit()
+            else:
+                ok, item = q.get()
+            if ok:
+                yield item
+            elif item is None:
+                return
+            else:
+                raise item
+    finally:
+        stop.set()
+
+# groups items into lists of n
+def batched(items, n):
+    it = iter(items)
+    while True:
+        batch = list(itertools.islice(it, n))
+        if len(batch) == 0:
+            return
+        yield batch
+
+# True if a response can never change again: cost data for a period that has
+# ended and is no longer flagged as Estimated, or coverage for a period that
+# ended more than FC_CACHE_SETTLE_DAYS ago.  recommendations always expire
+def is_closed_period(operation, kwargs, res):
+    if "TimePeriod" not in kwargs:
+        return False
+    today = datetime.datetime.utcnow().date()
+    end = parse_date(kwargs['TimePeriod']['End'])
+    if operation == "get_cost_and_usage":
+        if end > today:
+            return False
+        for rbt in res.get('ResultsByTime', []):
+            if rbt.get('Estimated', True):
+                return False
+        return True
+    elif operation == "get_reservation_coverage":
+        return end <= today - datetime.timedelta(days=FC_CACHE_SETTLE_DAYS)
+    return False
+
+# on-disk cache of complete (all pages) Cost Explorer responses, keyed by
+# account, API operation and every request parameter.  closed periods are
+# kept forever, everything else expires after ttl seconds.  pages are
+# written as they stream in and the request is only marked complete once
+# the last page has been stored, so an interrupted fetch is never reused
+class ResponseCache(object):
+    def __init__(self, path, ttl=FC_CACHE_TTL, refresh=False):
+        self.ttl = ttl
+        self.refresh = refresh # ignore existing entries, but store new ones
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS requests "
+                        "(key TEXT PRIMARY KEY, pages INTEGER, fetched REAL, closed INTEGER)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS pages "
+                        "(key TEXT, page INTEGER, body TEXT, PRIMARY KEY (key, page))")
+        self.db.commit()
+
+    def make_key(self, a, operation, kwargs):
+        req = json.dumps([a, operation, kwargs], sort_keys=True)
+        return hashlib.sha256(req.encode("utf-8")).hexdigest()
+
+    def lookup(self, key):
+        with self.lock:
+            row = self.db.execute("SELECT pages, fetched, closed FROM requests WHERE key=?",
+                                  (key,)).fetchone()
+        if row is None or (not row[2] and row[1] + self.ttl < time.time()):
+            return None
+        return row[0]
+
+    def load_page(self, key, page):
+        with self.lock:
+            row = self.db.execute("SELECT body FROM pages WHERE key=? AND page=?",
+                                  (key, page)).fetchone()
+        return json.loads(row[0])
+
+    def pages(self, ce, a, operation, kwargs):
+        key = self.make_key(a, operation, kwargs)
+        npages = None
+        if not self.refresh:
+            npages = self.lookup(key)
+        if npages is not None:
+            with self.lock:
+                self.hits += 1
+            for page in range(0, npages):
+                yield self.load_page(key, page)
+            return
+
+        with self.lock:
+            self.misses += 1
+            self.db.execute("DELETE FROM requests WHERE key=?", (key,))
+            self.db.execute("DELETE FROM pages WHERE key=?", (key,))
+            self.db.commit()
+
+        closed = True
+        npages = 0
+        for res in fetch_pages(ce, operation, kwargs):
+            res.pop('ResponseMetadata', None)
+            closed = closed and is_closed_period(operation, kwargs, res)
+            with self.lock:
+                self.db.execute("INSERT INTO pages VALUES (?, ?, ?)",
+                                (key, npages, json.dumps(res, default=str)))
+            npages += 1
+            yield res
+
+        with self.lock:
+            self.db.execute("INSERT INTO requests VALUES (?, ?, ?, ?)",
+                            (key, npages, time.time(), int(closed)))
+            self.db.commit()
+
+# opens the response cache under cache_dir.  the cache is an optimization
+# only, so any problem opening it just disables caching
+def open_response_cache(cache_dir, ttl=FC_CACHE_TTL, refresh=False):
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        return ResponseCache(os.path.join(cache_dir, FC_CACHE_FILE), ttl, refresh)
+    except Exception:
+        e = sys.exc_info()
+        sys.stderr.write("Warning: response cache disabled, error=%s\n" %str(e))
+        return None
+
+# all values of a dimension (kind "DIMENSION"), a tag key (kind "TAG") or,
+# for kind "TAG" and an empty name, all tag keys of an account over the last
+# FC_CATALOG_DAYS days, or over [start, end) if given.  follows every page
+@stats_phase("catalog")
+def fetch_catalog_values(a, s, kind, name, start=None, end=None):
+    ce = get_ce_client(a, s, "us-east-1") # not sure if region matters
+    if start is None:
+        start, end = catalog_period()
+    period = {"Start": start, "End": end}
+    values = []
+    if kind == "DIMENSION":
+        for res in fetch_pages(ce, "get_dimension_values",
+                               {"TimePeriod": period, "Dimension": name,
+                                "Context": "COST_AND_USAGE"}):
+            values.extend([v['Value'] for v in res['DimensionValues']])
+    else:
+        kwargs = {"TimePeriod": period}
+        if name != "":
+            kwargs["TagKey"] = name
+        for res in fetch_pages(ce, "get_tags", kwargs):
+            values.extend(res['Tags'])
+    return values
+
+# local catalog of the dimension values and tag keys and values of every
+# account, see FC_CATALOG_TTL.  entries are (account, kind, name) as for
+# fetch_catalog_values().  a stale entry is returned as is and fetched again
+# in a background thread, so repeated runs never wait for the catalog and
+# runs within the TTL make no catalog calls at all.  call wait() before
+# exiting to let background fetches finish
+class Catalog(object):
+    def __init__(self, path, ttl=FC_CATALOG_TTL, refresh=False):
+        self.ttl = ttl
+        self.refresh = refresh # fetch every entry again before using it
+        self.lock = threading.Lock()
+        self.threads = {} # entries being fetched in the background
+        self.fetched = set() # entries fetched by this run
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS catalog_entries "
+                        "(account TEXT, kind TEXT, name TEXT, fetched REAL, "
+                        "PRIMARY KEY (account, kind, name))")
+        self.db.execute("CREATE TABLE IF NOT EXISTS catalog_values "
+                        "(account TEXT, kind TEXT, name TEXT, value TEXT)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS catalog_values_entry "
+                        "ON catalog_values (account, kind, name)")
+        self.db.commit()
+
+    # stored (values, time fetched) of an entry, or (None, None).  never
+    # calls Cost Explorer
+    def lookup(self, a, kind, name):
+        with self.lock:
+            row = self.db.execute("SELECT fetched FROM catalog_entries "
+                                  "WHERE account=? AND kind=? AND name=?",
+                                  (a, kind, name)).fetchone()
+            if row is None:
+                return None, None
+            values = self.db.execute("SELECT value FROM catalog_values "
+                                     "WHERE account=? AND kind=? AND name=? ORDER BY rowid",
+                                     (a, kind, name)).fetchall()
+        return [v[0] for v in values], row[0]
+
+    def store(self, a, kind, name, values):
+        with self.lock:
+            self.db.execute("DELETE FROM catalog_values WHERE account=? AND kind=? AND name=?",
+                            (a, kind, name))
+            self.db.executemany("INSERT INTO catalog_values VALUES (?, ?, ?, ?)",
+                                [(a, kind, name, v) for v in values])
+            self.db.execute("INSERT OR REPLACE INTO catalog_entries VALUES (?, ?, ?, ?)",
+                            (a, kind, name, time.time()))
+            self.db.commit()
+
+    def fetch(self, a, s, kind, name):
+        values = fetch_catalog_values(a, s, kind, name)
+        self.store(a, kind, name, values)
+        with self.lock:
+            self.fetched.add((a, kind, name))
+        return values
+
+    # True if an entry fetched at fetched (None if never) is due again
+    def stale(self, a, kind, name, fetched):
+        if fetched is None:
+            return True
+        if self.refresh:
+            with self.lock:
+                return (a, kind, name) not in self.fetched
+        return time.time() - fetched > self.ttl
+
+    # values of an entry.  missing entries (and all entries with refresh) are
+    # fetched first, stale ones are returned and fetched in the background.
+    # returns None if the values can't be fetched
+    def values(self, a, s, kind, name):
+        values, fetched = self.lookup(a, kind, name)
+        if values is None or (self.refresh and self.stale(a, kind, name, fetched)):
+            return self.fetch_or(a, s, kind, name, values)
+        if self.stale(a, kind, name, fetched):
+            self.prefetch(a, s, [(kind, name)])
+        return values
+
+    # values of an entry as they are now, fetched first unless this run
+    # already did.  for checks that must not fail on a stale entry.  returns
+    # the stored values if they can't be fetched
+    def current(self, a, s, kind, name):
+        with self.lock:
+            fetched = (a, kind, name) in self.fetched
+        if fetched:
+            return self.lookup(a, kind, name)[0]
+        return self.fetch_or(a, s, kind, name, self.lookup(a, kind, name)[0])
+
+    # fetches an entry, warns and returns default if that fails
+    def fetch_or(self, a, s, kind, name, default):
+        try:
+            return self.fetch(a, s, kind, name)
+        except Exception:
+            e = sys.exc_info()
+            sys.stderr.write("Warning: catalog of %s %s unavailable, error=%s\n"
+                             %(kind.lower(), name or "keys", str(e[1])))
+            return default
+
+    # fetches the entries that are missing or stale in background threads
+    def prefetch(self, a, s, entries):
+        for (kind, name) in entries:
+            _values, fetched = self.lookup(a, kind, name)
+            if not self.stale(a, kind, name, fetched):
+                continue
+            with self.lock:
+                if (a, kind, name) in self.threads:
+                    continue
+                thread = threading.Thread(target=self.fetch_quietly, args=(a, s, kind, name))
+                thread.daemon = True
+                self.threads[(a, kind, name)] = thread
+            thread.start()
+
+    # background fetches keep the stored entry if they fail
+    def fetch_quietly(self, a, s, kind, name):
+        try:
+            self.fetch(a, s, kind, name)
+        except Exception:
+            pass
+
+    def wait(self):
+        with self.lock:
+            threads = list(self.threads.values())
+        for thread in threads:
+            thread.join()
+
+# opens the catalog under cache_dir.  like the response cache, the catalog is
+# an optimization only, so any problem opening it just disables it
+def open_catalog(cache_dir, ttl=FC_CATALOG_TTL, refresh=False):
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        return Catalog(os.path.join(cache_dir, FC_CATALOG_FILE), ttl, refresh)
+    except Exception:
+        e = sys.exc_info()
+        sys.stderr.write("Warning: catalog disabled, error=%s\n" %str(e))
+        return None
+
+# the [start, end) days the catalog holds values of
+def catalog_period():
+    today = datetime.datetime.utcnow().date()
+    return ((today - datetime.timedelta(days=FC_CATALOG_DAYS)).strftime(FC_DATE_FORMAT),
+            today.strftime(FC_DATE_FORMAT))
+
+# the tags of a comma separated list of -g tag keys that are not tag keys
+# of the account, as [(tag, " (did you mean X?)" or "")].  a tag missing
+# from the catalog is looked up again, as it may be newer than the entry,
+# then among the tag keys of [start, end) if that starts before the days
+# the catalog holds, so retired tags still work for the ranges they were
+# used in.  tags are not checked if the keys can't be fetched
+def unknown_tag_keys(a, s, tags, start, end):
+    tags = [tag for tag in tags.split(",") if tag != ""]
+    unknown = lambda known: [tag for tag in tags if known is not None and tag not in known]
+    known = CATALOG.values(a, s, "TAG", "")
+    if len(unknown(known)) > 0:
+        known = CATALOG.current(a, s, "TAG", "")
+    if len(unknown(known)) > 0 and start < catalog_period()[0]:
+        try:
+            known = known + fetch_catalog_values(a, s, "TAG", "", start, end)
+        except Exception:
+            e = sys.exc_info()
+            sys.stderr.write("Warning: tag keys of %s - %s unavailable, error=%s\n"
+                             %(start, end, str(e[1])))
+            return []
+    return [(tag, did_you_mean(tag, known)) for tag in unknown(known)]
+
+# catalog entries of the -d and -g keys of a run
+def catalog_entries(dims, tags):
+    return ([("DIMENSION", d) for d in dims.split(",") if d != ""] +
+            [("TAG", t) for t in tags.split(",") if t != ""])
+
+# " (did you mean X?)" for the closest of choices, or ""
+def did_you_mean(value, choices):
+    close = difflib.get_close_matches(value, choices, 1)
+    if len(close) == 0:
+        return ""
+    return " (did you mean %s?)" %close[0]
+
+# generator, yields one coverage row at a time across all result pages.
+# raises IncompleteResultsError if fetching fails
+def get_reservation_coverage(a, s, rlist, start, end, dims, tags, granularity="MONTHLY"):
+    groupbys = build_groupbys(dims, tags, "REGION") # group by region by default
+
+    r = None
+    try:
+        for r in rlist:
+            ce = get_ce_client(a, s, r)
+
+            # can either have granularity or groupby, but not both
+            if len(groupbys) > 0:
+                pages = get_pages(ce, a, "get_reservation_coverage",
+                                  TimePeriod={"Start":start, "End":end},
+                                  GroupBy=groupbys)
+            else:
+                pages = get_pages(ce, a, "get_reservation_coverage",
+                                  TimePeriod={"Start":start, "End":end},
+                                  Granularity=granularity)
+            for res in pages:
+                for groups in res['CoveragesByTime']:
+                    for group in groups['Groups']:
+                        yield {
+                            "start_time": groups['TimePeriod']['Start'],
+                            "end_time": groups['TimePeriod']['End'],
+                            "Attributes": group['Attributes'],
+                            "Coverage": group['Coverage']['CoverageHours']
+                        }
+    except IncompleteResultsError:
+        raise
+    except Exception as e:
+        raise IncompleteResultsError("coverage for %s - %s (region %s) is incomplete, %s: %s"
+                                     %(start, end, r, type(e).__name__, e))
+
+# generator, yields one cost row at a time across all result pages for a
+# single region.  errors are raised to the caller
+def fetch_costs(a, s, r, start, end, groupbys, granularity="MONTHLY"):
+    ce = get_ce_client(a, s, r)
+
+    pages = get_pages(ce, a, "get_cost_and_usage",
+                      TimePeriod={"Start":start, "End":end},
+                      Granularity=granularity,
+                      Metrics=[m for (m, _field) in FC_COST_METRICS],
+                      GroupBy=groupbys)
+    for res in pages:
+        for groups in res['ResultsByTime']:
+            for group in groups['Groups']:
+            # Metrics are of {'Amount':xxxxxx, 'Unit':xxxxxx}
+                yield {
+                    "region": r,
+                    "estimated": groups['Estimated'],
+                    "start_time": groups['TimePeriod']['Start'],
+                    "end_time": groups['TimePeriod']['End'],
+                    "group": group['Keys'],
+                    #"srvabbr": ABBRV[group['Keys'][0]],
+                    "blended_cost": group['Metrics']['BlendedCost'],
+                    "unblended_cost": group['Metrics']['UnblendedCost'],
+                    "usage_quantity": group['Metrics']['UsageQuantity']
+                }
+
+# generator, yields one cost row at a time across all result pages.
+# raises IncompleteResultsError if fetching fails
+def get_costs(a, s, rlist, start, end, dims, tags, granularity="MONTHLY"):
+    groupbys = build_groupbys(dims, tags, "SERVICE") # group by service by default
+
+    r = None
+    try:
+        for r in rlist:
+            costs = fetch_costs(a, s, r, start, end, groupbys, granularity)
+            if PIPELINE_DEPTH is not None:
+                costs = itertools.chain.from_iterable(
+                    pipelined(batched(costs, FC_PIPELINE_BATCH), PIPELINE_DEPTH, "wait for rows"))
+            for cost in costs:
+                yield cost
+    except IncompleteResultsError:
+        raise
+    except Exception as e:
+        raise IncompleteResultsError("costs for %s - %s (region %s) are incomplete, %s: %s"
+                                     %(start, end, r, type(e).__name__, e))
+
+def parse_date(date):
+    return datetime.datetime.strptime(date, FC_DATE_FORMAT).date()
+
+# first day of the month after date
+def next_month(date):
+    return (date.replace(day=1) + datetime.timedelta(days=32)).replace(day=1)
+
+# splits the [start, end) range into consecutive windows of either calendar
+# months (window="MONTH") or a fixed number of days.  month windows line up
+# with MONTHLY buckets, so per-window results add up to the full range
+def split_time_range(start, end, window=FC_SHARD_WINDOW):
+    windows = []
+    s = parse_date(start)
+    e = parse_date(end)
+    while s < e:
+        if window == "MONTH":
+            n = next_month(s)
+        else:
+            n = s + datetime.timedelta(days=int(window))
+        n = min(n, e)
+        windows.append((s.strftime(FC_DATE_FORMAT), n.strftime(FC_DATE_FORMAT)))
+        s = n
+    return windows
+
+# runs fetch(start, end) for every window on a pool of at most workers threads
+# and yields the rows window by window in time order, so the output is the
+# same as a single serial request over the whole range
+def fetch_windows(fetch, windows, workers):
+    if len(windows) == 0:
+        return
+    workers = max(1, min(workers, len(windows)))
+    pool = ThreadPool(workers)
+    pending = collections.deque() # windows in flight, in time order
+    windows = iter(windows)
+
+    def submit():
+        for (ws, we) in itertools.islice(windows, 1):
+            pending.append(pool.apply_async(lambda: list(fetch(ws, we))))
+
+    try:
+        for _n in range(0, workers):
+            submit()
+        while len(pending) > 0:
+            rows = pending.popleft().get()
+            submit()
+            for row in rows:
+                yield row
+    finally:
+        pool.terminate()
+
+# sharded version of get_costs().  yields the same rows in the same order
+def get_costs_sharded(a, s, rlist, start, end, dims, tags, granularity="MONTHLY",
+                      workers=4, window=FC_SHARD_WINDOW):
+    def fetch(ws, we):
+        return get_costs(a, s, rlist, ws, we, dims, tags, granularity)
+    return fetch_windows(fetch, split_time_range(start, end, window), workers)
+
+# grouped coverage is reported as a single bucket for the whole time period,
+# so the per-window buckets are summed back together by group attributes.
+# groups of a single window keep the strings Cost Explorer sent.  hours of
+# several are summed exactly as decimals, CoverageHoursPercentage is
+# recomputed from the summed hours with as many places as it was sent with
+@stats_phase("aggregate")
+def merge_coverage_shards(covs, start, end):
+    merged = collections.OrderedDict() # key: [row, windows, {name: decimal sum}]
+    for cov in covs:
+        key = tuple(sorted(cov['Attributes'].items()))
+        if key not in merged:
+            merged[key] = [{"start_time": start, "end_time": end,
+                            "Attributes": cov['Attributes'],
+                            "Coverage": dict(cov['Coverage'])}, 0, {}]
+        entry = merged[key]
+        entry[1] += 1
+        for k, v in cov['Coverage'].items():
+            if k == "CoverageHoursPercentage": # keep the finest places sent
+                place = decimal.Decimal(v).as_tuple().exponent
+                entry[2][k] = min(entry[2].get(k, 0), place)
+            else:
+                entry[2][k] = entry[2].get(k, 0) + decimal.Decimal(v)
+
+    for (cov, windows, sums) in merged.values():
+        if windows > 1:
+            hours = cov['Coverage']
+            for k, v in sums.items():
+                hours[k] = str(v)
+            if "CoverageHoursPercentage" in sums:
+                total = sums.get("TotalRunningHours", 0)
+                percentage = sums.get("ReservedHours", 0) * 100 / total if total else decimal.Decimal(0)
+                hours["CoverageHoursPercentage"] = str(percentage.quantize(
+                    decimal.Decimal(1).scaleb(sums["CoverageHoursPercentage"]),
+                    decimal.ROUND_HALF_EVEN))
+        yield cov
+
+# coverage percentage of summed hours.  percentages themselves can't be summed
+def coverage_percentage(hours):
+    total = hours.get("TotalRunningHours", 0.0)
+    return hours.get("ReservedHours", 0.0) * 100.0 / total if total else 0.0
+
+# sharded version of get_reservation_coverage()
+def get_reservation_coverage_sharded(a, s, rlist, start, end, dims, tags, granularity="MONTHLY",
+                                     workers=4, window=FC_SHARD_WINDOW):
+    def fetch(ws, we):
+        return get_reservation_coverage(a, s, rlist, ws, we, dims, tags, granularity)
+    covs = fetch_windows(fetch, split_time_range(start, end, window), workers)
+    return merge_coverage_shards(covs, start, end)
+
+# grouped coverage for every DAILY or MONTHLY interval of [start, end).  Cost
+# Explorer returns a single bucket for the whole period when grouping, so
+# every interval is requested on its own, up to workers at once.  yields
+# one row per group and interval, in time order
+def get_reservation_coverage_series(a, s, rlist, start, end, dims, tags, granularity="DAILY",
+                                    workers=FC_SERIES_WORKERS):
+    def fetch(ws, we):
+        return get_reservation_coverage(a, s, rlist, ws, we, dims, tags, granularity)
+    window = "MONTH" if granularity == "MONTHLY" else "1"
+    return fetch_windows(fetch, split_time_range(start, end, window), workers)
+
+# group x time matrix of coverage rows, built in a single pass.  cells hold
+# the coverage percentage of a group in an interval.  summed reserved and
+# running hours per group, per interval and overall give the totals
+class CoverageMatrix(object):
+    def __init__(self):
+        self.periods = set()
+        self.cells = collections.OrderedDict() # label: {period: percentage}
+        self.group_hours = {}                  # label: [reserved, total]
+        self.period_hours = {}                 # period: [reserved, total]
+        self.hours = [0.0, 0.0]
+
+    @classmethod
+    @stats_phase("aggregate")
+    def from_rows(cls, covs):
+        matrix = cls()
+        for cov in covs:
+            matrix.add(cov)
+        return matrix
+
+    # rows of multi-account reports are labeled with their account first
+    def add(self, cov):
+        label = ", ".join([cov['Attributes'][k] for k in sorted(cov['Attributes'].keys())])
+        if "account" in cov:
+            label = "%s: %s" %(cov["account"], label)
+        period = cov['start_time']
+        reserved = float(cov['Coverage'].get("ReservedHours", 0))
+        total = float(cov['Coverage'].get("TotalRunningHours", 0))
+
+        self.periods.add(period)
+        self.cells.setdefault(label, {})[period] = reserved * 100.0 / total if total else 0.0
+        for (sums, key) in [(self.group_hours, label), (self.period_hours, period)]:
+            h = sums.setdefault(key, [0.0, 0.0])
+            h[0] += reserved
+            h[1] += total
+        self.hours[0] += reserved
+        self.hours[1] += total
+
+    @staticmethod
+    def percentage(hours):
+        return hours[0] * 100.0 / hours[1] if hours[1] else 0.0
+
+# identifies a GroupBy combination in the local store, e.g.
+# "DIMENSION:SERVICE,TAG:env"
+def grouping_key(groupbys):
+    return ",".join(["%s:%s" %(g['Type'], g['Key']) for g in groupbys])
+
+# sqlite aggregate amount_sum(), the exact sum of amount strings as of
+# parse_amount().  the sum is returned as a string, sqlite integers could
+# overflow
+class AmountSum(object):
+    def __init__(self):
+        self.total = 0
+
+    def step(self, amount):
+        if amount is not None:
+            self.total += parse_amount(amount)
+
+    def finalize(self):
+        return str(self.total)
+
+# local store of DAILY cost rows filled by the sync command.  for every
+# account and grouping it records the [low, high) range of days it holds,
+# high being the high-water mark of the last sync
+class CostStore(object):
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.db.create_aggregate("amount_sum", 1, AmountSum)
+        self.db.execute("CREATE TABLE IF NOT EXISTS cost_rows "
+                        "(account TEXT, grouping TEXT, start TEXT, end TEXT, "
+                        "keys TEXT, region TEXT, estimated INTEGER, "
+                        "blended_amount TEXT, blended_unit TEXT, "
+                        "unblended_amount TEXT, unblended_unit TEXT, "
+                        "usage_amount TEXT, usage_unit TEXT, key1 TEXT, key2 TEXT)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS cost_rows_day "
+                        "ON cost_rows (account, grouping, start)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS sync_state "
+                        "(account TEXT, grouping TEXT, low TEXT, high TEXT, "
+                        "PRIMARY KEY (account, grouping))")
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(cost_rows)")]
+        if "key1" not in columns: # stores synced before the key columns existed
+            self.db.execute("ALTER TABLE cost_rows ADD COLUMN key1 TEXT")
+            self.db.execute("ALTER TABLE cost_rows ADD COLUMN key2 TEXT")
+            rows = self.db.execute("SELECT rowid, keys FROM cost_rows").fetchall()
+            self.db.executemany("UPDATE cost_rows SET key1=?, key2=? WHERE rowid=?",
+                                [tuple((json.loads(keys) + [None, None])[0:2]) + (rowid,)
+                                 for (rowid, keys) in rows])
+        self.db.commit()
+
+    # [(grouping, low, high)] of every grouping synced for an account
+    def groupings(self, a):
+        with self.lock:
+            return self.db.execute("SELECT grouping, low, high FROM sync_state "
+                                   "WHERE account=? ORDER BY rowid", (a,)).fetchall()
+
+    # returns the (low, high) range of days held, or (None, None)
+    def synced_range(self, a, grouping):
+        with self.lock:
+            row = self.db.execute("SELECT low, high FROM sync_state "
+                                  "WHERE account=? AND grouping=?",
+                                  (a, grouping)).fetchone()
+        if row is None:
+            return None, None
+        return row[0], row[1]
+
+    # first day on or after since that Cost Explorer still flagged as Estimated
+    def first_estimated(self, a, grouping, since):
+        with self.lock:
+            row = self.db.execute("SELECT MIN(start) FROM cost_rows "
+                                  "WHERE account=? AND grouping=? AND start>=? "
+                                  "AND estimated=1", (a, grouping, since)).fetchone()
+        return row[0]
+
+    # replaces all stored rows of [start, end) with costs and extends the
+    # synced range.  nothing is committed unless all of costs was read
+    def replace_rows(self, a, grouping, start, end, costs):
+        count = 0
+        with self.lock:
+            try:
+                self.db.execute("DELETE FROM cost_rows WHERE account=? AND grouping=? "
+                                "AND start>=? AND start<?", (a, grouping, start, end))
+                for cost in costs:
+                    keys = (cost['group'] + [None, None])[0:2]
+                    self.db.execute("INSERT INTO cost_rows VALUES "
+                                    "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                    (a, grouping, cost['start_time'], cost['end_time'],
+                                     json.dumps(cost['group']), cost['region'],
+                                     int(cost['estimated']),
+                                     cost['blended_cost']['Amount'], cost['blended_cost']['Unit'],
+                                     cost['unblended_cost']['Amount'], cost['unblended_cost']['Unit'],
+                                     cost['usage_quantity']['Amount'], cost['usage_quantity']['Unit'],
+                                     keys[0], keys[1]))
+                    count += 1
+                row = self.db.execute("SELECT low, high FROM sync_state "
+                                      "WHERE account=? AND grouping=?",
+                                      (a, grouping)).fetchone()
+                low, high = start, end
+                if row is not None:
+                    low, high = min(row[0], start), max(row[1], end)
+                self.db.execute("INSERT OR REPLACE INTO sync_state VALUES (?, ?, ?, ?)",
+                                (a, grouping, low, high))
+                self.db.commit()
+            except:
+                self.db.rollback()
+                raise
+        return count
+
+    # generator, yields stored rows of [start, end) in the same format as
+    # get_costs().  MONTHLY granularity sums the days of each month
+    def costs(self, a, grouping, start, end, granularity="DAILY"):
+        if granularity == "DAILY":
+            query = ("SELECT start, end, keys, region, estimated, "
+                     "blended_amount, blended_unit, unblended_amount, unblended_unit, "
+                     "usage_amount, usage_unit FROM cost_rows "
+                     "WHERE account=? AND grouping=? AND start>=? AND start<? "
+                     "ORDER BY start, rowid")
+        else:
+            query = ("SELECT substr(start, 1, 7), NULL, keys, MAX(region), MAX(estimated), "
+                     "amount_sum(blended_amount), MAX(blended_unit), "
+                     "amount_sum(unblended_amount), MAX(unblended_unit), "
+                     "amount_sum(usage_amount), MAX(usage_unit) FROM cost_rows "
+                     "WHERE account=? AND grouping=? AND start>=? AND start<? "
+                     "GROUP BY substr(start, 1, 7), keys "
+                     "ORDER BY substr(start, 1, 7), MIN(rowid)")
+        with self.lock:
+            rows = self.db.execute(query, (a, grouping, start, end)).fetchall()
+
+        for row in rows:
+            row_start, row_end = row[0], row[1]
+            if granularity != "DAILY": # row_start is the YYYY-MM month
+                month = parse_date(row_start + "-01")
+                row_start = max(month.strftime(FC_DATE_FORMAT), start)
+                row_end = min(next_month(month).strftime(FC_DATE_FORMAT), end)
+                row = row[0:5] + tuple([format_amount(int(x), FC_AMOUNT_DIGITS) if n % 2 == 0 else x
+                                        for (n, x) in enumerate(row[5:])])
+            yield {
+                "region": row[3],
+                "estimated": bool(row[4]),
+                "start_time": row_start,
+                "end_time": row_end,
+                "group": json.loads(row[2]),
+                "blended_cost": {"Amount": row[5], "Unit": row[6]},
+                "unblended_cost": {"Amount": row[7], "Unit": row[8]},
+                "usage_quantity": {"Amount": row[9], "Unit": row[10]}
+            }
+
+    # sums a metric of the rows of [start, end) per period and per group key
+    # column.  by is a list of key positions (0 or 1) to group by, filters a
+    # list of (key position, [allowed values]).  returns [(period, [keys],
+    # amount, unit)] ordered by period, then largest amount first.  amounts
+    # are exact sums as of parse_amount()
+    def aggregate(self, a, grouping, start, end, by, filters, period="TOTAL", metric="unblended"):
+        columns = ["key%d" %(i + 1) for i in by]
+        where = ["account=?", "grouping=?", "start>=?", "start<?"]
+        args = [a, grouping, start, end]
+        for (i, values) in filters:
+            where.append("key%d IN (%s)" %(i + 1, ", ".join(["?"] * len(values))))
+            args.extend(values)
+        query = ("SELECT %s, %s amount_sum(%s_amount), MAX(%s_unit) FROM cost_rows "
+                 "WHERE %s GROUP BY %s"
+                 %(FC_QUERY_PERIODS[period], "".join([c + ", " for c in columns]), metric, metric,
+                   " AND ".join(where), ", ".join(["1"] + columns)))
+        with self.lock:
+            rows = self.db.execute(query, args).fetchall()
+        rows = [(row[0], list(row[1:-2]), int(row[-2]), row[-1]) for row in rows]
+        rows.sort(key=lambda row: (row[0], -row[2]))
+        return rows
+
+def open_cost_store(path):
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    return CostStore(path)
+
+# brings the store up to date for [start, end): days before the stored range
+# are backfilled, then everything from the high-water mark (or the first day
+# still flagged as Estimated, if earlier) up to end is fetched again.  a
+# range apart from the stored one is widened to reach it, so the days in
+# between are fetched too and the stored range never has a gap.
+# returns a list of (start, end, rows) for every range that was fetched
+def sync_costs(store, a, s, rlist, start, end, dims, tags):
+    groupbys = build_groupbys(dims, tags, "SERVICE")
+    grouping = grouping_key(groupbys)
+
+    ranges = []
+    low, high = store.synced_range(a, grouping)
+    if low is None:
+        ranges.append((start, end)) # nothing stored yet
+    else:
+        start, end = min(start, high), max(end, low)
+        if start < low:
+            ranges.append((start, low))
+        since = high
+        estimated = store.first_estimated(a, grouping, max(start, low))
+        if estimated is not None and estimated < since:
+            since = estimated
+        if since < end:
+            ranges.append((max(since, start), end))
+
+    synced = []
+    for (fs, fe) in ranges:
+        costs = itertools.chain(*[fetch_costs(a, s, r, fs, fe, groupbys, "DAILY")
+                                  for r in rlist])
+        synced.append((fs, fe, store.replace_rows(a, grouping, fs, fe, costs)))
+    return synced
+
+# turns a comma separated list of grouping keys into a GroupBy list.  known
+# dimensions are DIMENSION keys, anything else is a tag name
+def parse_key_spec(spec):
+    groupbys = []
+    for key in spec.split(","):
+        key = key.strip()
+        if key.upper() in GROUP_DIMENSIONS:
+            groupbys.append({"Type":"DIMENSION", "Key":key.upper()})
+        elif key != "":
+            groupbys.append({"Type":"TAG", "Key":key})
+    return groupbys
+
+# the -d and -g option values of a GroupBy list
+def groupby_options(groupbys):
+    return (",".join([g['Key'] for g in groupbys if g['Type'] == "DIMENSION"]),
+            ",".join([g['Key'] for g in groupbys if g['Type'] == "TAG"]))
+
+# answers a query from the store without calling Cost Explorer.  by and
+# filters name grouping keys as for parse_key_spec(), filters maps a key to
+# its allowed values.  tag values may be given without the "<tag>$" prefix
+# Cost Explorer puts on them.  the first synced grouping holding every key
+# is used.  returns (grouping, rows), rows are {"period": ..., <key>: value,
+# ..., "amount": ..., "unit": ...} dicts, amounts as of parse_amount().  top keeps only the top groups by
+# their total over the whole time range.  raises ValueError if no synced
+# grouping can answer the query
+def query_store(store, a, start, end, by, filters, period="TOTAL", metric="unblended", top=None):
+    by_keys = parse_key_spec(by)
+    filter_keys = [(parse_key_spec(k)[0], values) for (k, values) in filters.items()]
+    needed = set([grouping_key([g]) for g in by_keys + [k for (k, _v) in filter_keys]])
+
+    for (grouping, low, high) in store.groupings(a):
+        held = grouping.split(",")
+        if needed.issubset(held):
+            break
+    else:
+        raise ValueError("no synced grouping holds %s, sync one with --pass"
+                         %", ".join(sorted(needed)))
+    if start < low or end > high:
+        sys.stderr.write("Warning: store only holds %s - %s for grouping %s\n"
+                         %(low, high, grouping))
+
+    positions = [held.index(grouping_key([g])) for g in by_keys]
+    where = []
+    for (key, values) in filter_keys:
+        if key['Type'] == "TAG":
+            prefix = key['Key'] + "$"
+            values = [v if v.startswith(prefix) else prefix + v for v in values]
+        where.append((held.index(grouping_key([key])), values))
+    rows = store.aggregate(a, grouping, start, end, positions, where, period,
+                           FC_QUERY_METRICS[metric])
+
+    if top is not None:
+        totals = {}
+        for (_period, keys, amount, _unit) in rows:
+            totals[tuple(keys)] = totals.get(tuple(keys), 0) + amount
+        kept = set(sorted(totals.keys(), key=lambda k: -totals[k])[0:top])
+        rows = [row for row in rows if tuple(row[1]) in kept]
+
+    out = []
+    for (row_period, keys, amount, unit) in rows:
+        row = collections.OrderedDict([("period", row_period)])
+        for (g, value) in zip(by_keys, keys):
+            row[g['Key']] = value
+        row["amount"] = amount
+        row["unit"] = unit
+        out.append(row)
+    return grouping, out
+
+# generator, yields rows for cost reports from the store instead of Cost
+# Explorer.  warns if the store does not cover the whole time range
+def get_stored_costs(store, a, start, end, dims, tags, granularity="MONTHLY"):
+    grouping = grouping_key(build_groupbys(dims, tags, "SERVICE"))
+    low, high = store.synced_range(a, grouping)
+    if low is None:
+        sys.stderr.write("Warning: no synced data for grouping %s\n" %grouping)
+        return
+    if start < low or end > high:
+        sys.stderr.write("Warning: store only holds %s - %s for grouping %s\n"
+                         %(low, high, grouping))
+    for cost in store.costs(a, grouping, start, end, granularity):
+        yield cost
+
+# rolling per-group state of the anomalies command.  for every account,
+# grouping and metric it holds the number of days seen, the day after the
+# last of them and the moving mean and variance of every group
+class AnomalyState(object):
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.execute("CREATE TABLE IF NOT EXISTS anomaly_series "
+                        "(account TEXT, grouping TEXT, metric TEXT, days INTEGER, high TEXT, "
+                        "PRIMARY KEY (account, grouping, metric))")
+        self.db.execute("CREATE TABLE IF NOT EXISTS anomaly_groups "
+                        "(account TEXT, grouping TEXT, metric TEXT, keys TEXT, "
+                        "mean REAL, variance REAL, "
+                        "PRIMARY KEY (account, grouping, metric, keys))")
+        self.db.commit()
+
+    # returns (days, high, {keys: [mean, variance]}), high being None for a
+    # new series.  keys are the JSON of the group keys
+    def load(self, a, grouping, metric):
+        row = self.db.execute("SELECT days, high FROM anomaly_series "
+                              "WHERE account=? AND grouping=? AND metric=?",
+                              (a, grouping, metric)).fetchone()
+        if row is None:
+            return 0, None, {}
+        groups = self.db.execute("SELECT keys, mean, variance FROM anomaly_groups "
+                                 "WHERE account=? AND grouping=? AND metric=?",
+                                 (a, grouping, metric))
+        return row[0], row[1], dict((keys, [mean, var]) for (keys, mean, var) in groups)
+
+    # replaces the stored series with the one given, all in one transaction
+    def save(self, a, grouping, metric, days, high, groups):
+        try:
+            self.db.execute("INSERT OR REPLACE INTO anomaly_series VALUES (?, ?, ?, ?, ?)",
+                            (a, grouping, metric, days, high))
+            self.db.execute("DELETE FROM anomaly_groups "
+                            "WHERE account=? AND grouping=? AND metric=?", (a, grouping, metric))
+            self.db.executemany("INSERT INTO anomaly_groups VALUES (?, ?, ?, ?, ?, ?)",
+                                [(a, grouping, metric, keys, mean, var)
+                                 for (keys, (mean, var)) in groups.items()])
+            self.db.commit()
+        except:
+            self.db.rollback()
+            raise
+
+def open_anomaly_state(path):
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    return AnomalyState(path)
+
+# groups DAILY cost rows by day.  yields (start, end, estimated, {keys:
+# amount}) per day in time order, amounts being the metric field summed
+# over regions.  keys are the JSON of the group keys
+def daily_amounts(costs, field):
+    for (day, rows) in itertools.groupby(costs, lambda cost: cost['start_time']):
+        amounts = {}
+        end = day
+        estimated = False
+        for cost in rows:
+            keys = json.dumps(cost['group'])
+            amounts[keys] = amounts.get(keys, 0) + parse_amount(cost[field]['Amount'])
+            end = cost['end_time']
+            estimated = estimated or cost['estimated']
+        yield day, end, estimated, dict((k, amount_value(v)) for (k, v) in amounts.items())
+
+# checks one day of amounts against the moving mean and variance of groups
+# and returns the flagged [(keys, amount, mean, stddev)].  groups missing
+# from the day count as zero, groups new to the state as having been zero
+# so far.  with fold, the day is then added to groups in place.  the first
+# days are weighted 1 / (days + 1), which gives the plain mean and variance
+# until that drops below FC_ANOMALY_ALPHA.  groups whose mean and deviation
+# are below a cent are dropped, which is the same as never having seen them
+def check_day(amounts, groups, days, threshold, min_change, fold):
+    flagged = []
+    alpha = max(FC_ANOMALY_ALPHA, 1.0 / (days + 1))
+    new = [keys for keys in amounts if keys not in groups]
+    for keys in itertools.chain(list(groups.keys()), new):
+        mean, var = groups.get(keys, (0.0, 0.0))
+        x = amounts.get(keys, 0.0)
+        diff = x - mean
+        sd = math.sqrt(var)
+        if days >= FC_ANOMALY_WARMUP and abs(diff) >= min_change and abs(diff) > threshold * sd:
+            flagged.append((keys, x, mean, sd))
+        if fold:
+            incr = alpha * diff
+            mean += incr
+            var = (1 - alpha) * (var + diff * incr)
+            if abs(mean) < 0.005 and var < 0.000025:
+                groups.pop(keys, None)
+            else:
+                groups[keys] = [mean, var]
+    return flagged
+
+# brings the anomaly state of a grouping up to end and returns (days
+# checked, groups tracked, flagged rows of days on or after start).  only
+# the days after the stored ones are fetched, or from start for a new
+# state.  days still flagged as Estimated and less than
+# FC_CACHE_SETTLE_DAYS old are checked against the state without being
+# added to it, so the next run reads them again
+@stats_phase("detect")
+def detect_anomalies(state, a, s, rlist, start, end, dims, tags, opts):
+    groupbys = build_groupbys(dims, tags, "SERVICE")
+    grouping = grouping_key(groupbys)
+    field = FC_ROW_METRICS[opts.metric]
+    days, high, groups = state.load(a, grouping, opts.metric)
+    since = high if high is not None else start
+    if since >= end:
+        return 0, len(groups), []
+
+    if opts.workers > 1:
+        costs = get_costs_sharded(a, s, rlist, since, end, dims, tags, "DAILY", opts.workers)
+    else:
+        costs = get_costs(a, s, rlist, since, end, dims, tags, "DAILY")
+
+    settled = datetime.datetime.utcnow().date() - datetime.timedelta(days=FC_CACHE_SETTLE_DAYS)
+    checked = 0
+    fold = True
+    flagged = []
+    for (day, day_end, estimated, amounts) in daily_amounts(costs, field):
+        fold = fold and (not estimated or parse_date(day_end) <= settled)
+        for (keys, x, mean, sd) in check_day(amounts, groups, days, opts.threshold,
+                                             opts.min_change, fold):
+            if day >= start:
+                flagged.append((day, json.loads(keys), x, mean, sd, not fold))
+        checked += 1
+        if fold:
+            days += 1
+            high = day_end
+    if high is not None and high > since:
+        state.save(a, grouping, opts.metric, days, high, groups)
+
+    # largest deviations first within a day, new spend (no deviation) on top
+    flagged.sort(key=lambda f: (f[0], -abs(f[2] - f[3]) / f[4] if f[4] > 0 else -float("inf")))
+    rows = []
+    for (day, keys, x, mean, sd, provisional) in flagged:
+        row = collections.OrderedDict([("day", day)])
+        for (g, value) in zip(groupbys, keys):
+            row[g['Key']] = value
+        row["amount"] = round(x, 2)
+        row["expected"] = round(mean, 2)
+        row["stddev"] = round(sd, 2)
+        row["deviation"] = round((x - mean) / sd, 2) if sd > 0 else None
+        row["estimated"] = provisional
+        rows.append(row)
+    return checked, len(groups), rows
+
+# returns (first item, iterator over all items including the first one) so
+# generators can be checked for emptiness without being consumed.
+# returns (None, None) if there are no items
+def peek(iterable):
+    it = iter(iterable)
+    for first in it:
+        return first, itertools.chain([first], it)
+    return None, None
+
+# writes items as a JSON array one element at a time instead of serializing
+# the whole list at once.  output matches json.dumps(items, sort_keys=True, indent=4)
+def print_json_stream(items):
+    sep = "[\n"
+    for item in items:
+        body = json.dumps(item, sort_keys=True, indent=4, separators=(",", ": "))
+        sys.stdout.write(sep + "    " + body.replace("\n", "\n    "))
+        sep = ",\n"
+    if sep == "[\n": # no items
+        sys.stdout.write("[]\n")
+    else:
+        sys.stdout.write("\n]\n")
+
+# CSV schema of cost rows, known up front from the GroupBy request.  returns
+# (column names, column paths into the row dicts).  the first group key is
+# in the "group" column, any others in "group_<key>"
+def cost_schema(groupbys, account=False):
+    names = ["region", "estimated", "start_time", "end_time"]
+    if account: # rows of multi-account reports
+        names.insert(0, "account")
+    paths = [(n,) for n in names]
+    for i in range(0, len(groupbys)):
+        names.append("group" if i == 0 else "group_" + groupbys[i]['Key'])
+        paths.append(("group", i))
+    for (_metric, field) in FC_COST_METRICS:
+        for sub in ["Amount", "Unit"]:
+            names.append(field + "_" + sub)
+            paths.append((field, sub))
+    return names, paths
+
+# CSV schema of coverage rows.  Cost Explorer picks the attribute names of
+# coverage groups, so those are taken from the first row, the rest is fixed
+def coverage_schema(first):
+    names = ["start_time", "end_time"]
+    if "account" in first: # rows of multi-account reports
+        names.insert(0, "account")
+    paths = [(n,) for n in names]
+    for k in sorted(first['Attributes'].keys()):
+        names.append("Attributes_" + k)
+        paths.append(("Attributes", k))
+    for k in FC_COVERAGE_HOURS:
+        names.append("Coverage_" + k)
+        paths.append(("Coverage", k))
+    return names, paths
+
+# turns a list of column paths like ("blended_cost", "Amount") into a function
+# that maps a row to the list of its column values.  the function is compiled
+# once per schema, so rows are flattened without walking them like flatten()
+# does.  missing dict values come out empty
+def compile_flattener(paths):
+    exprs = []
+    for path in paths:
+        expr = "r"
+        for p in path[:-1]:
+            expr += "[%r]" %p
+        if isinstance(path[-1], int):
+            expr += "[%d]" %path[-1]
+        else:
+            expr += ".get(%r, '')" %path[-1]
+        exprs.append(expr)
+    return eval("lambda r: [%s]" %", ".join(exprs))
+
+# writes rows as CSV with a fixed header as they arrive
+def print_csv_stream(rows, names, paths):
+    flat = compile_flattener(paths)
+    csv_writer = csv.writer(sys.stdout, delimiter=",")
+    csv_writer.writerow(names)
+    for row in rows:
+        csv_writer.writerow(flat(row))
+
+# writes rows as JSON Lines, one object per line
+def print_jsonl_stream(rows):
+    for row in rows:
+        sys.stdout.write(json.dumps(row, sort_keys=True) + "\n")
+
+# we have some nested values in cost so we need to process the data
+# before converting to CSV.  takes in dict, returns flattened dict
+# dict cannot have lists, just sub-dicts
+def flatten(d, parent_key='', sep='_'):
+    items = []
+    for k, v in d.items():
+        new_key = parent_key + sep + k if parent_key else k
+        if isinstance(v, MutableMapping):
+            items.extend(flatten(v, new_key, sep=sep).items())
+        else:
+            if type(v) == type(list()): # we don't have any lists with > 1 item
+                v = v[0]
+            items.append((new_key, v))
+    return dict(items)
+
+# sums all metrics of the cost rows per group.  rows are grouped by the first
+# depth keys of their GroupBy keys (all keys if depth is None), so depth=1
+# rolls up a "-d SERVICE,USAGE_TYPE" report to services.  groups are kept in
+# a dict index, so this is linear in the number of rows.  sums are exact
+# parse_amount() integers, see format_amount() and amount_value().  fields
+# limits the sums to some of the metrics, every amount is parsed once and
+# only if it is needed.  exact sums are slower than the float sums they
+# replaced, about 2x here and 5x for parsing alone (benchmark.py micro
+# suite): float() is itself the fastest parser python has, and none of the
+# exact ones, numpy included, gets below it.  that is the price of totals
+# that match the bill to the cent
+#
+# output is [{'group': 'key1, key2', 'keys': ['key1', 'key2'],
+#             'values':{'blended_cost':xxx, 'blended_unit':xxx,
+#                       'unblended_cost':xxx, 'unblended_unit':xxx,
+#                       'usage_quantity':xxx, 'usage_unit':xxx,
+#                       'regions':[xxx]}}]
+# in order of first appearance
+@stats_phase("aggregate")
+def consolidate_costs_by_group(costs, depth=None, fields=None):
+    if fields is None:
+        fields = [field for (_metric, field) in FC_COST_METRICS]
+    units = [(field, field[:field.rfind("_")] + "_unit") for field in fields]
+    point = -FC_AMOUNT_DIGITS - 1
+    index = {}
+    order = []
+    for cost in costs:
+        keys = tuple(cost['group'][:depth])
+        values = index.get(keys)
+        if values is None:
+            values = {'regions': [cost['region']]}
+            for (field, unit) in units:
+                values[field] = parse_amount(cost[field]['Amount'])
+                values[unit] = cost[field]['Unit']
+            index[keys] = values
+            order.append(keys)
+        else:
+            for field in fields:
+                amount = cost[field]['Amount']
+                # parse_amount() inlined for amounts with all digits
+                if amount[point:point + 1] == ".":
+                    try:
+                        values[field] += int(amount.replace(".", "", 1))
+                        continue
+                    except ValueError: # e.g. 1.2345678E-5
+                        pass
+                values[field] += parse_amount(amount)
+            if cost['region'] not in values['regions']:
+                values['regions'].append(cost['region'])
+
+    out = []
+    for keys in order:
+        out.append({'group': ", ".join(keys) if len(keys) > 0 else "Total",
+                    'keys': list(keys),
+                    'values': index[keys]})
+    return out
+
+# bounded-memory top-K of group sums over a stream (Space-Saving with
+# batched eviction).  up to 2 x capacity groups are tracked.  when that is
+# reached, all but the capacity largest are dropped, and the largest dropped
+# sum becomes the floor that every newly seen group starts from.  so a
+# tracked sum is never below the true sum and at most its error above it,
+# and every group whose true sum exceeds the floor is tracked.  the total is
+# exact.  credits (negative amounts) of dropped groups only count in it
+class TopK(object):
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.sums = {} # key: [sum, error]
+        self.floor = 0
+        self.total = 0
+
+    def add(self, key, amount):
+        self.total += amount
+        entry = self.sums.get(key)
+        if entry is not None:
+            entry[0] += amount
+            return
+        if len(self.sums) >= 2 * self.capacity:
+            self.prune()
+        self.sums[key] = [self.floor + amount, self.floor]
+
+    def prune(self):
+        ranked = sorted(self.sums.items(), key=lambda item: -item[1][0])
+        self.floor = max(self.floor, ranked[self.capacity][1][0])
+        self.sums = dict(ranked[0:self.capacity])
+
+    # the n largest as [(key, sum, error)], largest first
+    def top(self, n):
+        ranked = sorted(self.sums.items(), key=lambda item: -item[1][0])[0:n]
+        return [(key, entry[0], entry[1]) for (key, entry) in ranked]
+
+# sums metric per group of the first depth keys of a row stream and keeps
+# the n largest.  returns ([(keys, sum, error)], exact total of all rows)
+@stats_phase("aggregate")
+def top_costs(costs, n, depth=None, metric="unblended_cost"):
+    top = TopK(max(FC_TOP_MIN_CAPACITY, FC_TOP_FACTOR * n))
+    for cost in costs:
+        top.add(tuple(cost['group'][:depth]), parse_amount(cost[metric]['Amount']))
+    return top.top(n), top.total
+
+# sorts more records than fit in memory.  records are buffered until their
+# estimated size reaches budget bytes, then sorted by key(record) and spilled
+# to a temporary file as a run.  iterating merges the runs with heapq.merge.
+# records with equal keys come out in the order they were added
+class ExternalSorter(object):
+    def __init__(self, budget, key):
+        self.budget = budget
+        self.key = key
+        self.buffer = []
+        self.size = 0
+        self.seq = 0
+        self.runs = []
+
+    def add(self, record):
+        blob = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+        self.buffer.append((self.key(record), self.seq, blob))
+        self.seq += 1
+        self.size += len(blob) + FC_SPILL_ROW_OVERHEAD
+        if self.size >= self.budget:
+            self.spill()
+
+    def spill(self):
+        self.buffer.sort()
+        self.runs.append(self.write_run(self.buffer))
+        self.buffer = []
+        self.size = 0
+        if STATS is not None:
+            STATS.count("spills")
+        if len(self.runs) >= FC_SPILL_MAX_RUNS:
+            runs = self.runs
+            self.runs = [self.write_run(heapq.merge(*[self.read_run(f) for f in runs]))]
+
+    def write_run(self, items):
+        f = tempfile.TemporaryFile(prefix="costreporter-")
+        for item in items:
+            pickle.dump(item, f, pickle.HIGHEST_PROTOCOL)
+        if STATS is not None:
+            STATS.count("spill_bytes", f.tell())
+        f.seek(0)
+        return f
+
+    @staticmethod
+    def read_run(f):
+        try:
+            while True:
+                yield pickle.load(f)
+        except EOFError:
+            f.close()
+
+    def __iter__(self):
+        self.buffer.sort()
+        runs = [self.read_run(f) for f in self.runs] + [iter(self.buffer)]
+        self.buffer = []
+        self.runs = []
+        for (_key, _seq, blob) in heapq.merge(*runs):
+            yield pickle.loads(blob)
+
+# cost rows sorted by group keys and then time, in memory bounded by budget
+def sort_costs_external(costs, budget):
+    sorter = ExternalSorter(budget, lambda cost: (cost['group'], cost['start_time']))
+    for cost in costs:
+        sorter.add(cost)
+    return iter(sorter)
+
+# consolidate_costs_by_group() in memory bounded by budget bytes.  groups are
+# summed in a dict until it holds budget / FC_SPILL_GROUP_BYTES of them, then
+# the dict is spilled as one sorted run and started over.  the runs are
+# merged by group, and the merged groups are sorted back into the order of
+# their first row, so the output is the same as consolidate_costs_by_group()
+@stats_phase("aggregate")
+def consolidate_costs_external(costs, depth=None, budget=256 * 1048576):
+    runs = ExternalSorter(budget, lambda group: group[0])
+    index = {}
+    seq = 0
+    for cost in costs:
+        keys = tuple(cost['group'][:depth])
+        values = index.get(keys)
+        if values is None:
+            if len(index) * FC_SPILL_GROUP_BYTES >= budget:
+                for group in index.items():
+                    runs.add(group)
+                runs.spill()
+                index = {}
+            values = {'first': seq,
+                      'blended_cost': parse_amount(cost['blended_cost']['Amount']),
+                      'blended_unit': cost['blended_cost']['Unit'],
+                      'unblended_cost': parse_amount(cost['unblended_cost']['Amount']),
+                      'unblended_unit': cost['unblended_cost']['Unit'],
+                      'usage_quantity': parse_amount(cost['usage_quantity']['Amount']),
+                      'usage_unit': cost['usage_quantity']['Unit'],
+                      'regions': [cost['region']]}
+            index[keys] = values
+        else:
+            values['blended_cost'] += parse_amount(cost['blended_cost']['Amount'])
+            values['unblended_cost'] += parse_amount(cost['unblended_cost']['Amount'])
+            values['usage_quantity'] += parse_amount(cost['usage_quantity']['Amount'])
+            if cost['region'] not in values['regions']:
+                values['regions'].append(cost['region'])
+        seq += 1
+    for group in index.items():
+        runs.add(group)
+    index = None
+
+    # runs of the same group come out in the order they were spilled
+    ordered = ExternalSorter(budget, lambda group: group[1]['first'])
+    for keys, parts in itertools.groupby(runs, lambda group: group[0]):
+        values = None
+        for (_keys, part) in parts:
+            if values is None:
+                values = part
+                continue
+            for m in ['blended_cost', 'unblended_cost', 'usage_quantity']:
+                values[m] += part[m]
+            values['regions'].extend([r for r in part['regions'] if r not in values['regions']])
+        ordered.add((keys, values))
+
+    for (keys, values) in ordered:
+        del values['first']
+        yield {'group': ", ".join(keys) if len(keys) > 0 else "Total",
+               'keys': list(keys),
+               'values': values}
+
+# columnar, numpy backed version of the rows returned by get_costs().  group
+# keys, periods and regions are dictionary encoded (each row only stores an
+# integer code), and the three metrics are parsed once into int64 columns of
+# parse_amount() units.  this takes a small fraction of the memory of the row
+# dicts and lets group-by, pivot, totals and top-N run vectorized.  a column
+# whose sums could overflow int64 (e.g. usage quantities of requests or
+# bytes) holds python ints instead, so sums are always exact.  rows are
+# rendered back with the amount strings they were read from
+class CostTable(object):
+    METRICS = ["blended_cost", "unblended_cost", "usage_quantity"]
+
+    def __init__(self):
+        self.keys = []         # distinct group key tuples, by code
+        self.periods = []      # distinct (start, end) tuples, by code
+        self.regions = []      # distinct regions, by code
+        self.units = {}        # unit per metric, usage unit per group key code
+        self.usage_units = []
+        self.key_codes = None  # per row columns
+        self.period_codes = None
+        self.region_codes = None
+        self.estimated = None
+        self.columns = {}
+        self.strings = {}      # per metric, {row: amount} of amounts that
+                               # format_amount() does not render back as read
+
+    # builds a table from an iterable of cost rows.  rows are consumed one at
+    # a time into compact arrays, so the row dicts never all exist at once
+    @classmethod
+    @stats_phase("aggregate")
+    def from_rows(cls, costs):
+        if load_numpy() is None:
+            raise RuntimeError("numpy is required for columnar cost tables")
+        table = cls()
+        key_index = {}
+        period_index = {}
+        region_index = {}
+        key_codes = array.array('i')
+        period_codes = array.array('i')
+        region_codes = array.array('i')
+        estimated = array.array('b')
+        columns = dict((m, array.array(FC_ARRAY_INT64)) for m in cls.METRICS)
+        point = -FC_AMOUNT_DIGITS - 1
+        table.strings = dict((m, {}) for m in cls.METRICS)
+
+        for cost in costs:
+            key = tuple(cost['group'])
+            code = key_index.get(key)
+            if code is None:
+                code = key_index[key] = len(table.keys)
+                table.keys.append(key)
+                table.usage_units.append(cost['usage_quantity']['Unit'])
+            key_codes.append(code)
+
+            period = (cost['start_time'], cost['end_time'])
+            code = period_index.get(period)
+            if code is None:
+                code = period_index[period] = len(table.periods)
+                table.periods.append(period)
+            period_codes.append(code)
+
+            code = region_index.get(cost['region'])
+            if code is None:
+                code = region_index[cost['region']] = len(table.regions)
+                table.regions.append(cost['region'])
+            region_codes.append(code)
+
+            estimated.append(1 if cost['estimated'] else 0)
+            for m in cls.METRICS:
+                amount = cost[m]['Amount']
+                digits = amount.replace(".", "", 1)
+                # all digits and no extra leading zero, as format_amount() renders it
+                if amount[point:point + 1] == "." and digits.isdigit() and \
+                   (digits[0] != "0" or len(digits) == FC_AMOUNT_DIGITS + 1):
+                    n = int(digits)
+                else:
+                    n = parse_amount(amount)
+                    if format_amount(n, FC_AMOUNT_DIGITS) != amount: # e.g. 1E-7
+                        table.strings[m][len(columns[m])] = amount
+                try:
+                    columns[m].append(n)
+                except OverflowError: # beyond int64, the column becomes python ints
+                    columns[m] = list(columns[m])
+                    columns[m].append(n)
+                table.units.setdefault(m, cost[m]['Unit'])
+
+        table.key_codes = numpy.frombuffer(key_codes, dtype=numpy.intc)
+        table.period_codes = numpy.frombuffer(period_codes, dtype=numpy.intc)
+        table.region_codes = numpy.frombuffer(region_codes, dtype=numpy.intc)
+        table.estimated = numpy.frombuffer(estimated, dtype=numpy.int8).astype(bool)
+        for m in cls.METRICS:
+            if isinstance(columns[m], list):
+                table.columns[m] = numpy.array(columns[m], dtype=object)
+                continue
+            column = numpy.frombuffer(columns[m], dtype="i%d" %columns[m].itemsize)
+            column = column.astype(numpy.int64, copy=False)
+            # no sum of the column can overflow if n x its largest magnitude fits
+            if len(column) > 0 and \
+               max(int(column.max()), -int(column.min())) * len(column) >= 2 ** 63:
+                column = column.astype(object)
+            table.columns[m] = column
+        return table
+
+    def __len__(self):
+        return len(self.key_codes)
+
+    # maps every row to the code of its first depth keys.  returns
+    # (prefix keys, per row prefix codes), prefixes in order of first appearance
+    def prefix_codes(self, depth=None):
+        if depth is None or depth >= max([len(k) for k in self.keys] or [0]):
+            return self.keys, self.key_codes
+        prefix_index = {}
+        prefixes = []
+        mapping = numpy.empty(len(self.keys), dtype=numpy.intc)
+        for code, key in enumerate(self.keys):
+            prefix = key[:depth]
+            if prefix not in prefix_index:
+                prefix_index[prefix] = len(prefixes)
+                prefixes.append(prefix)
+            mapping[code] = prefix_index[prefix]
+        return prefixes, mapping[self.key_codes]
+
+    # sums every metric per group of the first depth keys.  returns
+    # (group keys, {metric: array of sums indexed like group keys})
+    def group_by(self, depth=None):
+        keys, codes = self.prefix_codes(depth)
+        sums = {}
+        for m in self.METRICS:
+            sums[m] = numpy.zeros(len(keys), dtype=self.columns[m].dtype)
+            numpy.add.at(sums[m], codes, self.columns[m])
+        return keys, sums
+
+    # group x period matrix of one metric.  returns (group keys, periods,
+    # 2-d array with one row per group and one column per period)
+    def pivot(self, metric="unblended_cost", depth=None):
+        keys, codes = self.prefix_codes(depth)
+        order = sorted(range(0, len(self.periods)), key=lambda p: self.periods[p])
+        position = numpy.empty(len(self.periods), dtype=numpy.intc)
+        position[order] = numpy.arange(len(order), dtype=numpy.intc)
+        cells = codes.astype(numpy.int64) * len(order) + position[self.period_codes]
+        matrix = numpy.zeros(len(keys) * len(order), dtype=self.columns[metric].dtype)
+        numpy.add.at(matrix, cells, self.columns[metric])
+        return keys, [self.periods[p] for p in order], matrix.reshape(len(keys), len(order))
+
+    def totals(self):
+        return dict((m, int(self.columns[m].sum())) for m in self.METRICS)
+
+    # the n groups with the largest sum of metric, largest first.  returns a
+    # list of (group key, sum)
+    def top(self, n, metric="unblended_cost", depth=None):
+        keys, sums = self.group_by(depth)
+        ranked = numpy.argsort(-sums[metric], kind="mergesort")[:n]
+        return [(keys[i], int(sums[metric][i])) for i in ranked]
+
+    # same output as consolidate_costs_by_group(), computed from the columns
+    @stats_phase("aggregate")
+    def consolidate(self, depth=None):
+        keys, sums = self.group_by(depth)
+        regions = {}
+        codes = self.prefix_codes(depth)[1]
+        pairs = numpy.unique(codes.astype(numpy.int64) * len(self.regions) + self.region_codes)
+        for pair in pairs.tolist():
+            regions.setdefault(pair // len(self.regions), []).append(
+                self.regions[pair % len(self.regions)])
+
+        first_key = dict()
+        for code, key in enumerate(self.keys):
+            first_key.setdefault(key[:depth], code)
+
+        out = []
+        for code, key in enumerate(keys):
+            out.append({'group': ", ".join(key) if len(key) > 0 else "Total",
+                        'keys': list(key),
+                        'values': {'blended_cost': int(sums['blended_cost'][code]),
+                                   'blended_unit': self.units['blended_cost'],
+                                   'unblended_cost': int(sums['unblended_cost'][code]),
+                                   'unblended_unit': self.units['unblended_cost'],
+                                   'usage_quantity': int(sums['usage_quantity'][code]),
+                                   'usage_unit': self.usage_units[first_key[key]],
+                                   'regions': sorted(regions.get(code, []))}})
+        return out
+
+    # generator, turns the table back into cost rows for JSON and CSV output.
+    # amounts are rendered from the int64 columns, as read from the rows
+    def rows(self):
+        def amount(m, i):
+            text = self.strings[m].get(i)
+            if text is None:
+                return format_amount(int(self.columns[m][i]), FC_AMOUNT_DIGITS)
+            return text
+
+        for i in range(0, len(self)):
+            code = int(self.key_codes[i])
+            period = self.periods[self.period_codes[i]]
+            yield {
+                "region": self.regions[self.region_codes[i]],
+                "estimated": bool(self.estimated[i]),
+                "start_time": period[0],
+                "end_time": period[1],
+                "group": list(self.keys[code]),
+                "blended_cost": {"Amount": amount('blended_cost', i),
+                                 "Unit": self.units['blended_cost']},
+                "unblended_cost": {"Amount": amount('unblended_cost', i),
+                                   "Unit": self.units['unblended_cost']},
+                "usage_quantity": {"Amount": amount('usage_quantity', i),
+                                   "Unit": self.usage_units[code]}
+            }
+
+# writes cost rows in the native archive layout.  all integers are little
+# endian:
+#
+#   row groups, each holding the columns of up to FC_ARCHIVE_ROW_GROUP rows
+#       blended_cost, unblended_cost, usage_quantity
+#                   int64 amounts in parse_amount() units (10^-10), or for
+#                   the "wide" columns of the row group 128 bit amounts,
+#                   all uint64 low words, then all int64 high words
+#       key         int32 code into the "keys" dictionary
+#       period      int32 code into the "periods" dictionary
+#       region      int32 code into the "regions" dictionary
+#       estimated   uint8, 1 if Cost Explorer flagged the row as estimated
+#       zero padding to a multiple of 8 bytes
+#   footer          UTF-8 JSON object
+#   footer length   uint64
+#   magic           FC_ARCHIVE_MAGIC
+#
+# the footer holds the "groupbys" of the rows, the dictionaries "keys" (lists
+# of group keys), "periods" ([start, end] pairs) and "regions", the "units"
+# of the amount columns, "usage_units" per key code, and "row_groups", one
+# object per row group with its "offset", number of "rows", "min_start" and
+# "max_start" day, the sorted distinct "key_codes" it holds and the amount
+# columns that are "wide".  a column is only wide in row groups holding an
+# amount beyond int64 (about 9.2e8, e.g. usage quantities of requests or
+# bytes), 128 bits hold any amount up to about 1.7e28.  readers need the
+# footer only to decide which row groups to map
+class NativeArchiveWriter(object):
+    METRICS = ["blended_cost", "unblended_cost", "usage_quantity"]
+
+    def __init__(self, path, groupbys, row_group=FC_ARCHIVE_ROW_GROUP):
+        self.out = open(path, "wb")
+        self.groupbys = groupbys
+        self.row_group = row_group
+        self.keys = []
+        self.periods = []
+        self.regions = []
+        self.units = {}
+        self.usage_units = []
+        self.key_index = {}
+        self.period_index = {}
+        self.region_index = {}
+        self.row_groups = []
+        self.rows = 0
+        self.start_pending()
+
+    def start_pending(self):
+        self.amounts = dict((m, []) for m in self.METRICS)
+        self.key_codes = []
+        self.period_codes = []
+        self.region_codes = []
+        self.estimated = []
+
+    # index of value in a dictionary, added at the end if it is new
+    def code(self, index, values, value):
+        code = index.get(value)
+        if code is None:
+            code = index[value] = len(values)
+            values.append(value)
+        return code
+
+    def add(self, cost):
+        key = tuple(cost['group'])
+        if key not in self.key_index:
+            self.usage_units.append(cost['usage_quantity']['Unit'])
+        self.key_codes.append(self.code(self.key_index, self.keys, key))
+        self.period_codes.append(self.code(self.period_index, self.periods,
+                                           (cost['start_time'], cost['end_time'])))
+        self.region_codes.append(self.code(self.region_index, self.regions, cost['region']))
+        self.estimated.append(1 if cost['estimated'] else 0)
+        for m in self.METRICS:
+            self.amounts[m].append(parse_amount(cost[m]['Amount']))
+            self.units.setdefault(m, cost[m]['Unit'])
+        self.rows += 1
+        if len(self.key_codes) >= self.row_group:
+            self.flush()
+
+    def flush(self):
+        n = len(self.key_codes)
+        if n == 0:
+            return
+        starts = [self.periods[code][0] for code in set(self.period_codes)]
+        wide = [m for m in self.METRICS
+                if max(self.amounts[m]) >= 2 ** 63 or min(self.amounts[m]) < -2 ** 63]
+        self.row_groups.append({"offset": self.out.tell(), "rows": n,
+                                "min_start": min(starts), "max_start": max(starts),
+                                "key_codes": sorted(set(self.key_codes)), "wide": wide})
+        for m in self.METRICS:
+            if m not in wide:
+                self.out.write(struct.pack("<%dq" %n, *self.amounts[m]))
+                continue
+            if max(self.amounts[m]) >= 2 ** 127 or min(self.amounts[m]) < -2 ** 127:
+                raise ValueError("%s amount out of range" %m)
+            self.out.write(struct.pack("<%dQ" %n, *[x & (2 ** 64 - 1) for x in self.amounts[m]]))
+            self.out.write(struct.pack("<%dq" %n, *[x >> 64 for x in self.amounts[m]]))
+        for codes in [self.key_codes, self.period_codes, self.region_codes]:
+            self.out.write(struct.pack("<%di" %n, *codes))
+        self.out.write(struct.pack("<%dB" %n, *self.estimated))
+        self.out.write(b"\0" * (-(37 * n) % 8))
+        self.start_pending()
+
+    # writes the last row group and the footer.  returns the number of row groups
+    def close(self):
+        self.flush()
+        footer = json.dumps({"groupbys": self.groupbys, "keys": self.keys,
+                             "periods": self.periods, "regions": self.regions,
+                             "units": self.units, "usage_units": self.usage_units,
+                             "row_groups": self.row_groups}, sort_keys=True).encode("utf-8")
+        self.out.write(footer + struct.pack("<Q", len(footer)) + FC_ARCHIVE_MAGIC)
+        self.out.close()
+        return len(self.row_groups)
+
+# writes cost rows as Parquet, with the columns of the CSV output.  amounts
+# are decimals with FC_AMOUNT_DIGITS places, the GroupBy is kept in the
+# schema metadata.  Parquet records min/max statistics of every column of
+# every row group by itself
+class ParquetArchiveWriter(object):
+    def __init__(self, path, groupbys, row_group=FC_ARCHIVE_ROW_GROUP):
+        self.names, paths = cost_schema(groupbys)
+        self.flat = compile_flattener(paths)
+        self.amount_columns = [n for (n, name) in enumerate(self.names) if name.endswith("_Amount")]
+        fields = []
+        for name in self.names:
+            if name == "estimated":
+                kind = pyarrow.bool_()
+            elif name.endswith("_Amount"):
+                kind = pyarrow.decimal128(38, FC_AMOUNT_DIGITS)
+            else:
+                kind = pyarrow.string()
+            fields.append(pyarrow.field(name, kind))
+        self.schema = pyarrow.schema(fields, metadata={"costreporter": json.dumps(
+            {"groupbys": groupbys})})
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+        self.row_group = row_group
+        self.row_groups = 0
+        self.rows = 0
+        self.columns = [[] for _name in self.names]
+
+    def add(self, cost):
+        values = self.flat(cost)
+        for n in self.amount_columns:
+            values[n] = decimal.Decimal(parse_amount(values[n])).scaleb(-FC_AMOUNT_DIGITS)
+        for (column, value) in zip(self.columns, values):
+            column.append(value)
+        self.rows += 1
+        if len(self.columns[0]) >= self.row_group:
+            self.flush()
+
+    def flush(self):
+        n = len(self.columns[0])
+        if n == 0:
+            return
+        arrays = [pyarrow.array(column, type=field.type)
+                  for (column, field) in zip(self.columns, self.schema)]
+        self.writer.write_table(pyarrow.Table.from_arrays(arrays, schema=self.schema),
+                                row_group_size=n)
+        self.row_groups += 1
+        self.columns = [[] for _name in self.names]
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+        return self.row_groups
+
+# writes cost rows to path as Parquet if pyarrow is installed, else in the
+# native layout.  the file only appears once it is complete.  returns
+# (format, rows, row groups, bytes)
+@stats_phase("export")
+def export_costs(costs, path, groupbys):
+    if load_pyarrow() is not None:
+        kind, make = "Parquet", ParquetArchiveWriter
+    else:
+        kind, make = "native", NativeArchiveWriter
+    partial = path + ".partial"
+    writer = make(partial, groupbys)
+    try:
+        for cost in costs:
+            writer.add(cost)
+        row_groups = writer.close()
+    except:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    os.rename(partial, path)
+    return kind, writer.rows, row_groups, os.path.getsize(path)
+
+# key predicates of read --filter options, {key: [values]}, on archives
+# grouped by groupbys.  returns [(position of the key, set of values)].
+# raises ValueError for keys the archives are not grouped by
+def archive_conditions(groupbys, filters):
+    conditions = []
+    for (key, values) in filters.items():
+        groupby = parse_key_spec(key)[0]
+        names = [g['Key'] for g in groupbys]
+        if groupby['Key'] not in names:
+            raise ValueError("the archives are grouped by %s, not by %s"
+                             %(grouping_key(groupbys), key))
+        if groupby['Type'] == "TAG":
+            prefix = groupby['Key'] + "$"
+            values = [v if v.startswith(prefix) else prefix + v for v in values]
+        conditions.append((names.index(groupby['Key']), set(values)))
+    return conditions
+
+# an archive in the native layout, memory-mapped.  select() sets the time
+# range and key conditions, after which skip() tells from the footer alone
+# whether a row group can hold matching rows and rows() decodes only the
+# columns of one row group
+class NativeArchive(object):
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError: # empty file
+            raise ValueError("%s is not a cost archive" %path)
+        size = len(self.map)
+        if size < 16 or self.map[size - 8:] != FC_ARCHIVE_MAGIC:
+            raise ValueError("%s is not a cost archive" %path)
+        length = struct.unpack_from("<Q", self.map, size - 16)[0]
+        footer = json.loads(self.map[size - 16 - length:size - 16].decode("utf-8"))
+        self.groupbys = footer["groupbys"]
+        self.keys = footer["keys"]
+        self.periods = footer["periods"]
+        self.regions = footer["regions"]
+        self.units = footer["units"]
+        self.usage_units = footer["usage_units"]
+        self.row_groups = footer["row_groups"]
+        self.size = size
+
+    def count(self):
+        return len(self.row_groups)
 
-    groupbys = []
-    if len(dims) > 0 or len(tags) > 0:
-        dims = dims.split(",")
-        for d in dims:
-            groupbys.append({"Type":"DIMENSION", "Key":d})
+    def row_group_bytes(self, index):
+        n = self.row_groups[index]["rows"]
+        return 37 * n + (-(37 * n) % 8) + 8 * n * len(self.row_groups[index].get("wide", []))
 
-        tags = tags.split(",")
-    if len(tags) > 0 and tags != [""]:
-        for t in tags:
-            groupbys.append({"Type":"TAG", "Key":t})
+    def select(self, start, end, conditions):
+        self.start = start
+        self.end = end
+        self.allowed = None
+        if len(conditions) > 0:
+            self.allowed = set([code for (code, key) in enumerate(self.keys)
+                                if all([key[n] in values for (n, values) in conditions])])
+        self.period_codes = set([code for (code, period) in enumerate(self.periods)
+                                 if start <= period[0] < end])
 
-    if len(groupbys) == 0: # group by service by default
-        groupbys.append({"Type":"DIMENSION", "Key":"REGION"})
+    def skip(self, index):
+        group = self.row_groups[index]
+        if group["max_start"] < self.start or group["min_start"] >= self.end:
+            return True
+        return self.allowed is not None and self.allowed.isdisjoint(group["key_codes"])
 
-    try:
-        for r in rlist:
-            ce = boto3.client('ce',
-                              aws_access_key_id=a,
-                              aws_secret_access_key=s,
-                              region_name=r)
+    def rows(self, index):
+        group = self.row_groups[index]
+        n = group["rows"]
+        offset = group["offset"]
+        amounts = []
+        for metric in NativeArchiveWriter.METRICS:
+            if metric not in group.get("wide", []):
+                amounts.append(struct.unpack_from("<%dq" %n, self.map, offset))
+                offset += 8 * n
+                continue
+            low = struct.unpack_from("<%dQ" %n, self.map, offset)
+            high = struct.unpack_from("<%dq" %n, self.map, offset + 8 * n)
+            amounts.append([(h << 64) + l for (h, l) in zip(high, low)])
+            offset += 16 * n
+        codes = []
+        for _column in ["key", "period", "region"]:
+            codes.append(struct.unpack_from("<%di" %n, self.map, offset))
+            offset += 4 * n
+        estimated = struct.unpack_from("<%dB" %n, self.map, offset)
+        key_codes, period_codes, region_codes = codes
+        blended, unblended, usage = amounts
 
-            # can either have granularity or groupby, but not both
-            if len(groupbys) > 0:
-                res = ce.get_reservation_coverage(TimePeriod={"Start":start, "End":end},
-                                                  GroupBy=groupbys)
-            else:
-                res = ce.get_reservation_coverage(TimePeriod={"Start":start, "End":end},
-                                                  Granularity=granularity)
-            cbt = res['CoveragesByTime']
-            for groups in cbt:
-                for group in groups['Groups']:
-                    c = {
-                        "start_time": groups['TimePeriod']['Start'],
-                        "end_time": groups['TimePeriod']['End'],
-                        "Attributes": group['Attributes'],
-                        "Coverage": group['Coverage']['CoverageHours']
-                    }
-                    covs.append(c)
-    except:
-        e = sys.exc_info()
-        print("ERROR: exception region=%s, error=%s" %(r, str(e)))
-        traceback.print_exc()
-    return covs
+        for i in range(0, n):
+            if period_codes[i] not in self.period_codes or \
+               (self.allowed is not None and key_codes[i] not in self.allowed):
+                continue
+            code = key_codes[i]
+            period = self.periods[period_codes[i]]
+            yield {
+                "region": self.regions[region_codes[i]],
+                "estimated": estimated[i] == 1,
+                "start_time": period[0],
+                "end_time": period[1],
+                "group": list(self.keys[code]),
+                "blended_cost": {"Amount": format_amount(blended[i], FC_AMOUNT_DIGITS),
+                                 "Unit": self.units['blended_cost']},
+                "unblended_cost": {"Amount": format_amount(unblended[i], FC_AMOUNT_DIGITS),
+                                   "Unit": self.units['unblended_cost']},
+                "usage_quantity": {"Amount": format_amount(usage[i], FC_AMOUNT_DIGITS),
+                                   "Unit": self.usage_units[code]}
+            }
 
-def get_costs(a, s, rlist, start, end, dims, tags, granularity="MONTHLY"):
-    costs = []
+# a Parquet archive of ParquetArchiveWriter, memory-mapped by pyarrow.  same
+# interface as NativeArchive, row groups are skipped on the min/max
+# statistics of their start_time and group columns
+class ParquetArchive(object):
+    def __init__(self, path):
+        self.file = pyarrow.parquet.ParquetFile(path, memory_map=True)
+        metadata = self.file.schema_arrow.metadata or {}
+        if b"costreporter" not in metadata:
+            raise ValueError("%s is not a cost archive" %path)
+        self.groupbys = json.loads(metadata[b"costreporter"].decode("utf-8"))["groupbys"]
+        self.names = cost_schema(self.groupbys)[0]
+        self.metadata = self.file.metadata
+        self.size = os.path.getsize(path)
 
-    groupbys = []
-    if len(dims) > 0 or len(tags) > 0:
-        dims = dims.split(",")
-        if len(dims) > 0 and dims != [""]:
-            for d in dims:
-                groupbys.append({"Type":"DIMENSION", "Key":d})
+    def count(self):
+        return self.metadata.num_row_groups
 
-        tags = tags.split(",")
-        if len(tags) > 0 and tags != [""]:
-            for t in tags:
-                groupbys.append({"Type":"TAG", "Key":t})
+    def row_group_bytes(self, index):
+        return self.metadata.row_group(index).total_byte_size
 
-    if len(groupbys) == 0: # group by service by default
-        groupbys.append({"Type":"DIMENSION", "Key":"SERVICE"})
+    def select(self, start, end, conditions):
+        self.start = start
+        self.end = end
+        self.conditions = conditions
 
-    try:
-        for r in rlist:
-            ce = boto3.client('ce',
-                              aws_access_key_id=a,
-                              aws_secret_access_key=s,
-                              region_name=r)
+    # (min, max) of a column in a row group, or None without statistics
+    def bounds(self, index, name):
+        stats = self.metadata.row_group(index).column(self.names.index(name)).statistics
+        if stats is None or not stats.has_min_max:
+            return None
+        return [v.decode("utf-8") if isinstance(v, bytes) else v for v in [stats.min, stats.max]]
 
+    def skip(self, index):
+        bounds = self.bounds(index, "start_time")
+        if bounds is not None and (bounds[1] < self.start or bounds[0] >= self.end):
+            return True
+        for (n, values) in self.conditions:
+            bounds = self.bounds(index, self.names[4 + n])
+            if bounds is not None and len([v for v in values if bounds[0] <= v <= bounds[1]]) == 0:
+                return True
+        return False
 
-            if len(groupbys) > 0:
-                res = ce.get_cost_and_usage(TimePeriod={"Start":start, "End":end},
-                                            Granularity=granularity,
-                                            Metrics=["BlendedCost", "UnblendedCost", "UsageQuantity"],
-                                            GroupBy=groupbys)
-            else:
-                res = ce.get_cost_and_usage(TimePeriod={"Start":start, "End":end},
-                                            Granularity=granularity,
-                                            Metrics=["BlendedCost", "UnblendedCost", "UsageQuantity"])
-            rbt = res['ResultsByTime']
-            for groups in rbt:
-                for group in groups['Groups']:
-                # Metrics are of {'Amount':xxxxxx, 'Unit':xxxxxx}
-                    cost = {
-                        "region": r,
-                        "estimated": groups['Estimated'],
-                        "start_time": groups['TimePeriod']['Start'],
-                        "end_time": groups['TimePeriod']['End'],
-                        "group": group['Keys'],
-                        #"srvabbr": ABBRV[group['Keys'][0]],
-                        "blended_cost": group['Metrics']['BlendedCost'],
-                        "unblended_cost": group['Metrics']['UnblendedCost'],
-                        "usage_quantity": group['Metrics']['UsageQuantity']
-                    }
-                    costs.append(cost)
-    except:
-        e = sys.exc_info()
-        print("ERROR: exception region=%s, error=%s" %(r, str(e)))
-        traceback.print_exc()
-    return costs
+    def rows(self, index):
+        table = self.file.read_row_group(index)
+        columns = [table.column(name).to_pylist() for name in self.names]
+        depth = len(self.groupbys)
+        for values in zip(*columns):
+            if not self.start <= values[2] < self.end:
+                continue
+            keys = list(values[4:4 + depth])
+            if len([1 for (n, allowed) in self.conditions if keys[n] not in allowed]) > 0:
+                continue
+            row = {"region": values[0], "estimated": values[1], "start_time": values[2],
+                   "end_time": values[3], "group": keys}
+            for (m, (_metric, field)) in enumerate(FC_COST_METRICS):
+                amount = values[4 + depth + 2 * m]
+                row[field] = {"Amount": format_amount(int(amount.scaleb(FC_AMOUNT_DIGITS)),
+                                                      FC_AMOUNT_DIGITS),
+                              "Unit": values[5 + depth + 2 * m]}
+            yield row
 
-# we have some nested values in cost so we need to process the data
-# before converting to CSV.  takes in dict, returns flattened dict
-# dict cannot have lists, just sub-dicts
-def flatten(d, parent_key='', sep='_'):
-    items = []
-    for k, v in d.items():
-        new_key = parent_key + sep + k if parent_key else k
-        if isinstance(v, collections.MutableMapping):
-            items.extend(flatten(v, new_key, sep=sep).items())
-        else:
-            if type(v) == type(list()): # we don't have any lists with > 1 item
-                v = v[0]
-            items.append((new_key, v))
-    return dict(items)
+# opens an archive written by export_costs(), Parquet or native.  raises
+# ValueError if it is neither
+def open_archive(path):
+    with open(path, "rb") as f:
+        magic = f.read(4)
+    if magic == b"PAR1":
+        if load_pyarrow() is None:
+            raise ValueError("%s is a Parquet file, reading it requires pyarrow" %path)
+        return ParquetArchive(path)
+    return NativeArchive(path)
 
-# output is [{'group': 'name', values:{'unblended_cost':xxx, 'unblended_unit':xxx,
-#             'usage_quantity':xxx, 'usage_unit':xxx}}]
-def consolidate_costs_by_group(costs):
-    out = []
+# generator, yields the rows of archives with a start_time in [start, end)
+# whose group keys meet conditions (of archive_conditions()).  row groups
+# whose footer or statistics rule them out are never read.  the number of
+# row groups and bytes read is reported on stderr
+def read_archives(archives, start, end, conditions):
+    groups = read = 0
+    size = read_bytes = 0
+    for archive in archives:
+        archive.select(start, end, conditions)
+        size += archive.size
+        for index in range(0, archive.count()):
+            groups += 1
+            if archive.skip(index):
+                continue
+            read += 1
+            read_bytes += archive.row_group_bytes(index)
+            for row in archive.rows(index):
+                yield row
+    sys.stderr.write("read: %d of %d row groups, %s of %s in %d files\n"
+                     %(read, groups, format_bytes(read_bytes), format_bytes(size), len(archives)))
+
+# sums a metric field of cost rows per full group key tuple.  returns
+# ({keys: amount}, {keys: unit})
+def sum_costs_by_group(costs, field):
+    sums = {}
+    units = {}
     for cost in costs:
-        found = 0
-
-        # check if group already exists in list
-        for i in range(0, len(out)):
-            if out[i]['group'] == cost['group'][0]:
-                found = 1
-                out[i]['values']['unblended_cost'] += \
-                        float(cost['unblended_cost']['Amount'])
-                out[i]['values']['usage_quantity'] += \
-                        float(cost['usage_quantity']['Amount'])
-                break
-        # else add to output
-        if found == 0:
-            tmp = {'group':cost['group'][0], 'values':{}}
-            tmp['values'] = {'unblended_cost': float(cost['unblended_cost']['Amount']),
-                             'unblended_unit': cost['unblended_cost']['Unit'],
-                             'usage_quantity': float(cost['usage_quantity']['Amount']),
-                             'usage_unit': cost['usage_quantity']['Unit']}
-            out.append(tmp)
-    return out
+        keys = tuple(cost['group'])
+        sums[keys] = sums.get(keys, 0) + parse_amount(cost[field]['Amount'])
+        units[keys] = cost[field]['Unit']
+    return sums, units
+
+# fetches the costs of the [start, end) ranges after and before per group.
+# both are split into calendar months and every distinct window is
+# fetched once, up to workers at a time, so overlapping ranges share their
+# common months.  windows are summed as they arrive, so memory grows with
+# the number of groups, not rows.  returns (before sums, after sums, units)
+# as of sum_costs_by_group()
+def get_compared_costs(a, s, rlist, after, before, dims, tags, metric="unblended",
+                       workers=FC_COMPARE_WORKERS):
+    field = FC_ROW_METRICS[metric]
+    ranges = [split_time_range(*before), split_time_range(*after)]
+    windows = sorted(set(itertools.chain(*ranges)))
+
+    def fetch(window):
+        return window, sum_costs_by_group(get_costs(a, s, rlist, window[0], window[1], dims, tags),
+                                          field)
+
+    sums = [{}, {}]
+    units = {}
+    pool = ThreadPool(max(1, min(workers, len(windows))))
+    try:
+        for (window, (window_sums, window_units)) in pool.imap_unordered(fetch, windows):
+            units.update(window_units)
+            for (n, windows_of_range) in enumerate(ranges):
+                if window in windows_of_range:
+                    total = sums[n]
+                    for (keys, amount) in window_sums.items():
+                        total[keys] = total.get(keys, 0) + amount
+    finally:
+        pool.terminate()
+    return sums[0], sums[1], units
+
+# joins the per group sums of two ranges with a merge of their sorted keys.
+# returns one row per group in either range, [keys, before, after, status]
+# with status "new" for groups only after, "vanished" for groups only
+# before and "" for the rest, ranked by the largest absolute change
+@stats_phase("aggregate")
+def compare_costs(before, after):
+    b = sorted(before.items())
+    a = sorted(after.items())
+    i = j = 0
+    rows = []
+    while i < len(b) or j < len(a):
+        if j == len(a) or (i < len(b) and b[i][0] < a[j][0]):
+            rows.append([b[i][0], b[i][1], 0, "vanished"])
+            i += 1
+        elif i == len(b) or a[j][0] < b[i][0]:
+            rows.append([a[j][0], 0, a[j][1], "new"])
+            j += 1
+        else:
+            rows.append([a[j][0], b[i][1], a[j][1], ""])
+            i += 1
+            j += 1
+    rows.sort(key=lambda row: -abs(row[2] - row[1])) # stable, ties stay in key order
+    return rows
 
 # pass return value from get_reserve_instance_recs
-def print_ri_recs_results(recs, use_json=False, use_csv=False, lookback="SIXTY_DAYS", term="ONE_YEAR"):
+# one flat row per recommendation detail, with the scope, term, payment
+# option and lookback of its recommendation
+def ri_detail_rows(recs):
+    rows = []
+    for rec in recs.get("Recommendations", []):
+        for detail in rec.get("RecommendationDetails", []):
+            row = flatten(detail)
+            for key in FC_RI_DETAIL_COLUMNS[1:]:
+                row[key] = rec.get(key, "")
+            if "account" in recs: # responses of multi-account reports
+                row["account"] = recs["account"]
+            rows.append(row)
+    return rows
+
+# prints the rows of ri_detail_rows() as CSV or JSON Lines.  details of EC2
+# and RDS recommendations differ, so the columns are all keys of all rows
+def print_ri_detail_results(rows, use_csv=False, use_jsonl=False):
+    if use_jsonl == True:
+        print_jsonl_stream(rows)
+        return
+    keys = set()
+    for row in rows:
+        keys.update(row.keys())
+    names = [k for k in FC_RI_DETAIL_COLUMNS if k in keys]
+    names.extend(sorted(keys.difference(names)))
+    print_csv_stream(rows, names, [(n,) for n in names])
+
+@stats_phase("render")
+def print_ri_recs_results(recs, use_json=False, use_csv=False, lookback="SIXTY_DAYS", term="ONE_YEAR",
+                          use_jsonl=False):
     if len(recs) == 0:
         return
 
     if use_json == True:
         print(json.dumps(recs, sort_keys=True, indent=4))
-    elif use_csv == True:
-        #TODO the recommendation output is very nested, not ideal for CSV
-        pass
+    elif use_csv == True or use_jsonl == True:
+        print_ri_detail_results(ri_detail_rows(recs), use_csv, use_jsonl)
     else:
         print("Reserved Instance Recommendations: %s\n" %recs["Metadata"]["GenerationTimestamp"])
         print(" = Recommendation Details =")
@@ -342,8 +2943,9 @@ def print_ri_recs_results(recs, use_json=False, use_csv=False, lookback="SIXTY_D
                 for key, value in detail.items():
                     if key == "InstanceDetails":
                         continue # we'll print this out later
-                    if isfloat(value): # if a float
-                        print("%-54s %14.2f" %(key, float(value)))
+                    number = to_float(value)
+                    if number is not None:
+                        print("%-54s %14.2f" %(key, number))
                     else:
                         print("%-54s %14s" %(key, str(value)))
 
@@ -351,84 +2953,994 @@ def print_ri_recs_results(recs, use_json=False, use_csv=False, lookback="SIXTY_D
                 for key, value in detail["InstanceDetails"].items():
                     print("%s:" %key)
                     for k, v in detail["InstanceDetails"][key].items():
-                        if isfloat(v): # if a float
-                            print("%-54s %14.2f" %(k, float(v)))
+                        number = to_float(v)
+                        if number is not None:
+                            print("%-54s %14.2f" %(k, number))
                         else:
                             print("%-54s %14s" %(k, str(v)))
 
             print("\n = Recommendation Summary =")
             for key, value in rec["RecommendationSummary"].items():
-                if isfloat(value): # if a float
-                    print("%-54s %14.2f" %(key, float(value)))
+                number = to_float(value)
+                if number is not None:
+                    print("%-54s %14.2f" %(key, number))
                 else:
                     print("%-54s %14s" %(key, str(value)))
 
-# pass return value from get_reservation_coverages()
-def print_coverage_results(covs, use_json=False, use_csv=False, start=None, end=None):
-    if len(covs) == 0:
+# prints the rows of ri_matrix_rows().  text output is sorted by savings,
+# CSV and JSON keep the order of the combinations
+@stats_phase("render")
+def print_ri_matrix_results(rows, use_json=False, use_csv=False, use_jsonl=False):
+    names = list(FC_RI_MATRIX_COLUMNS)
+    if len(rows) > 0 and "account" in rows[0]: # rows of multi-account reports
+        names.insert(0, "account")
+
+    if use_json == True:
+        print_json_stream(rows)
+    elif use_jsonl == True:
+        print_jsonl_stream(rows)
+    elif use_csv == True:
+        print_csv_stream(rows, names, [(n,) for n in names])
+    else:
+        print("\nReserved Instance Recommendation Comparison\n")
+        account = "account" in names
+        header = "%-12s %-12s %-16s %-12s %6s %10s %14s %14s %8s" \
+                 %("= Service =", "= Term =", "= Payment =", "= Lookback =", "Recs",
+                   "Instances", "Upfront", "Savings/mo", "Savings")
+        print(("%-16s " %"= Account =" if account else "") + header)
+        for row in sorted(rows, key=lambda r: -r["monthly_savings"]):
+            print(("%-16s " %row["account"] if account else "") +
+                  "%-12s %-12s %-16s %-12s %6d %10.0f %14.2f %14.2f %7.2f%% %s"
+                  %(row["service"], row["term"], row["payment_option"], row["lookback"],
+                    row["recommendations"], row["instances"], row["upfront_cost"],
+                    row["monthly_savings"], row["savings_percentage"], row["currency"]))
+
+# pass return value from get_reservation_coverages().  rows are consumed as
+# they are printed so covs can be a generator
+# subtotals adds per account totals to the text output of multi-account
+# reports
+# series prints text output as a group x time matrix of coverage percentages
+@stats_phase("render")
+def print_coverage_results(covs, use_json=False, use_csv=False, start=None, end=None,
+                           use_jsonl=False, subtotals=False, series=False):
+    first, covs = peek(covs)
+    if first is None:
         return
 
     if use_json == True:
-        print(json.dumps(covs, sort_keys=True, indent=4))
+        print_json_stream(covs)
+    elif use_jsonl == True:
+        print_jsonl_stream(covs)
     elif use_csv == True:
-        flat_covs = []
-        for cov in covs:
-            flat_covs.append(flatten(cov))
-        # print headers
-        csv_writer = csv.DictWriter(sys.stdout, flat_covs[0].keys(), delimiter=",")
-        csv_writer.writeheader()
-        for cov in flat_covs:
-            csv_writer.writerow(cov)
+        names, paths = coverage_schema(first)
+        print_csv_stream(covs, names, paths)
+    elif series == True:
+        print_coverage_matrix(CoverageMatrix.from_rows(covs), start, end)
     else:
         # for calculating totals
         totals = {}
+        account_totals = collections.OrderedDict()
 
         print("\nSummary of Reservation Coverage: %s - %s\n" %(start, end))
         # print header.  hard-coded for now
         for cov in covs:
             print("= Group Attributes =")
+            if "account" in cov:
+                print("    account: %s" %cov["account"])
             for k, v in cov['Attributes'].items():
                 print("    %s: %s" %(k, v))
             print("= Coverage =")
+            account = account_totals.setdefault(cov.get("account", ""), {})
             for k, v in cov['Coverage'].items():
-                if k in totals:
-                    totals[k] += float(v)
-                else:
-                    totals[k] = float(v)
-                print("    %-50s\t%14.2f" %(k, float(v)))
+                value = parse_amount(v)
+                totals[k] = totals.get(k, 0) + value
+                account[k] = account.get(k, 0) + value
+                print("    %-50s\t%14s" %(k, format_amount(value)))
+            print("")
+        if subtotals == True:
+            print("= Account Subtotals =")
+            for account, hours in account_totals.items():
+                if "CoverageHoursPercentage" in hours:
+                    hours["CoverageHoursPercentage"] = float_amount(coverage_percentage(hours))
+                print("%s:" %account)
+                for k, v in hours.items():
+                    print("    %-50s\t%14s" %(k, format_amount(v)))
             print("")
+        if "CoverageHoursPercentage" in totals:
+            totals["CoverageHoursPercentage"] = float_amount(coverage_percentage(totals))
         print("= Totals =")
         for k, v in totals.items():
-            print("%-54s\t%14.2f" %(k, v))
+            print("%-54s\t%14s" %(k, format_amount(v)))
+
+# one line per group with its coverage percentage in every interval and over
+# the whole period, then the totals of all groups per interval
+def print_coverage_matrix(matrix, start=None, end=None):
+    periods = sorted(matrix.periods)
+    width = max([len(label) for label in matrix.cells.keys()] + [len("= Total =")])
+
+    print("\nReservation Coverage over time (%%): %s - %s\n" %(start, end))
+    print("%-*s %s %10s" %(width, "= Group =", " ".join(["%10s" %p for p in periods]), "= Total ="))
+    for label, cells in matrix.cells.items():
+        values = ["%10.2f" %cells[p] if p in cells else "%10s" %"-" for p in periods]
+        print("%-*s %s %10.2f" %(width, label, " ".join(values),
+                                 matrix.percentage(matrix.group_hours[label])))
+    values = ["%10.2f" %matrix.percentage(matrix.period_hours[p]) for p in periods]
+    print("%-*s %s %10.2f" %(width, "= Total =", " ".join(values), matrix.percentage(matrix.hours)))
 
-# pass return value from get_costs()
-def print_cost_results(costs, use_json=False, use_csv=False, start=None, end=None):
-    if len(costs) == 0:
+# text label of a group's keys, with service names abbreviated if
+# abbreviations is given
+def group_label(keys, abbreviations=None):
+    if abbreviations is not None:
+        keys = [abbreviations.get(k, k) for k in keys]
+    return ", ".join(keys) if len(keys) > 0 else "Total"
+
+# passes cost rows through while summing their unblended cost per account
+# into totals
+def tally_accounts(costs, totals):
+    for cost in costs:
+        account = cost.get("account", "")
+        totals[account] = totals.get(account, 0) + parse_amount(cost['unblended_cost']['Amount'])
+        yield cost
+
+# pass return value from get_costs().  rows are consumed as they are printed
+# so costs can be a generator
+# rollup limits the text summary to the first <rollup> GroupBy keys.
+# columnar loads the rows into a CostTable first and renders from it.
+# groupbys is the GroupBy of the request, used for the CSV header.
+# subtotals adds per account totals to the text output of multi-account
+# reports
+# top limits the text summary to the <top> largest groups by metric plus an
+# "Other" line, in memory bounded by <top> instead of the number of groups
+# budget (bytes) bounds the memory used to sort and aggregate, spilling to
+# temporary files.  row output is then sorted by group and time
+# abbreviations shortens service names in the text summary
+@stats_phase("render")
+def print_cost_results(costs, use_json=False, use_csv=False, start=None, end=None, rollup=None,
+                       columnar=False, groupbys=None, use_jsonl=False, subtotals=False,
+                       top=None, metric="unblended", budget=None, abbreviations=None):
+    first, costs = peek(costs)
+    if first is None:
         return
 
+    account_totals = collections.OrderedDict()
+    if subtotals == True:
+        costs = tally_accounts(costs, account_totals)
+
+    table = None
+    if columnar == True:
+        table = CostTable.from_rows(costs)
+        costs = table.rows()
+
+    if budget is not None and (use_json or use_jsonl or use_csv):
+        costs = sort_costs_external(costs, budget)
+
     if use_json == True:
-        print(json.dumps(costs, sort_keys=True, indent=4))
+        print_json_stream(costs)
+    elif use_jsonl == True:
+        print_jsonl_stream(costs)
     elif use_csv == True:
-        flat_costs = []
-        for cost in costs:
-            flat_costs.append(flatten(cost))
-
-        # print headers
-        #    print(
-        csv_writer = csv.DictWriter(sys.stdout, flat_costs[0].keys(), delimiter=",")
-        csv_writer.writeheader()
-        for cost in flat_costs:
-            csv_writer.writerow(cost)
+        if groupbys is None: # name extra group columns by position
+            groupbys = [{"Type":"DIMENSION", "Key":str(n)}
+                        for n in range(1, len(first['group']) + 1)]
+        names, paths = cost_schema(groupbys, "account" in first)
+        print_csv_stream(costs, names, paths)
+    elif top is not None:
+        field = FC_ROW_METRICS[metric]
+        if table is not None: # exact
+            ranked = [(keys, amount, 0) for (keys, amount) in table.top(top, field, rollup)]
+            total = table.totals()[field]
+        elif budget is not None: # exact
+            total = 0
+            heap = [] # (sum, -position, group), smallest first
+            out = consolidate_costs_external(costs, rollup, budget)
+            for n, cost in enumerate(out):
+                total += cost['values'][field]
+                item = (cost['values'][field], -n, cost)
+                if len(heap) < top:
+                    heapq.heappush(heap, item)
+                else:
+                    heapq.heappushpop(heap, item)
+            ranked = [(c['keys'], amount, 0) for (amount, _n, c) in sorted(heap, reverse=True)]
+        else:
+            ranked, total = top_costs(costs, top, rollup, field)
+        unit = first[field]['Unit']
+        print("\nSummary of costs: %s - %s (top %d by %s)\n" %(start, end, top, metric))
+        print("%s %61s" %("= Group =", "= Cost ="))
+        for (keys, amount, error) in ranked:
+            print("%-54s\t%14s %s%s" %(group_label(keys, abbreviations), format_amount(amount), unit,
+                                       " (at most %s high)" %format_amount(error) if error > 0 else ""))
+        other = total - sum([a for (_k, a, _e) in ranked])
+        print("%-54s\t%14s %s" %("Other", format_amount(other), unit))
+        print("%-54s\t%14s %s" %("= Total =", format_amount(total), unit))
+        if len([e for (_k, _a, e) in ranked if e > 0]) > 0:
+            print("\nToo many groups to track exactly, costs marked 'at most ... high'\n"
+                  "are upper bounds and their order may be off.  Use --columnar\n"
+                  "or --memory-budget for exact results.")
+        if subtotals == True:
+            print("\n%s %59s" %("= Account =", "= Cost ="))
+            for account, account_total in account_totals.items():
+                print("%-54s\t%14s %s" %(account, format_amount(account_total),
+                                         first['unblended_cost']['Unit']))
     else:
-        out = consolidate_costs_by_group(costs)
+        if table is not None:
+            out = table.consolidate(rollup)
+        elif budget is not None:
+            out = consolidate_costs_external(costs, rollup, budget)
+        else:
+            out = consolidate_costs_by_group(costs, rollup, ["unblended_cost"])
         print("\nSummary of costs: %s - %s\n" %(start, end))
         # print header.  hard-coded for now
         print("%s %61s" %("= Group =", "= Cost ="))
         for cost in out:
-            print("%-54s\t%14.2f %s"          \
-                  %(cost['group'],
-                  cost['values']['unblended_cost'],
+            print("%-54s\t%14s %s"          \
+                  %(group_label(cost['keys'], abbreviations),
+                  format_amount(cost['values']['unblended_cost']),
                   cost['values']['unblended_unit']))
+        if subtotals == True:
+            print("\n%s %59s" %("= Account =", "= Cost ="))
+            for account, total in account_totals.items():
+                print("%-54s\t%14s %s" %(account, format_amount(total),
+                                         first['unblended_cost']['Unit']))
+
+# passes is [(grouping, [(start, end, rows)])], one entry per sync pass.
+# groupings are only printed if there are several passes
+@stats_phase("render")
+def print_sync_results(passes, start=None, end=None, prefix=""):
+    for (grouping, synced) in passes:
+        label = prefix + ("%s: " %grouping if len(passes) > 1 else "")
+        if len(synced) == 0:
+            print("%sStore is up to date: %s - %s" %(label, start, end))
+        for (fs, fe, count) in synced:
+            print("%sSynced %s - %s: %d rows" %(label, fs, fe, count))
+
+# prints the rows of query_store().  the period column is left out of text
+# output of TOTAL queries
+@stats_phase("render")
+def print_query_results(grouping, rows, use_json=False, use_csv=False, start=None, end=None,
+                        use_jsonl=False, period="TOTAL", by=""):
+    if use_json == True or use_jsonl == True or use_csv == True:
+        rows = [collections.OrderedDict([(k, amount_value(v) if k == "amount" else v)
+                                         for (k, v) in row.items()]) for row in rows]
+    if use_json == True:
+        print_json_stream(rows)
+    elif use_jsonl == True:
+        print_jsonl_stream(rows)
+    elif use_csv == True:
+        names = ["period"] + [g['Key'] for g in parse_key_spec(by)] + ["amount", "unit"]
+        print_csv_stream(rows, names, [(n,) for n in names])
+    else:
+        print("\nSummary of costs from the store: %s - %s (%s)\n" %(start, end, grouping))
+        width = 54 if period == "TOTAL" else 43
+        print("%s%-*s %14s" %("" if period == "TOTAL" else "%-10s " %"= Period =",
+                              width, "= Group =", "= Cost ="))
+        for row in rows:
+            keys = [v for (k, v) in row.items() if k not in ["period", "amount", "unit"]]
+            print("%s%-*s\t%14s %s" %("" if period == "TOTAL" else "%-10s " %row["period"],
+                                      width, ", ".join(keys) or "Total",
+                                      format_amount(row["amount"]), row["unit"]))
+
+# result is (before sums, after sums, units) of get_compared_costs().  top
+# limits the output to the <top> largest changes, text output then sums the
+# rest into an "Other" line
+@stats_phase("render")
+def print_compare_results(result, use_json=False, use_csv=False, after=None, before=None,
+                          use_jsonl=False, groupbys=None, top=None, metric="unblended",
+                          abbreviations=None):
+    before_sums, after_sums, units = result
+    rows = compare_costs(before_sums, after_sums)
+    shown = rows[0:top] if top is not None else rows
+    if use_json == True or use_csv == True or use_jsonl == True:
+        out = []
+        for (keys, b, a, status) in shown:
+            row = collections.OrderedDict()
+            for (g, value) in zip(groupbys, keys):
+                row[g['Key']] = value
+            row["before"] = amount_value(b)
+            row["after"] = amount_value(a)
+            row["change"] = amount_value(a - b)
+            row["percent"] = round((a - b) * 100.0 / b, 2) if b != 0 else None
+            row["status"] = status
+            row["unit"] = units.get(keys, "")
+            out.append(row)
+        if use_json == True:
+            print_json_stream(out)
+        elif use_jsonl == True:
+            print_jsonl_stream(out)
+        else:
+            names = [g['Key'] for g in groupbys] + ["before", "after", "change", "percent",
+                                                   "status", "unit"]
+            print_csv_stream(out, names, [(n,) for n in names])
+        return
+
+    def line(label, b, a):
+        percent = "%+.1f%%" %((a - b) * 100.0 / b) if b != 0 else "-"
+        return "%-40s %14s %14s %14s %9s" %(label, format_amount(b), format_amount(a),
+                                            ("+" if a >= b else "") + format_amount(a - b), percent)
+
+    print("\nCost comparison (%s): %s - %s against %s - %s\n"
+          %(metric, after[0], after[1], before[0], before[1]))
+    print("%-40s %14s %14s %14s %9s" %("= Group =", "= Before =", "= After =", "= Change =",
+                                       "= % ="))
+    for (keys, b, a, status) in shown:
+        label = group_label(list(keys), abbreviations)
+        print(line(label + (" (%s)" %status if status != "" else ""), b, a))
+    if len(shown) < len(rows):
+        print(line("Other", sum([r[1] for r in rows[len(shown):]]),
+                   sum([r[2] for r in rows[len(shown):]])))
+    print(line("= Total =", sum(before_sums.values()), sum(after_sums.values())))
+    print("\n%d groups, %d new, %d vanished"
+          %(len(rows), len([r for r in rows if r[3] == "new"]),
+            len([r for r in rows if r[3] == "vanished"])))
+
+# result is (days checked, groups tracked, rows) of detect_anomalies()
+@stats_phase("render")
+def print_anomaly_results(result, use_json=False, use_csv=False, start=None, end=None,
+                          use_jsonl=False, groupbys=None, threshold=FC_ANOMALY_THRESHOLD):
+    checked, groups, rows = result
+    if use_json == True:
+        print_json_stream(rows)
+    elif use_jsonl == True:
+        print_jsonl_stream(rows)
+    elif use_csv == True:
+        names = (["day"] + [g['Key'] for g in groupbys] +
+                 ["amount", "expected", "stddev", "deviation", "estimated"])
+        print_csv_stream(rows, names, [(n,) for n in names])
+    else:
+        print("\nCost anomalies: %s - %s (%d new days, %d groups, over %.1f standard deviations)\n"
+              %(start, end, checked, groups, threshold))
+        print("%-10s %-43s %14s %14s %10s" %("= Day =", "= Group =", "= Cost =", "= Expected =",
+                                             "= Dev. ="))
+        for row in rows:
+            keys = [row[g['Key']] for g in groupbys]
+            deviation = "%+.1f" %row["deviation"] if row["deviation"] is not None else \
+                        "new" if row["expected"] == 0 else "-"
+            print("%-10s %-43s %14.2f %14.2f %10s%s" %(row["day"], ", ".join(keys), row["amount"],
+                                                      row["expected"], deviation,
+                                                      " (estimated)" if row["estimated"] else ""))
+        if len(rows) == 0:
+            print("No anomalies")
+
+# entries is [(kind, name, values)].  service names are listed with their
+# --abbreviate abbreviation
+@stats_phase("render")
+def print_catalog_results(entries, use_json=False, use_csv=False, use_jsonl=False):
+    rows = [collections.OrderedDict([("kind", kind), ("name", name), ("value", value)])
+            for (kind, name, values) in entries for value in values]
+    if use_json == True:
+        print_json_stream(rows)
+    elif use_jsonl == True:
+        print_jsonl_stream(rows)
+    elif use_csv == True:
+        names = ["kind", "name", "value"]
+        print_csv_stream(rows, names, [(n,) for n in names])
+    else:
+        for (kind, name, values) in entries:
+            label = "tag keys" if kind == "TAG" and name == "" else "%s %s" %(kind.lower(), name)
+            print("\n= %s (%d values) =" %(label, len(values)))
+            abbrv = build_abbreviations(values) if (kind, name) == ("DIMENSION", "SERVICE") else {}
+            for value in values:
+                print("    %-54s %s" %(value, abbrv.get(value, "")))
+
+def format_bytes(n):
+    if n is None:
+        return "n/a"
+    return "%.1f MB" %(n / 1048576.0)
+
+# prints the --stats report to stderr and writes it to the --stats-json file
+def print_stats(stats, opts):
+    report = stats.report()
+    if opts.stats_json is not None:
+        with open(opts.stats_json, "w") as f:
+            json.dump(report, f, indent=2)
+    if not opts.stats:
+        return
+    sys.stderr.write("\nStatistics: %.3f s wall, %.3f s cpu, peak RSS %s"
+                     %(report['wall'], report['cpu'], format_bytes(report['peak_rss'])))
+    if report['worker_peak_rss'] is not None:
+        sys.stderr.write(" (workers %s)" %format_bytes(report['worker_peak_rss']))
+    sys.stderr.write("\n\n%-44s %8s %12s %12s\n" %("= Phase =", "calls", "wall (s)", "cpu (s)"))
+    for name, phase in report['phases'].items():
+        sys.stderr.write("%-44s %8d %12.4f %12.4f\n"
+                         %(name, phase['calls'], phase['wall'], phase['cpu']))
+    sys.stderr.write("\n")
+    for name, n in report['counters'].items():
+        sys.stderr.write("%-44s %12d\n" %(name, n))
+    if "cache" in report:
+        sys.stderr.write("%-44s %12d\n" %("cache_hits", report['cache']['hits']))
+        sys.stderr.write("%-44s %12d\n" %("cache_misses", report['cache']['misses']))
+
+# parses an AWS credentials file once.  returns {profile: (access key,
+# secret key)} for every profile that has both keys, in file order
+@stats_phase("credentials")
+def load_credentials(path):
+    parser = configparser.RawConfigParser()
+    parser.read(path)
+    creds = collections.OrderedDict()
+    for profile in parser.sections():
+        if parser.has_option(profile, "aws_access_key_id") and \
+           parser.has_option(profile, "aws_secret_access_key"):
+            creds[profile] = (parser.get(profile, "aws_access_key_id"),
+                              parser.get(profile, "aws_secret_access_key"))
+    return creds
+
+# fetches the results of a command for one account.  cost and coverage
+# return row generators, recommend the recommendation response, or the
+# comparison rows if several combinations were asked for, sync the synced
+# ranges of every pass and query the (grouping, rows) of query_store()
+@stats_phase("fetch", "rows")
+def get_results(cmd, a, s, rlist, start, end, dims, tags, granularity, lookback, service, opts):
+    if cmd == "cost" and opts.from_store:
+        store = open_cost_store(opts.store)
+        return get_stored_costs(store, a, start, end, dims, tags, granularity)
+    elif cmd == "cost":
+        if opts.workers > 1:
+            return get_costs_sharded(a, s, rlist, start, end, dims, tags, granularity,
+                                     opts.workers, opts.window)
+        return get_costs(a, s, rlist, start, end, dims, tags, granularity)
+    elif cmd == "recommend":
+        combos = ri_combinations(service, opts.term, opts.payment_option, lookback)
+        if len(combos) == 1:
+            return get_reserve_instance_recs(a, s, service, lookback, opts.term, opts.payment_option)
+        workers = opts.workers if opts.workers > 1 else FC_RI_WORKERS
+        return ri_matrix_rows(get_ri_recs_matrix(a, s, combos, workers))
+    elif cmd == "coverage" and opts.series:
+        workers = opts.workers if opts.workers > 1 else FC_SERIES_WORKERS
+        return get_reservation_coverage_series(a, s, rlist, start, end, dims, tags, granularity,
+                                               workers)
+    elif cmd == "coverage":
+        if opts.workers > 1:
+            return get_reservation_coverage_sharded(a, s, rlist, start, end, dims, tags, granularity,
+                                                    opts.workers, opts.window)
+        return get_reservation_coverage(a, s, rlist, start, end, dims, tags, granularity)
+    elif cmd == "sync":
+        store = open_cost_store(opts.store)
+        passes = [groupby_options(parse_key_spec(spec)) for spec in opts.passes]
+        if len(passes) == 0:
+            passes = [(dims, tags)]
+        return [(grouping_key(build_groupbys(d, g, "SERVICE")),
+                 sync_costs(store, a, s, rlist, start, end, d, g)) for (d, g) in passes]
+    elif cmd == "compare":
+        workers = opts.workers if opts.workers > 1 else FC_COMPARE_WORKERS
+        return get_compared_costs(a, s, rlist, (start, end), opts.against, dims, tags,
+                                  opts.metric, workers)
+    elif cmd == "read":
+        archives = [open_archive(path) for path in opts.archives]
+        return read_archives(archives, start, end,
+                             archive_conditions(archives[0].groupbys, opts.filters))
+    elif cmd == "anomalies":
+        state = open_anomaly_state(opts.state)
+        return detect_anomalies(state, a, s, rlist, start, end, dims, tags, opts)
+    elif cmd == "query":
+        store = open_cost_store(opts.store)
+        return query_store(store, a, start, end, opts.by, opts.filters, opts.period,
+                           opts.metric, opts.top)
+
+# process pool initializer.  every worker process opens its own cache
+# connection, sqlite connections must not be shared across processes.  the
+# rate limiter is shared by all of them.  with stats, every worker collects
+# its own and sends them back with each result
+def init_account_worker(cache_args, limiter, stats=False, pipeline=None):
+    global RESPONSE_CACHE, RATE_LIMITER, STATS, PIPELINE_DEPTH
+    CE_SESSIONS.clear() # never share connections with the parent process
+    CE_CLIENTS.clear()
+    RATE_LIMITER = limiter
+    PIPELINE_DEPTH = pipeline
+    STATS = Stats() if stats else None
+    RESPONSE_CACHE = None
+    if cache_args is not None:
+        RESPONSE_CACHE = open_response_cache(*cache_args)
+
+# runs in a pool worker process.  job is (cmd, profile, access key, secret
+# key, <get_results() arguments>).  returns (profile, result, error, stats),
+# rows of cost and coverage results are tagged with the profile name.  errors
+# are returned as text so that one failing account does not stop the others.
+# stats is a Stats snapshot of the job, or None without stats
+def run_account(job):
+    global STATS
+    cmd, profile, a, s = job[0:4]
+    if STATS is not None:
+        STATS = Stats() # only report this job
+    try:
+        result = get_results(cmd, a, s, *job[4:])
+        if cmd in ["cost", "coverage"]:
+            rows = []
+            for row in result:
+                row["account"] = profile
+                rows.append(row)
+            result = rows
+        elif cmd == "recommend" and isinstance(result, list): # comparison rows
+            for row in result:
+                row["account"] = profile
+        elif cmd == "recommend":
+            result["account"] = profile
+        error = None
+    except Exception:
+        result, error = None, traceback.format_exc()
+    return profile, result, error, (STATS.snapshot() if STATS is not None else None)
+
+# runs a command for every (profile, (access key, secret key)) in accounts on
+# a pool of processes and yields (profile, result, error) in account order
+def get_account_results(cmd, accounts, rlist, start, end, dims, tags, granularity,
+                        lookback, service, opts, cache_args=None):
+    jobs = []
+    for (profile, (a, s)) in accounts:
+        jobs.append((cmd, profile, a, s, rlist, start, end, dims, tags, granularity,
+                     lookback, service, opts))
+    pool = multiprocessing.Pool(max(1, min(opts.processes, len(jobs))),
+                                init_account_worker, (cache_args, RATE_LIMITER, STATS is not None,
+                                                     PIPELINE_DEPTH))
+    try:
+        for (profile, result, error, stats) in pool.imap(run_account, jobs):
+            if stats is not None and STATS is not None:
+                STATS.merge(stats)
+            yield profile, result, error
+    finally:
+        pool.terminate()
+
+# prints one merged report out of get_account_results().  failed accounts are
+# reported on stderr and skipped.  returns the list of failed profiles
+@stats_phase("render")
+def print_account_results(cmd, results, use_json=False, use_csv=False, start=None, end=None,
+                          groupbys=None, opts=None):
+    failed = []
+
+    def succeeded():
+        for (profile, result, error) in results:
+            if error is not None:
+                sys.stderr.write("Error: profile %s failed:\n%s" %(profile, error))
+                failed.append(profile)
+            else:
+                yield profile, result
+
+    if cmd == "cost":
+        costs = itertools.chain.from_iterable(r for (_p, r) in succeeded())
+        print_cost_results(costs, use_json, use_csv, start, end, opts.rollup, opts.columnar,
+                           groupbys, opts.jsonl, opts.subtotals, opts.top, opts.metric,
+                           opts.memory_budget, opts.abbreviations)
+    elif cmd == "coverage":
+        covs = itertools.chain.from_iterable(r for (_p, r) in succeeded())
+        print_coverage_results(covs, use_json, use_csv, start, end, opts.jsonl, opts.subtotals,
+                               opts.series)
+    elif cmd == "recommend" and len(ri_combinations(opts.service, opts.term, opts.payment_option,
+                                                    opts.lookback)) > 1:
+        rows = list(itertools.chain.from_iterable(r for (_p, r) in succeeded()))
+        print_ri_matrix_results(rows, use_json, use_csv, opts.jsonl)
+    elif cmd == "recommend":
+        recs = (r for (_p, r) in succeeded())
+        if use_json == True:
+            print_json_stream(recs)
+        elif use_csv == True or opts.jsonl == True:
+            rows = itertools.chain.from_iterable(ri_detail_rows(r) for r in recs)
+            print_ri_detail_results(list(rows), use_csv, opts.jsonl)
+        else:
+            for rec in recs:
+                print("Account: %s\n" %rec["account"])
+                print_ri_recs_results(rec)
+                print("")
+    elif cmd == "sync":
+        for (profile, synced) in succeeded():
+            print_sync_results(synced, start, end, "%s: " %profile)
+    return failed
+
+# size-bounded LRU of serialized query results for the serve command.
+# entries expire after ttl seconds.  a request for a key that is already
+# being computed waits for that computation instead of starting its own
+class QueryCache(object):
+    def __init__(self, size=FC_SERVE_LRU_SIZE, ttl=FC_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict() # key: (time stored, value)
+        self.pending = {}                        # key: [event, value, error]
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get(self, key, compute):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None and time.time() - entry[0] < self.ttl:
+                self.entries[key] = entry # most recently used last
+                self.hits += 1
+                return entry[1]
+            call = self.pending.get(key)
+            owner = call is None
+            if owner:
+                call = self.pending[key] = [threading.Event(), None, None]
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not owner:
+            call[0].wait()
+            if call[2] is not None:
+                raise call[2]
+            return call[1]
+
+        try:
+            call[1] = compute()
+        except Exception as e:
+            call[2] = e
+            raise
+        finally:
+            with self.lock:
+                del self.pending[key]
+                if call[2] is None:
+                    self.entries[key] = (time.time(), call[1])
+                    while len(self.entries) > self.size:
+                        self.entries.popitem(last=False)
+            call[0].set()
+        return call[1]
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses,
+                    "coalesced": self.coalesced}
+
+# checks the query string parameters of a serve endpoint and fills in the
+# defaults.  returns the normalized {parameter: value}, equal queries give
+# equal results.  raises ValueError for invalid queries
+def parse_query(cmd, params):
+    query = {}
+    for name, default in FC_SERVE_PARAMS[cmd].items():
+        values = params.pop(name, None)
+        if values is not None:
+            query[name] = ",".join([v.strip() for v in values[-1].split(",") if v.strip() != ""])
+        elif default is None:
+            raise ValueError("missing parameter: %s" %name)
+        else:
+            query[name] = default
+    if len(params) > 0:
+        raise ValueError("unknown parameter: %s" %sorted(params.keys())[0])
+
+    for name in ["interval", "dimension", "lookback", "term", "payment_option"]:
+        if name in query:
+            query[name] = query[name].upper()
+    checks = [("start", None, FC_MATCH_DATE), ("end", None, FC_MATCH_DATE),
+              ("interval", FC_INTERVALS, None), ("dimension", GROUP_DIMENSIONS, None),
+              ("lookback", FC_RI_LOOKBACKS, None), ("term", FC_RI_TERMS, None),
+              ("payment_option", FC_RI_PAYMENT_OPTIONS, None), ("view", ["rows", "summary"], None),
+              ("series", ["0", "1"], None)]
+    for (name, valid, pattern) in checks:
+        if name not in query or query[name] == "":
+            continue
+        for value in query[name].split(","):
+            if (valid is not None and value not in valid) or \
+               (pattern is not None and re.match(pattern + "$", value) is None):
+                raise ValueError("invalid %s: %s" %(name, value))
+    if query.get("rollup", "") != "" and not query["rollup"].isdigit():
+        raise ValueError("invalid rollup: %s" %query["rollup"])
+    return query
+
+# runs a parsed query for one account and returns the result as JSON.  the
+# result is what the -j option prints for the same command line
+def run_query(cmd, query, a, s, rlist, opts):
+    qopts = argparse.Namespace(**vars(opts))
+    if cmd == "recommend":
+        qopts.term = query["term"]
+        qopts.payment_option = query["payment_option"]
+        result = get_results(cmd, a, s, rlist, None, None, "", "", None,
+                             query["lookback"], query["service"], qopts)
+    else:
+        qopts.series = query.get("series") == "1"
+        result = list(get_results(cmd, a, s, rlist, query["start"], query["end"],
+                                  query["dimension"], query["tag"], query["interval"],
+                                  None, None, qopts))
+        if query.get("view") == "summary":
+            rollup = int(query["rollup"]) if query["rollup"] != "" else None
+            result = consolidate_costs_by_group(result, rollup)
+            for group in result:
+                for (_metric, field) in FC_COST_METRICS:
+                    group['values'][field] = amount_value(group['values'][field])
+    return json.dumps(result, sort_keys=True).encode("utf-8")
+
+# serves GET /cost, /coverage and /recommend for one account until
+# interrupted, plus GET /stats with the counters of the query cache.  query
+# parameters are those of FC_SERVE_PARAMS, e.g.
+# /cost?start=2018-01-01&end=2018-02-01&dimension=SERVICE&interval=DAILY
+def serve(a, s, rlist, opts):
+    try:
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        from socketserver import ThreadingMixIn
+        from urllib.parse import urlparse, parse_qs
+    except ImportError: # python 2.7
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+        from SocketServer import ThreadingMixIn
+        from urlparse import urlparse, parse_qs
+
+    cache = QueryCache(opts.lru_size, opts.cache_ttl)
+
+    class ThreadingServer(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    class Handler(BaseHTTPRequestHandler):
+        def reply(self, status, body):
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def error(self, status, message):
+            self.reply(status, json.dumps({"error": message}).encode("utf-8"))
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            cmd = url.path.strip("/")
+            if cmd == "stats":
+                return self.reply(200, json.dumps(cache.stats()).encode("utf-8"))
+            if cmd not in FC_SERVE_PARAMS:
+                return self.error(404, "unknown endpoint: %s" %url.path)
+            try:
+                query = parse_query(cmd, parse_qs(url.query))
+            except ValueError as e:
+                return self.error(400, str(e))
+            key = json.dumps([cmd, query], sort_keys=True)
+            try:
+                body = cache.get(key, lambda: run_query(cmd, query, a, s, rlist, opts))
+            except IncompleteResultsError as e:
+                return self.error(502, str(e))
+            except Exception as e:
+                return self.error(500, "%s: %s" %(type(e).__name__, e))
+            self.reply(200, body)
+
+    server = ThreadingServer((opts.host, opts.port), Handler)
+    sys.stderr.write("Serving on http://%s:%d/\n" %server.server_address[0:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+# one report of a batch file, with the options of its own command line
+BatchReport = namedtuple("BatchReport", ["name", "cmd", "output", "start", "end", "use_json",
+                                         "use_csv", "dims", "tags", "granularity", "lookback",
+                                         "service", "opts"])
+
+# reads a batch file, JSON or YAML if the name ends in .yaml or .yml.  it is
+# either a list of reports or {"defaults": {...}, "reports": [...]}, the
+# defaults being merged into every report.  returns the report dicts.
+# raises ValueError if the file is not valid
+def load_batch_file(path):
+    with open(path) as f:
+        text = f.read()
+    if path.endswith((".yaml", ".yml")):
+        if load_yaml() is None:
+            raise ValueError("YAML batch files require PyYAML, use JSON instead")
+        try:
+            spec = yaml.safe_load(text)
+        except yaml.YAMLError as e:
+            raise ValueError(str(e))
+    else:
+        spec = json.loads(text)
+
+    defaults = {}
+    if isinstance(spec, dict):
+        defaults = spec.get("defaults") or {}
+        spec = spec.get("reports")
+    if not isinstance(spec, list) or len(spec) == 0 or \
+       not all([isinstance(r, dict) for r in [defaults] + spec]):
+        raise ValueError("expected a list of reports or {\"defaults\": {...}, \"reports\": [...]}")
+    reports = []
+    for report in spec:
+        merged = dict(defaults)
+        merged.update(report)
+        reports.append(merged)
+    return reports
+
+# turns a report dict of a batch file into a BatchReport.  keys are a
+# "command", an "output" file (default "-", stdout) and FC_BATCH_OPTIONS,
+# which are parsed and checked like the same options on the command line.
+# raises ValueError for invalid reports
+def parse_batch_report(n, report):
+    report = dict((k.replace("-", "_"), v) for (k, v) in report.items())
+    cmd = report.pop("command", None)
+    output = str(report.pop("output", "-"))
+    name = "%d (%s)" %(n, output) if output != "-" else str(n)
+    if cmd not in FC_BATCH_COMMANDS:
+        raise ValueError("report %s: command must be one of %s" %(name, ", ".join(FC_BATCH_COMMANDS)))
+
+    argv = []
+    for key in sorted(report.keys()):
+        value = report[key]
+        if key not in FC_BATCH_OPTIONS:
+            raise ValueError("report %s: unknown option: %s" %(name, key))
+        if value is True:
+            argv.append("--" + key.replace("_", "-"))
+        elif value is not False and value is not None:
+            if isinstance(value, list):
+                value = ",".join([str(v) for v in value])
+            argv += ["--" + key.replace("_", "-"), str(value)]
+    try:
+        _p, _a, _s, _r, t, j, c, d, g, i, l, r, opts = parse_options(argv)
+    except SystemExit: # argparse has printed why
+        raise ValueError("report %s: invalid options: %s" %(name, " ".join(argv)))
+
+    def invalid(message):
+        return ValueError("report %s: %s" %(name, message))
+
+    start = end = None
+    if cmd != "recommend":
+        timerange = t.split(",")
+        if len(timerange) != 2 or \
+           len([x for x in timerange if re.match(FC_MATCH_DATE + "$", x) is None]) > 0:
+            raise invalid("timerange must be <YYYY-MM-DD>,<YYYY-MM-DD>")
+        start, end = timerange
+    for dt in d.split(",") if d != "" else []:
+        if dt not in GROUP_DIMENSIONS:
+            raise invalid("invalid dimension: %s%s" %(dt, did_you_mean(dt, GROUP_DIMENSIONS)))
+    if i not in FC_INTERVALS:
+        raise invalid("invalid time interval: %s" %i)
+    if cmd == "recommend":
+        for (values, valid, what) in [(l, FC_RI_LOOKBACKS, "lookback period"),
+                                      (opts.term, FC_RI_TERMS, "term"),
+                                      (opts.payment_option, FC_RI_PAYMENT_OPTIONS, "payment option")]:
+            for value in values.split(","):
+                if value not in valid:
+                    raise invalid("invalid %s: %s" %(what, value))
+    if len([x for x in [j, c, opts.jsonl] if x]) > 1:
+        raise invalid("only one of json, csv and jsonl can be set")
+    if opts.rollup is not None and opts.rollup < 0:
+        raise invalid("invalid rollup depth: %d" %opts.rollup)
+    if opts.metric not in FC_QUERY_METRICS:
+        raise invalid("invalid metric: %s" %opts.metric)
+    if opts.top is not None and (opts.top < 1 or cmd != "cost" or j or c or opts.jsonl):
+        raise invalid("top must be at least 1 and is only available for the text output of cost")
+    if opts.series and cmd != "coverage":
+        raise invalid("series is only available for coverage")
+    if opts.columnar and load_numpy() is None:
+        raise invalid("columnar requires numpy")
+    if opts.memory_budget is not None:
+        if opts.memory_budget < 1 or opts.columnar:
+            raise invalid("memory budget must be at least 1 and cannot be used with columnar")
+        opts.memory_budget *= 1048576 # MB
+    return BatchReport(name, cmd, output, start, end, j, c, d, g, i, l, r, opts)
+
+# the requests a batch report needs, as keys that are equal for equal
+# requests.  time ranges are split into calendar months, so reports over
+# overlapping ranges share the months they have in common, and the grouping
+# is normalized with the default of build_groupbys().  coverage is always
+# grouped, so Cost Explorer ignores its interval and it is left out of the key
+def batch_requests(report):
+    if report.cmd == "recommend":
+        return [("recommend",) + combo for combo in
+                ri_combinations(report.service, report.opts.term, report.opts.payment_option,
+                                report.lookback)]
+    groupbys = build_groupbys(report.dims, report.tags,
+                              "SERVICE" if report.cmd == "cost" else "REGION")
+    dims = ",".join([x['Key'] for x in groupbys if x['Type'] == "DIMENSION"])
+    tags = ",".join([x['Key'] for x in groupbys if x['Type'] == "TAG"])
+    if report.cmd == "cost":
+        return [("cost", ws, we, dims, tags, report.granularity)
+                for (ws, we) in split_time_range(report.start, report.end)]
+    # series are fetched an interval at a time
+    window = "1" if report.opts.series and report.granularity == "DAILY" else "MONTH"
+    return [("coverage", ws, we, dims, tags)
+            for (ws, we) in split_time_range(report.start, report.end, window)]
+
+# fetches one batch_requests() key.  returns the list of its rows, or the
+# recommendation response
+@stats_phase("fetch")
+def fetch_batch_request(a, s, rlist, key):
+    if key[0] == "recommend":
+        service, term, payment, lookback = key[1:]
+        try:
+            return get_reserve_instance_recs(a, s, service, lookback, term, payment)
+        except Exception as e:
+            raise IncompleteResultsError("recommendations for %s are incomplete, %s: %s"
+                                         %(" ".join(key[1:]), type(e).__name__, e))
+    elif key[0] == "cost":
+        rows = list(get_costs(a, s, rlist, *key[1:]))
+    else:
+        rows = list(get_reservation_coverage(a, s, rlist, *key[1:]))
+    if STATS is not None:
+        STATS.count("rows", len(rows))
+    return rows
+
+# prints a batch report out of the results of its requests, {key: result}.
+# the output is what its command line prints on its own, except that
+# coverage over several months is merged from monthly requests as with -w
+def print_batch_report(report, keys, results, abbreviations=None):
+    opts = report.opts
+    if report.cmd == "cost":
+        costs = itertools.chain.from_iterable(results[k] for k in keys)
+        print_cost_results(costs, report.use_json, report.use_csv, report.start, report.end,
+                           opts.rollup, opts.columnar,
+                           build_groupbys(report.dims, report.tags, "SERVICE"), opts.jsonl,
+                           top=opts.top, metric=opts.metric, budget=opts.memory_budget,
+                           abbreviations=abbreviations if opts.abbreviate else None)
+    elif report.cmd == "coverage":
+        covs = itertools.chain.from_iterable(results[k] for k in keys)
+        if len(keys) > 1 and not opts.series:
+            covs = merge_coverage_shards(covs, report.start, report.end)
+        print_coverage_results(covs, report.use_json, report.use_csv, report.start, report.end,
+                               opts.jsonl, series=opts.series)
+    elif len(keys) > 1: # several combinations
+        print_ri_matrix_results(ri_matrix_rows([(k[1:], results[k]) for k in keys]),
+                                report.use_json, report.use_csv, opts.jsonl)
+    else:
+        print_ri_recs_results(results[keys[0]], report.use_json, report.use_csv,
+                              use_jsonl=opts.jsonl)
+
+# print_batch_report() into the output file of the report
+def write_batch_report(report, keys, results, abbreviations=None):
+    if report.output == "-":
+        return print_batch_report(report, keys, results, abbreviations)
+    out = open(report.output, "w")
+    stdout = sys.stdout
+    sys.stdout = out
+    try:
+        print_batch_report(report, keys, results, abbreviations)
+    finally:
+        sys.stdout = stdout
+        out.close()
+
+# runs the reports of a batch for one account.  the requests of all reports
+# are deduplicated and every unique one is fetched once, up to workers at a
+# time, in the order the reports first need them.  each report is written
+# as soon as its requests are in and results are dropped after the last
+# report using them.  a failed request fails the reports that need it, the
+# others are still written.  returns [(report name, error)] of failed reports
+def run_batch(a, s, rlist, reports, workers, abbreviations=None):
+    needs = [] # unique keys of every report
+    users = collections.OrderedDict() # key: number of reports needing it
+    for report in reports:
+        keys = []
+        for key in batch_requests(report):
+            if key not in users:
+                users[key] = 0
+            if key not in keys:
+                keys.append(key)
+                users[key] += 1
+        needs.append(keys)
+    sys.stderr.write("batch: %d reports, %d requests, %d unique\n"
+                     %(len(reports), sum([len(keys) for keys in needs]), len(users)))
+
+    results = {}
+    errors = {}
+    failed = []
+    written = [0] # reports written or failed so far, in order
+
+    def fetch(key):
+        try:
+            return key, fetch_batch_request(a, s, rlist, key), None
+        except IncompleteResultsError as e:
+            return key, None, str(e)
+        except Exception as e:
+            return key, None, "%s: %s" %(type(e).__name__, e)
+
+    def write_ready():
+        while written[0] < len(reports):
+            report, keys = reports[written[0]], needs[written[0]]
+            if len([k for k in keys if k not in results and k not in errors]) > 0:
+                return
+            error = ([errors[k] for k in keys if k in errors] + [None])[0]
+            if error is None:
+                try:
+                    write_batch_report(report, keys, results, abbreviations)
+                except (IOError, OSError) as e:
+                    error = str(e)
+            if error is not None:
+                failed.append((report.name, error))
+            for k in keys:
+                users[k] -= 1
+                if users[k] == 0:
+                    results.pop(k, None)
+            written[0] += 1
+
+    pool = ThreadPool(max(1, min(workers, len(users))))
+    try:
+        for (key, result, error) in pool.imap(fetch, list(users.keys())):
+            if error is None:
+                results[key] = result
+            else:
+                errors[key] = error
+            write_ready()
+        write_ready() # reports without requests
+    finally:
+        pool.terminate()
+    return failed
 
 # human-readable option currently not used, so hide it from usage
 def print_usage():
@@ -437,16 +3949,50 @@ def print_usage():
      print("    Command must be one of the following:\n")
      for cmd, desc in FC_COMMANDS.items():
          print("    %s - %s" %(cmd, desc))
-     print("\n    General options are:\n\n"
+     print(("\n    General options are:\n\n"
            "        -h --help - Display this help message\n"
            "        -p --profile <profile name> - AWS profile name\n"
            "                (can be used instead of -a and -s options)\n"
+           "        --profiles <profile1,profile2,...> - Run the command for\n"
+           "                several AWS profiles and merge the results.\n"
+           "        --all-profiles - Run the command for every profile in\n"
+           "                ~/.aws/credentials and merge the results.\n"
+           "        --processes <n> - Number of profiles to fetch at once\n"
+           "                (default %d).\n"
+           "        --subtotals - Add per profile subtotals to text output\n"
+           "                of --profiles and --all-profiles reports.\n"
            "        -a --accesskey <access key> - AWS access key\n"
            "        -s --secretkey <secret key> - AWS secret key\n"
            #"       -r --regions <region1,region2,...> - A list of AWS regions.  If this option is omitted, all regions will be checked.\n" # currently not in use
            "        -j --json - Output in JSON format.\n"
            "        -c --csv - Output as CSV.  Not compatible with --json\n"
-           "                (currently not available for 'recommend' command).\n")
+           "        --jsonl - Output as JSON Lines, one object per line\n"
+           "        --no-cache - Do not use the local response cache\n"
+           "                (~/.costreporter/cache.db).\n"
+           "        --refresh - Ignore cached responses and fetch fresh data.\n"
+           "        --cache-ttl <seconds> - How long estimated or still open\n"
+           "                periods are cached (default %d).\n"
+           "        --cache-stats - Print cache hits and misses to stderr.\n"
+           "        --pipeline - Fetch result pages and turn them into rows in\n"
+           "                background threads while earlier rows are being\n"
+           "                aggregated and printed.  Output is unchanged.\n"
+           "        --rate <n> - Maximum Cost Explorer requests per second,\n"
+           "                shared by all workers (default %.0f).  Lowered\n"
+           "                automatically while requests are throttled.\n"
+           "        --stats - Print timings per phase, API call counts,\n"
+           "                response sizes and peak memory to stderr.\n"
+           "        --stats-json <file> - Write the same statistics to a\n"
+           "                JSON file.\n"
+           "        --no-catalog - Do not use the local catalog of dimension\n"
+           "                values and tag keys (~/.costreporter/catalog.db).\n"
+           "                Single-profile runs check -g tag keys against it\n"
+           "                (fetching the keys again, and those of the time\n"
+           "                range if it is older, before rejecting one).  'sync'\n"
+           "                adds the values of its -d and -g keys to it.\n"
+           "        --catalog-ttl <seconds> - Age after which catalog entries\n"
+           "                are fetched again in the background (default %d).\n"
+           "                --refresh fetches them before use.\n")
+           %(FC_ACCOUNT_PROCESSES, FC_CACHE_TTL, FC_RATE_LIMIT, FC_CATALOG_TTL))
      print("    Options for 'cost' and 'coverage' commands:\n\n"
            "        -t --timerange - Time range as <start,end> time\n"
            "                in format <YYYY-MM-DD>,<YYYY-MM-DD> (required)\n"
@@ -460,41 +4006,231 @@ def print_usage():
            "        -g --tag <tag name> - Group by tag name\n"
            "                (list of names in format Tag1,Tag2,...,TagN).\n"
            "        -i --interval <interval> - Dumps stats at <interval> granularity.\n"
-           "                Valid values are MONTHLY (default) and DAILY.\n")
+           "                Valid values are MONTHLY (default) and DAILY.\n"
+           "        -w --workers <n> - Split the time range into windows and fetch\n"
+           "                up to <n> windows concurrently (default 1, no sharding).\n"
+           "        --window <window> - Shard window size, either MONTH (default)\n"
+           "                or a number of days (requires -i DAILY).\n"
+           "        --rollup <n> - Summarize text output by the first <n> of the\n"
+           "                -d and -g keys only ('cost' command only).\n"
+           "        --columnar - Load results into a compact numpy table before\n"
+           "                printing (requires numpy, 'cost' command only).\n"
+           "        --memory-budget <MB> - Sort and aggregate within about <MB>\n"
+           "                megabytes, spilling to temporary files beyond that.\n"
+           "                -j, -c and --jsonl rows are sorted by group and\n"
+           "                time ('cost' command only).\n"
+           "        --export <file> - Write the rows to <file> in a compact\n"
+           "                columnar format for the 'read' command, Parquet if\n"
+           "                pyarrow is installed, else a memory-mappable native\n"
+           "                layout ('cost' command only).\n"
+           "        --abbreviate - Abbreviate service names in the text summary\n"
+           "                (see the 'catalog' command, 'cost' command only).\n"
+           "        --top <n> - Print only the <n> largest groups of the text\n"
+           "                summary plus an 'Other' line, in memory bounded\n"
+           "                by <n> ('cost' command only).\n"
+           "        --metric <metric> - Rank --top groups by unblended (default),\n"
+           "                blended or usage.\n"
+           "        --series - Report grouped coverage for every -i interval\n"
+           "                as a group x time table.  Intervals are fetched\n"
+           "                separately, up to %d at once or -w ('coverage'\n"
+           "                command only).\n"
+           "        --from-store - Report costs from the local store filled by\n"
+           "                the 'sync' command instead of querying AWS\n"
+           "                ('cost' command only).\n" %FC_SERIES_WORKERS)
+     print("    Options for 'sync' command:\n\n"
+           "        -t --timerange - Time range to keep in the store as <start,end>\n"
+           "                (default is the last %d days).  Only days after the\n"
+           "                last sync and days still estimated by AWS are fetched.\n"
+           "                Days between a range and the stored one are fetched\n"
+           "                as well.\n"
+           "        -d --dimension, -g --tag - Grouping to sync, as for 'cost'.\n"
+           "        --store <path> - Location of the local store\n"
+           "                (default ~/.costreporter/store.db, also used by\n"
+           "                --from-store and 'query').\n"
+           "        --pass <key1,key2> - Sync one grouping of one or two keys\n"
+           "                (dimensions or tag names) instead of -d and -g.\n"
+           "                Can be given several times.\n"
+           "        --grain - Sync the passes %s, enough for\n"
+           "                'query' to answer most breakdowns locally.\n"
+           %(FC_SYNC_DAYS, " ".join(FC_GRAIN_PASSES)))
+     print("    Options for 'query' command:\n\n"
+           "        -t --timerange - Time range as <start,end> (required).\n"
+           "        --by <key1,key2> - Group by these keys, dimensions or tag\n"
+           "                names (default: one total).\n"
+           "        --filter <key=value1,value2> - Only count rows whose key\n"
+           "                has one of the values.  Can be given several times.\n"
+           "        --period <period> - Roll days up to DAY, WEEK, MONTH or\n"
+           "                TOTAL (default).\n"
+           "        --metric <metric> - unblended (default), blended or usage.\n"
+           "        --top <n> - Only report the <n> largest groups.\n"
+           "        --store <path> - Location of the local store.\n"
+           "        Queries never call AWS.  They are answered from the first\n"
+           "        synced grouping holding all --by and --filter keys.\n"
+           "        --filter values missing from the catalog are reported.\n")
+     print("    Options for 'catalog' command:\n\n"
+           "        -d --dimension, -g --tag - List the values of these\n"
+           "                dimensions and tag keys (default: all tag keys and\n"
+           "                the services with their --abbreviate abbreviations).\n"
+           "        Values are fetched for the last %d days and kept for\n"
+           "        --catalog-ttl seconds.\n" %FC_CATALOG_DAYS)
+     print("    Options for 'batch' command:\n\n"
+           "        --reports <file> - JSON file (or YAML with PyYAML) listing\n"
+           "                the reports to run, either as a list or as\n"
+           "                {\"defaults\": {...}, \"reports\": [...]}.  A report is\n"
+           "                a \"command\" (cost, coverage or recommend), an\n"
+           "                \"output\" file (default stdout) and any of the\n"
+           "                options timerange, dimension, tag, interval, json,\n"
+           "                csv, jsonl, rollup, columnar, memory_budget,\n"
+           "                abbreviate, top, metric, series, service,\n"
+           "                lookback, term and payment_option,\n"
+           "                e.g. {\"command\": \"cost\", \"timerange\":\n"
+           "                \"2018-01-01,2018-04-01\", \"dimension\": \"SERVICE\",\n"
+           "                \"csv\": true, \"output\": \"services.csv\"}.\n"
+           "        -w --workers <n> - Number of requests to fetch at once\n"
+           "                (default %d).\n"
+           "        Requests are split into calendar months and every distinct\n"
+           "        request is fetched once, however many reports need it.\n"
+           "        Coverage over several months is merged as with -w.\n"
+           %FC_BATCH_WORKERS)
+     print("    Options for 'read' command:\n\n"
+           "        --archive <file1,file2,...> - Files written by cost --export,\n"
+           "                glob patterns allowed (e.g. 'archive/*.fcc').\n"
+           "        -t --timerange - Only rows starting in <start,end> (required).\n"
+           "        --filter <key=value1,value2> - Only rows whose key has one of\n"
+           "                the values.  Can be given several times.\n"
+           "        Output options are those of 'cost'.  No AWS credentials are\n"
+           "        needed.  Row groups whose dates or group keys cannot match\n"
+           "        are skipped without being read.\n")
+     print("    Options for 'anomalies' command:\n\n"
+           "        -t --timerange - Report anomalies of the days in <start,end>\n"
+           "                (default is the last %d days).  A new state starts\n"
+           "                at start, later runs only fetch the days after the\n"
+           "                last one they saw, days already seen are not\n"
+           "                checked again.\n"
+           "        -d --dimension, -g --tag - Grouping to track, as for 'cost'.\n"
+           "        --metric <metric> - unblended (default), blended or usage.\n"
+           "        --threshold <n> - Flag costs more than <n> standard\n"
+           "                deviations from the moving average (default %.1f).\n"
+           "        --min-change <amount> - Ignore changes smaller than\n"
+           "                <amount> (default %.2f).\n"
+           "        --state <path> - Location of the moving averages\n"
+           "                (default ~/.costreporter/%s).\n"
+           "        Every group keeps an exponentially weighted moving average\n"
+           "        and variance of its daily cost.  Groups are checked once\n"
+           "        %d days have been seen.  Days still estimated by AWS are\n"
+           "        checked but only added once final.\n"
+           %(FC_ANOMALY_DAYS, FC_ANOMALY_THRESHOLD, FC_ANOMALY_MIN_CHANGE, FC_ANOMALY_FILE,
+             FC_ANOMALY_WARMUP))
+     print("    Options for 'compare' command:\n\n"
+           "        -t --timerange - Range to compare, <start,end>.\n"
+           "        --against <start,end> - Range to compare with (required).\n"
+           "        -d --dimension, -g --tag - Grouping, as for 'cost'.\n"
+           "        --metric <metric> - unblended (default), blended or usage.\n"
+           "        --top <n> - Only show the <n> largest changes.\n"
+           "        -w --workers <n> - Number of requests to fetch at once\n"
+           "                (default %d).\n"
+           "        Both ranges are split into calendar months and months\n"
+           "        they share are fetched once.  Groups only in the range\n"
+           "        compared are 'new', groups only in the other 'vanished'.\n"
+           "        Rows are ranked by the largest absolute change.\n"
+           %FC_COMPARE_WORKERS)
      print("    Options for 'recommend' command:\n\n"
            "        -l --lookback <lookback> - Lookback period for recommendations.\n"
            "                Valid values are SEVEN_DAYS, THIRTY_DAYS,\n"
            "                SIXTY_DAYS (default)\n"
            "        -r --service <service> - Service for recommendations.\n"
-           "                Valid values are EC2 (default) and RDS\n")
+           "                Valid values are EC2 (default) and RDS\n"
+           "        --term <term> - Reservation term, ONE_YEAR (default)\n"
+           "                or THREE_YEARS.\n"
+           "        --payment-option <option> - NO_UPFRONT, PARTIAL_UPFRONT\n"
+           "                (default) or ALL_UPFRONT.\n"
+           "        All four options take comma separated lists.  With more\n"
+           "        than one value, every combination is fetched (up to %d at\n"
+           "        once, or -w) and compared in a single table.\n" %FC_RI_WORKERS)
+     print("    Options for 'serve' command:\n\n"
+           "        --host <host> - Address to listen on (default %s).\n"
+           "        --port <port> - Port to listen on (default %d).\n"
+           "        --lru-size <n> - Number of query results kept in memory\n"
+           "                (default %d).  Results expire after --cache-ttl.\n"
+           "        Endpoints are GET /cost, /coverage and /recommend, taking\n"
+           "        start, end, dimension, tag and interval, plus view=summary\n"
+           "        and rollup for /cost and series=1 for /coverage, or service,\n"
+           "        lookback, term and payment_option for /recommend.  They\n"
+           "        return what -j prints.  GET /stats returns cache counters.\n"
+           %(FC_SERVE_HOST, FC_SERVE_PORT, FC_SERVE_LRU_SIZE))
            #"    -b --abbrv - Output service abbreviations.\n\n"
-     print("    One of the following three parameters are required:\n"
+     print("    One of the following parameters are required:\n"
            "        1. Both the -a and -s options.\n"
            "        2. The -p option.\n"
-           "        3. A valid " + FC_AWS_ENV + " environment variable.")
+           "        3. The --profiles or --all-profiles option.\n"
+           "        4. A valid " + FC_AWS_ENV + " environment variable.")
 
 def parse_options(argv):
     parser = argparse.ArgumentParser(prog="costreporter.py",
                      add_help=False) # use print_usage() instead
 
     parser.add_argument("-p", "--profile", type=str, required=False)
+    parser.add_argument("--profiles", type=str, default="")
+    parser.add_argument("--all-profiles", action="store_true", default=False)
+    parser.add_argument("--processes", type=int, default=FC_ACCOUNT_PROCESSES)
+    parser.add_argument("--subtotals", action="store_true", default=False)
+    parser.add_argument("--rate", type=float, default=FC_RATE_LIMIT)
     parser.add_argument("-a", "--access-key", type=str, required=False)
     parser.add_argument("-s", "--secret-key", type=str, required=False)
     parser.add_argument("-z", "--regions", type=str, default="") #dummy
     parser.add_argument("-t", "--timerange", type=str, default="dummy,dummy")
     parser.add_argument("-j", "--json", action="store_true", default=False)
     parser.add_argument("-c", "--csv", action="store_true", default=False)
+    parser.add_argument("--jsonl", action="store_true", default=False)
     parser.add_argument("-d", "--dimension", type=str, default="")
     parser.add_argument("-g", "--tag", type=str, default="")
     parser.add_argument("-i", "--interval", type=str, default="MONTHLY")
     parser.add_argument("-l", "--lookback", type=str, default="SIXTY_DAYS")
     parser.add_argument("-r", "--service", type=str, default="EC2")
+    parser.add_argument("--term", type=str, default="ONE_YEAR")
+    parser.add_argument("--payment-option", type=str, default="PARTIAL_UPFRONT")
+    parser.add_argument("-w", "--workers", type=int, default=1)
+    parser.add_argument("--window", type=str, default=FC_SHARD_WINDOW)
+    parser.add_argument("--no-cache", action="store_true", default=False)
+    parser.add_argument("--refresh", action="store_true", default=False)
+    parser.add_argument("--cache-ttl", type=int, default=FC_CACHE_TTL)
+    parser.add_argument("--cache-stats", action="store_true", default=False)
+    parser.add_argument("--stats", action="store_true", default=False)
+    parser.add_argument("--pipeline", action="store_true", default=False)
+    parser.add_argument("--stats-json", type=str, default=None)
+    parser.add_argument("--store", type=str, default=os.path.join(FC_CACHE_DIR, FC_STORE_FILE))
+    parser.add_argument("--from-store", action="store_true", default=False)
+    parser.add_argument("--pass", dest="passes", action="append", default=[])
+    parser.add_argument("--grain", action="store_true", default=False)
+    parser.add_argument("--by", type=str, default="")
+    parser.add_argument("--filter", dest="filter_specs", action="append", default=[])
+    parser.add_argument("--period", type=str, default="TOTAL")
+    parser.add_argument("--metric", type=str, default="unblended")
+    parser.add_argument("--top", type=int, default=None)
+    parser.add_argument("--rollup", type=int, default=None)
+    parser.add_argument("--columnar", action="store_true", default=False)
+    parser.add_argument("--memory-budget", type=int, default=None)
+    parser.add_argument("--no-catalog", action="store_true", default=False)
+    parser.add_argument("--catalog-ttl", type=int, default=FC_CATALOG_TTL)
+    parser.add_argument("--abbreviate", action="store_true", default=False)
+    parser.add_argument("--series", action="store_true", default=False)
+    parser.add_argument("--host", type=str, default=FC_SERVE_HOST)
+    parser.add_argument("--port", type=int, default=FC_SERVE_PORT)
+    parser.add_argument("--lru-size", type=int, default=FC_SERVE_LRU_SIZE)
+    parser.add_argument("--reports", type=str, default=None)
+    parser.add_argument("--threshold", type=float, default=FC_ANOMALY_THRESHOLD)
+    parser.add_argument("--min-change", type=float, default=FC_ANOMALY_MIN_CHANGE)
+    parser.add_argument("--state", type=str, default=os.path.join(FC_CACHE_DIR, FC_ANOMALY_FILE))
+    parser.add_argument("--export", type=str, default=None)
+    parser.add_argument("--archive", type=str, default="")
+    parser.add_argument("--against", type=str, default=None)
 
+    # newer options are read straight from the returned namespace
     args = parser.parse_args(argv)
     if (len(args.regions) == 0):
-        return args.profile, args.access_key, args.secret_key, [], args.timerange, args.json, args.csv, args.dimension, args.tag, args.interval, args.lookback, args.service
+        return args.profile, args.access_key, args.secret_key, [], args.timerange, args.json, args.csv, args.dimension, args.tag, args.interval, args.lookback, args.service, args
     else:
-        return args.profile, args.access_key, args.secret_key, args.regions.split(','), args.timerange, args.json, args.csv, args.dimension, args.tag, args.interval, args.lookback, args.service
+        return args.profile, args.access_key, args.secret_key, args.regions.split(','), args.timerange, args.json, args.csv, args.dimension, args.tag, args.interval, args.lookback, args.service, args
 
 
 def parse_args(argv):
@@ -507,21 +4243,30 @@ def parse_args(argv):
 
     cmd = argv[1]
 
-    p, a, s, rList, t, j, c, d, g, i, l, r = parse_options(argv[2:])
+    p, a, s, rList, t, j, c, d, g, i, l, r, opts = parse_options(argv[2:])
 
-    return cmd, p, a, s, rList, t, j, c, d, g, i, l, r
+    return cmd, p, a, s, rList, t, j, c, d, g, i, l, r, opts
 
 
 if __name__ == "__main__":
-    cmd, p, a, s, rList, t, j, c, d, g, i, l, r = parse_args(sys.argv)
+    cmd, p, a, s, rList, t, j, c, d, g, i, l, r, opts = parse_args(sys.argv)
 
     if cmd not in FC_COMMANDS.keys():
         print_usage()
         print("\nError: invalid command %s" %cmd)
         os._exit(1)
 
-    # need either -a and -s, -p, or AWS_DEFAULT_PROFILE environment variable
-    if not a and not s and not p:
+    if opts.stats or opts.stats_json is not None:
+        STATS = Stats()
+
+    if opts.pipeline:
+        PIPELINE_DEPTH = FC_PIPELINE_DEPTH
+
+    multi_account = opts.profiles != "" or opts.all_profiles
+
+    # need either -a and -s, -p, --profiles, --all-profiles or
+    # AWS_DEFAULT_PROFILE environment variable.  read only reads local files
+    if not a and not s and not p and not multi_account and cmd != "read":
         if (FC_AWS_ENV in os.environ):
             p = os.environ[FC_AWS_ENV]
         else:
@@ -539,29 +4284,37 @@ if __name__ == "__main__":
         print("\nError: must provide access key using -a option")
         os._exit(1)
 
-    if p:
+    # list of (profile, (access key, secret key)) for multi-account reports
+    accounts = None
+
+    if p or multi_account:
         try:
             home = os.environ["HOME"]
-            pFile = open(home + "/.aws/credentials", "r")
-            line = pFile.readline()
-            p = "["+p+"]"
-            while p not in line:
-                line = pFile.readline()
-                if (line == ""): # end of file
+            creds = load_credentials(home + "/.aws/credentials")
+        except:
+            print("Error: reading credentials file.")
+            os._exit(1)
+
+        if p:
+            if p not in creds:
+                print_usage()
+                print("\nError: invalid profile: [%s]" %p)
+                os._exit(1)
+            a, s = creds[p]
+
+        if opts.all_profiles:
+            accounts = list(creds.items())
+        elif multi_account:
+            accounts = []
+            for profile in opts.profiles.split(","):
+                if profile not in creds:
                     print_usage()
-                    print("\nError: invalid profile: %s" %p)
+                    print("\nError: invalid profile: [%s]" %profile)
                     os._exit(1)
+                accounts.append((profile, creds[profile]))
 
-            # get access/secret keys
-            for _dummy in range(0, 2):
-                line = pFile.readline()
-                if "aws_secret_access_key" in line:
-                    s = line.strip().split(" ")[2]
-                elif "aws_access_key_id" in line:
-                    a = line.strip().split(" ")[2]
-
-        except:
-            print("Error: reading credentials for profile %s." %p)
+        if accounts is not None and len(accounts) == 0:
+            print("Error: no profiles with credentials found")
             os._exit(1)
 
     #if (len(rList) == 0):
@@ -574,18 +4327,29 @@ if __name__ == "__main__":
         print("Error: cannot specify both -j and -c")
         os._exit(1)
 
-    time = t.split(",")
+    if opts.jsonl and (j == True or c == True):
+        print("Error: cannot specify --jsonl with -j or -c")
+        os._exit(1)
+
+    # sync keeps a rolling window by default, anomalies reads up to today
+    if cmd in ["sync", "anomalies"] and t == "dummy,dummy":
+        today = datetime.datetime.utcnow().date()
+        days = FC_SYNC_DAYS if cmd == "sync" else FC_ANOMALY_DAYS
+        t = "%s,%s" %((today - datetime.timedelta(days=days)).strftime(FC_DATE_FORMAT),
+                      today.strftime(FC_DATE_FORMAT))
+
+    timerange = t.split(",")
 
     # simple sanity check #1
-    if len(time) != 2 and cmd != "recommend":
+    if len(timerange) != 2 and cmd not in ["recommend", "serve", "catalog", "batch"]:
         print("Error: proper timerange format for <start,end> times is <YYYY-MM-DD>,<YYYY-MM-DD>")
         os._exit(1)
 
-    start_time = time[0]
-    end_time = time[1]
+    start_time = timerange[0]
+    end_time = timerange[1]
 
     # simple sanity check #2
-    if cmd != "recommend" and                          \
+    if cmd not in ["recommend", "serve", "catalog", "batch"] and \
        (re.match(FC_MATCH_DATE, start_time) == None or \
        re.match(FC_MATCH_DATE, end_time) == None):
         print("start_time = %s, match = %s" %(start_time, re.match(FC_MATCH_DATE, start_time)))
@@ -598,28 +4362,330 @@ if __name__ == "__main__":
         dtmp = d.split(",")
         for dt in dtmp:
             if dt not in GROUP_DIMENSIONS:
-                print("Error: invalid dimension: %s" %str(dt))
+                print("Error: invalid dimension: %s%s" %(str(dt), did_you_mean(dt, GROUP_DIMENSIONS)))
                 os._exit(1)
 
     if i not in FC_INTERVALS:
         print("Error: invalid time interval: %s" %str(i))
         os._exit(1)
 
+    if opts.workers < 1:
+        print("Error: invalid number of workers: %d" %opts.workers)
+        os._exit(1)
+
+    if cmd == "recommend":
+        for (values, valid, name) in [(l, FC_RI_LOOKBACKS, "lookback period"),
+                                      (opts.term, FC_RI_TERMS, "term"),
+                                      (opts.payment_option, FC_RI_PAYMENT_OPTIONS, "payment option")]:
+            for value in values.split(","):
+                if value not in valid:
+                    print("Error: invalid %s: %s" %(name, value))
+                    os._exit(1)
+
+    if opts.window != "MONTH" and (not opts.window.isdigit() or int(opts.window) < 1):
+        print("Error: invalid shard window: %s" %opts.window)
+        os._exit(1)
+
+    # day windows would split MONTHLY buckets across requests
+    if opts.window != "MONTH" and i == "MONTHLY":
+        print("Error: day shard windows require -i DAILY")
+        os._exit(1)
+
+    if opts.rollup is not None and opts.rollup < 0:
+        print("Error: invalid rollup depth: %d" %opts.rollup)
+        os._exit(1)
+
+    if opts.columnar and load_numpy() is None:
+        print("Error: --columnar requires numpy")
+        os._exit(1)
+
+    if opts.cache_ttl < 0:
+        print("Error: invalid cache TTL: %d" %opts.cache_ttl)
+        os._exit(1)
+
+    if opts.rate <= 0:
+        print("Error: invalid request rate: %s" %opts.rate)
+        os._exit(1)
+
+    if opts.processes < 1:
+        print("Error: invalid number of processes: %d" %opts.processes)
+        os._exit(1)
+
+    if opts.grain:
+        opts.passes = FC_GRAIN_PASSES + opts.passes
+
+    for spec in opts.passes:
+        if len(parse_key_spec(spec)) not in [1, 2]:
+            print("Error: a sync pass needs one or two grouping keys: %s" %spec)
+            os._exit(1)
+
+    # --filter KEY=value1,value2 options as {key: [values]}
+    opts.filters = collections.OrderedDict()
+    for spec in opts.filter_specs:
+        key, sep, values = spec.partition("=")
+        if sep == "" or key.strip() == "" or values.strip() == "":
+            print("Error: filters must look like KEY=value1,value2: %s" %spec)
+            os._exit(1)
+        opts.filters.setdefault(key.strip(), []).extend([v.strip() for v in values.split(",")])
+
+    opts.period = opts.period.upper()
+    if opts.period not in FC_QUERY_PERIODS:
+        print("Error: invalid period: %s" %opts.period)
+        os._exit(1)
+
+    if opts.metric not in FC_QUERY_METRICS:
+        print("Error: invalid metric: %s" %opts.metric)
+        os._exit(1)
+
+    if opts.top is not None and opts.top < 1:
+        print("Error: invalid top: %d" %opts.top)
+        os._exit(1)
+
+    if cmd in ["cost", "read", "compare"] and opts.top is not None and (j or c or opts.jsonl):
+        print("Error: --top is only available for the text output of 'cost', 'read' and 'compare'")
+        os._exit(1)
+
+    if cmd == "query" and multi_account:
+        print("Error: query cannot be used with --profiles or --all-profiles")
+        os._exit(1)
+
+    if opts.series and cmd != "coverage":
+        print("Error: --series is only available for the 'coverage' command")
+        os._exit(1)
+
+    if cmd == "serve" and multi_account:
+        print("Error: serve cannot be used with --profiles or --all-profiles")
+        os._exit(1)
+
+    if cmd == "catalog" and (multi_account or opts.no_catalog):
+        print("Error: catalog cannot be used with --profiles, --all-profiles or --no-catalog")
+        os._exit(1)
+
+    if opts.catalog_ttl < 0:
+        print("Error: invalid catalog TTL: %d" %opts.catalog_ttl)
+        os._exit(1)
+
+    if cmd in ["batch", "anomalies", "compare"] and multi_account:
+        print("Error: %s cannot be used with --profiles or --all-profiles" %cmd)
+        os._exit(1)
+
+    if opts.threshold <= 0 or opts.min_change < 0:
+        print("Error: invalid anomaly threshold or minimum change: %s, %s"
+              %(opts.threshold, opts.min_change))
+        os._exit(1)
+
+    # reports of the batch file as BatchReports
+    opts.batch = []
+    if cmd == "batch":
+        if opts.reports is None:
+            print("Error: batch requires --reports <file>")
+            os._exit(1)
+        try:
+            opts.batch = [parse_batch_report(n + 1, report)
+                          for (n, report) in enumerate(load_batch_file(opts.reports))]
+        except (IOError, ValueError) as e:
+            print("Error: %s: %s" %(opts.reports, str(e)))
+            os._exit(1)
+
+    if opts.export is not None and (cmd != "cost" or multi_account or j or c or opts.jsonl or
+                                    opts.top is not None or opts.columnar):
+        print("Error: --export is only available for single-profile 'cost' reports,\n"
+              "       without -j, -c, --jsonl, --top or --columnar")
+        os._exit(1)
+
+    # compare needs a second time range
+    if cmd == "compare":
+        against = (opts.against or "").split(",")
+        if len(against) != 2 or \
+           len([x for x in against if re.match(FC_MATCH_DATE + "$", x) is None]) > 0:
+            print("Error: compare needs --against <YYYY-MM-DD>,<YYYY-MM-DD>")
+            os._exit(1)
+        opts.against = tuple(against)
+
+    # files of --archive, glob patterns expanded
+    opts.archives = []
+    if cmd == "read":
+        for pattern in [x for x in opts.archive.split(",") if x != ""]:
+            opts.archives.extend(sorted(glob.glob(pattern)) or [pattern])
+        if len(opts.archives) == 0 or multi_account:
+            print("Error: read needs --archive <file1,file2,...> and no --profiles or --all-profiles")
+            os._exit(1)
+        try:
+            groupings = set([grouping_key(open_archive(path).groupbys) for path in opts.archives])
+            if len(groupings) > 1:
+                raise ValueError("the archives have different groupings: %s"
+                                 %" ".join(sorted(groupings)))
+            archive_conditions(open_archive(opts.archives[0]).groupbys, opts.filters)
+        except (IOError, ValueError) as e:
+            print("Error: %s" %str(e))
+            os._exit(1)
+
+    if opts.lru_size < 1:
+        print("Error: invalid LRU size: %d" %opts.lru_size)
+        os._exit(1)
+
+    if opts.columnar and multi_account:
+        print("Error: --columnar cannot be used with --profiles or --all-profiles")
+        os._exit(1)
+
+    if opts.memory_budget is not None:
+        if opts.memory_budget < 1:
+            print("Error: invalid memory budget: %d" %opts.memory_budget)
+            os._exit(1)
+        if opts.columnar:
+            print("Error: --memory-budget cannot be used with --columnar")
+            os._exit(1)
+        opts.memory_budget *= 1048576 # MB
+
+    RATE_LIMITER = RateLimiter(opts.rate)
+
+    cache_args = None
+    if not opts.no_cache:
+        cache_args = (FC_CACHE_DIR, opts.cache_ttl, opts.refresh)
+
+    # worker processes of multi-account reports open their own cache
+    if cache_args is not None and accounts is None:
+        RESPONSE_CACHE = open_response_cache(*cache_args)
+
+    # single-account runs check -g against the tag keys in the catalog.  sync
+    # runs fetch the values of their -d and -g keys into it in the
+    # background, query --filter and --from-store check against them.  the
+    # local commands only read it
+    CATALOG = None
+    if accounts is None and not opts.no_catalog and cmd not in ["recommend", "serve", "read"]:
+        CATALOG = open_catalog(FC_CACHE_DIR, opts.catalog_ttl, opts.refresh)
+    if CATALOG is not None and (cmd == "query" or opts.from_store):
+        for key, values in opts.filters.items():
+            groupby = parse_key_spec(key)[0]
+            known, _fetched = CATALOG.lookup(a, groupby['Type'], groupby['Key'])
+            for value in values:
+                if known is not None and value not in known:
+                    sys.stderr.write("Warning: %s is not a known value of %s%s\n"
+                                     %(value, key, did_you_mean(value, known)))
+    elif CATALOG is not None and cmd in ["cost", "coverage", "sync", "batch", "anomalies",
+                                                     "compare"]:
+        groupings = [(d, g)]
+        first, last = start_time, end_time
+        if cmd == "batch":
+            groupings = [(report.dims, report.tags) for report in opts.batch]
+            ranged = [report for report in opts.batch if report.start is not None]
+            if len(ranged) > 0:
+                first = min([report.start for report in ranged])
+                last = max([report.end for report in ranged])
+        tags = ",".join([tg for (_d, tg) in groupings if tg != ""])
+        for (tag, hint) in unknown_tag_keys(a, s, tags, first, last) if tags != "" else []:
+            print("Error: unknown tag key: %s%s" %(tag, hint))
+            os._exit(1)
+        if cmd == "sync":
+            passes = [groupby_options(parse_key_spec(spec)) for spec in opts.passes] or [(d, g)]
+            CATALOG.prefetch(a, s, catalog_entries(",".join([dm for (dm, _g) in passes if dm != ""]),
+                                                   ",".join([tg for (_d, tg) in passes if tg != ""])))
+
+    opts.abbreviations = None
+    if opts.abbreviate or len([x for x in opts.batch if x.opts.abbreviate]) > 0:
+        services = None
+        if CATALOG is not None:
+            services = CATALOG.values(a, s, "DIMENSION", "SERVICE")
+        opts.abbreviations = build_abbreviations(services or list(ABBRV.keys()))
+
     # finally, let's get some cost data!
     try:
-        # comment out customer service abbreviations for now
-        #abbrv = build_abbreviations(a, s, rList[0], start_time, end_time)
-        #ABBRV.update(abbrv)
-
-        if cmd == "cost":
-            costs = get_costs(a, s, rList, start_time, end_time, d, g, i)
-            print_cost_results(costs, j, c, start_time, end_time)
+        if accounts is not None:
+            results = get_account_results(cmd, accounts, rList, start_time, end_time, d, g, i,
+                                          l, r, opts, cache_args)
+            failed = print_account_results(cmd, results, j, c, start_time, end_time,
+                                           build_groupbys(d, g, "SERVICE"), opts)
+            if len(failed) > 0:
+                sys.stdout.flush()
+                if STATS is not None:
+                    print_stats(STATS, opts)
+                sys.stderr.write("Error: failed profiles: %s\n" %",".join(failed))
+                os._exit(1)
+        elif cmd == "cost" and opts.export is not None:
+            costs = get_results(cmd, a, s, rList, start_time, end_time, d, g, i, l, r, opts)
+            kind, rows, row_groups, size = export_costs(costs, opts.export,
+                                                        build_groupbys(d, g, "SERVICE"))
+            print("Exported %d rows in %d row groups to %s (%s, %s)"
+                  %(rows, row_groups, opts.export, kind, format_bytes(size)))
+        elif cmd == "read":
+            costs = get_results(cmd, a, s, rList, start_time, end_time, d, g, i, l, r, opts)
+            print_cost_results(costs, j, c, start_time, end_time, opts.rollup, opts.columnar,
+                               open_archive(opts.archives[0]).groupbys, opts.jsonl, top=opts.top,
+                               metric=opts.metric, budget=opts.memory_budget,
+                               abbreviations=opts.abbreviations)
+        elif cmd == "cost":
+            costs = get_results(cmd, a, s, rList, start_time, end_time, d, g, i, l, r, opts)
+            print_cost_results(costs, j, c, start_time, end_time, opts.rollup, opts.columnar,
+                               build_groupbys(d, g, "SERVICE"), opts.jsonl, top=opts.top,
+                               metric=opts.metric, budget=opts.memory_budget,
+                               abbreviations=opts.abbreviations)
         elif cmd == "recommend":
-            recs = get_reserve_instance_recs(a, s, r, l)
-            print_ri_recs_results(recs)
+            recs = get_results(cmd, a, s, rList, start_time, end_time, d, g, i, l, r, opts)
+            if isinstance(recs, list): # several combinations
+                print_ri_matrix_results(recs, j, c, opts.jsonl)
+            else:
+                print_ri_recs_results(recs, j, c, use_jsonl=opts.jsonl)
         elif cmd == "coverage":
-            covs = get_reservation_coverage(a, s, rList, start_time, end_time, d, g, i)
-            print_coverage_results(covs, j, c, start_time, end_time)
+            covs = get_results(cmd, a, s, rList, start_time, end_time, d, g, i, l, r, opts)
+            print_coverage_results(covs, j, c, start_time, end_time, opts.jsonl,
+                                   series=opts.series)
+        elif cmd == "sync":
+            synced = get_results(cmd, a, s, rList, start_time, end_time, d, g, i, l, r, opts)
+            print_sync_results(synced, start_time, end_time)
+        elif cmd == "compare":
+            result = get_results(cmd, a, s, rList, start_time, end_time, d, g, i, l, r, opts)
+            print_compare_results(result, j, c, (start_time, end_time), opts.against, opts.jsonl,
+                                  build_groupbys(d, g, "SERVICE"), opts.top, opts.metric,
+                                  opts.abbreviations)
+        elif cmd == "anomalies":
+            result = get_results(cmd, a, s, rList, start_time, end_time, d, g, i, l, r, opts)
+            print_anomaly_results(result, j, c, start_time, end_time, opts.jsonl,
+                                  build_groupbys(d, g, "SERVICE"), opts.threshold)
+        elif cmd == "serve":
+            serve(a, s, rList, opts)
+        elif cmd == "query":
+            try:
+                grouping, rows = get_results(cmd, a, s, rList, start_time, end_time, d, g, i, l, r,
+                                             opts)
+            except ValueError as e:
+                print("Error: %s" %str(e))
+                os._exit(1)
+            print_query_results(grouping, rows, j, c, start_time, end_time, opts.jsonl,
+                                opts.period, opts.by)
+        elif cmd == "catalog":
+            if CATALOG is None:
+                os._exit(1)
+            entries = catalog_entries(d, g) or [("TAG", ""), ("DIMENSION", "SERVICE")]
+            print_catalog_results([(kind, name, CATALOG.values(a, s, kind, name) or [])
+                                   for (kind, name) in entries], j, c, opts.jsonl)
+
+        elif cmd == "batch":
+            workers = opts.workers if opts.workers > 1 else FC_BATCH_WORKERS
+            failed = run_batch(a, s, rList, opts.batch, workers, opts.abbreviations)
+            if len(failed) > 0:
+                sys.stdout.flush()
+                if STATS is not None:
+                    print_stats(STATS, opts)
+                for (name, error) in failed:
+                    sys.stderr.write("Error: report %s failed: %s\n" %(name, error))
+                os._exit(1)
+
+        if CATALOG is not None:
+            CATALOG.wait()
+
+        if opts.cache_stats and RESPONSE_CACHE is not None:
+            sys.stderr.write("cache: %d hits, %d misses\n"
+                             %(RESPONSE_CACHE.hits, RESPONSE_CACHE.misses))
+        if STATS is not None:
+            sys.stdout.flush()
+            print_stats(STATS, opts)
+    except IncompleteResultsError as e:
+        # anything printed so far is partial
+        sys.stdout.flush()
+        sys.stderr.write("Error: %s\n" %str(e))
+        if STATS is not None:
+            print_stats(STATS, opts)
+        os._exit(1)
     except:
         e = sys.exc_info()
         traceback.print_exc()
@@ -0,0 +1,303 @@
+#----------------------------------------------------------------------------
+# Copyright 2018, FittedCloud, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+#----------------------------------------------------------------------------
+
+# local stand-in for the Cost Explorer client, for benchmarks and offline
+# runs.  costreporter.py uses it instead of boto3 when the
+# COSTREPORTER_FAKE_CE environment variable is set to a spec such as
+#
+#     groups=500,tags=4,page=1000,throttle=0.01,latency=0.05,seed=1
+#
+# groups  - number of values of the first GroupBy key
+# tags    - number of values of every further GroupBy key, so a day has
+#           groups x tags^(keys - 1) rows
+# page    - rows per response page (Cost Explorer pages are much smaller
+#           for real, but the number of pages is what matters)
+# throttle - probability that a call fails with a ThrottlingException
+# latency - seconds every call sleeps before answering
+# seed    - changes all generated amounts
+#
+# all payloads are generated deterministically from the request, so the
+# same request always returns the same data, and summing DAILY results
+# gives the same totals no matter how the time range was split up.  pages
+# are computed straight from their offset, so paging through millions of
+# rows is linear.
+
+import datetime
+import random
+import threading
+import time
+import zlib
+
+FAKE_DATE_FORMAT = "%Y-%m-%d"
+
+# defaults for keys missing from a spec
+FAKE_DEFAULTS = {"groups": 20, "tags": 3, "page": 1000, "throttle": 0.0,
+                 "latency": 0.0, "seed": 0}
+
+# a few recognizable group names, the rest are numbered
+FAKE_SERVICES = ["Amazon Elastic Compute Cloud - Compute",
+                 "Amazon Simple Storage Service",
+                 "Amazon Relational Database Service",
+                 "Amazon DynamoDB",
+                 "AWS Data Transfer"]
+
+# looks like botocore's ClientError, which is all costreporter relies on
+class FakeClientError(Exception):
+    def __init__(self, code, operation):
+        Exception.__init__(self, "An error occurred (%s) when calling the %s operation"
+                           %(code, operation))
+        self.response = {"Error": {"Code": code, "Message": code},
+                         "ResponseMetadata": {"HTTPStatusCode": 400}}
+
+def parse_date(date):
+    return datetime.datetime.strptime(date, FAKE_DATE_FORMAT).date()
+
+# splits [start, end) into DAILY or MONTHLY buckets like Cost Explorer
+def buckets(time_period, granularity):
+    start = parse_date(time_period["Start"])
+    end = parse_date(time_period["End"])
+    if granularity is None: # grouped coverage, one bucket for everything
+        return [(start, end)]
+    out = []
+    while start < end:
+        if granularity == "DAILY":
+            n = start + datetime.timedelta(days=1)
+        else:
+            n = (start.replace(day=1) + datetime.timedelta(days=32)).replace(day=1)
+        n = min(n, end)
+        out.append((start, n))
+        start = n
+    return out
+
+def group_name(key, n):
+    if key == "SERVICE" and n < len(FAKE_SERVICES):
+        return FAKE_SERVICES[n]
+    return "%s-%d" %(key, n)
+
+class FakeCostExplorer(object):
+    def __init__(self, groups=20, tags=3, page=1000, throttle=0.0, latency=0.0, seed=0):
+        self.groups = groups
+        self.tags = tags
+        self.page = page
+        self.throttle = throttle
+        self.latency = latency
+        self.seed = seed
+        self.calls = 0
+        self.lock = threading.Lock()
+        self.random = random.Random(seed)
+
+    # latency, throttling and call counting shared by all operations
+    def _call(self, operation):
+        with self.lock:
+            self.calls += 1
+            throttled = self.throttle > 0 and self.random.random() < self.throttle
+        if self.latency > 0:
+            time.sleep(self.latency)
+        if throttled:
+            raise FakeClientError("ThrottlingException", operation)
+
+    # deterministic amount in [0, scale) for a group over [start, end).  DAILY
+    # amounts of a group add up to its amount for a longer bucket
+    def _amount(self, combo, start, end, scale):
+        total = 0.0
+        day = start
+        while day < end:
+            h = zlib.crc32(("%d:%s:%s" %(self.seed, combo, day.toordinal())).encode("utf-8"))
+            total += (h & 0xffff) * scale / 65536.0
+            day += datetime.timedelta(days=1)
+        return total
+
+    # number of group combinations per bucket and the keys of combination i
+    def _combos(self, group_by):
+        count = self.groups * (self.tags ** max(0, len(group_by) - 1))
+        return count
+
+    def _keys(self, group_by, i):
+        keys = []
+        rest = i
+        for n, g in enumerate(group_by):
+            size = self.groups if n == 0 else self.tags
+            value = rest % size
+            rest //= size
+            if g["Type"] == "TAG":
+                keys.append("%s$%s-%d" %(g["Key"], g["Key"], value))
+            else:
+                keys.append(group_name(g["Key"], value))
+        return keys
+
+    # slices rows [offset, offset + page) out of buckets x combos and calls
+    # make(bucket, combo index) for each.  returns (list of (bucket, items),
+    # next token or None)
+    def _page(self, periods, combos, token, make):
+        offset = int(token or 0)
+        stop = min(offset + self.page, len(periods) * combos)
+        out = []
+        for i in range(offset, stop):
+            bucket = periods[i // combos]
+            if not out or out[-1][0] != bucket:
+                out.append((bucket, []))
+            out[-1][1].append(make(bucket, i % combos))
+        return out, (str(stop) if stop < len(periods) * combos else None)
+
+    def get_cost_and_usage(self, TimePeriod, Granularity, Metrics, GroupBy=None,
+                           NextPageToken=None, **kwargs):
+        self._call("GetCostAndUsage")
+        group_by = GroupBy or []
+        today = datetime.datetime.utcnow().date()
+
+        def make(bucket, combo):
+            keys = self._keys(group_by, combo)
+            name = "|".join(keys)
+            unblended = self._amount(name, bucket[0], bucket[1], 100.0)
+            metrics = {"BlendedCost": {"Amount": "%.10f" %(unblended * 1.02), "Unit": "USD"},
+                       "UnblendedCost": {"Amount": "%.10f" %unblended, "Unit": "USD"},
+                       "UsageQuantity": {"Amount": "%.10f" %self._amount(name, bucket[0], bucket[1], 24.0),
+                                         "Unit": "Hrs"}}
+            return {"Keys": keys, "Metrics": dict((m, metrics[m]) for m in Metrics)}
+
+        periods = buckets(TimePeriod, Granularity)
+        pages, token = self._page(periods, self._combos(group_by), NextPageToken, make)
+        res = {"GroupDefinitions": group_by, "ResultsByTime": []}
+        for (bucket, groups) in pages:
+            res["ResultsByTime"].append({
+                "TimePeriod": {"Start": bucket[0].strftime(FAKE_DATE_FORMAT),
+                               "End": bucket[1].strftime(FAKE_DATE_FORMAT)},
+                "Total": {},
+                "Groups": groups,
+                "Estimated": bucket[1] > today})
+        if token is not None:
+            res["NextPageToken"] = token
+        return res
+
+    def get_reservation_coverage(self, TimePeriod, GroupBy=None, Granularity=None,
+                                 NextPageToken=None, **kwargs):
+        self._call("GetReservationCoverage")
+        group_by = GroupBy or []
+
+        def make(bucket, combo):
+            keys = self._keys(group_by, combo)
+            name = "|".join(keys)
+            total = self._amount(name, bucket[0], bucket[1], 24.0)
+            reserved = self._amount(name + "/ri", bucket[0], bucket[1], 1.0) * total / max(1, (bucket[1] - bucket[0]).days)
+            attributes = {}
+            for (g, k) in zip(group_by, keys):
+                attributes[g["Key"].lower()] = k
+            return {"Attributes": attributes,
+                    "Coverage": {"CoverageHours": {
+                        "OnDemandHours": "%.6f" %(total - reserved),
+                        "ReservedHours": "%.6f" %reserved,
+                        "TotalRunningHours": "%.6f" %total,
+                        "CoverageHoursPercentage": "%.6f" %(reserved * 100.0 / total if total else 0.0)}}}
+
+        periods = buckets(TimePeriod, Granularity)
+        pages, token = self._page(periods, self._combos(group_by), NextPageToken, make)
+        res = {"CoveragesByTime": []}
+        for (bucket, groups) in pages:
+            res["CoveragesByTime"].append({
+                "TimePeriod": {"Start": bucket[0].strftime(FAKE_DATE_FORMAT),
+                               "End": bucket[1].strftime(FAKE_DATE_FORMAT)},
+                "Groups": groups,
+                "Total": {}})
+        if token is not None:
+            res["NextPageToken"] = token
+        return res
+
+    def get_reservation_purchase_recommendation(self, Service, LookbackPeriodInDays="SIXTY_DAYS",
+                                                TermInYears="ONE_YEAR", PaymentOption="PARTIAL_UPFRONT",
+                                                NextPageToken=None, **kwargs):
+        self._call("GetReservationPurchaseRecommendation")
+        name = "%s/%s/%s/%s" %(Service, LookbackPeriodInDays, TermInYears, PaymentOption)
+        day = datetime.date(2018, 1, 1)
+
+        def make(bucket, combo):
+            savings = self._amount("%s/%d" %(name, combo), day, day + datetime.timedelta(days=1), 500.0)
+            return {"AccountId": "123456789012",
+                    "InstanceDetails": {"EC2InstanceDetails": {
+                        "InstanceType": "m4.%dxlarge" %(combo + 1),
+                        "Region": "us-east-1",
+                        "Platform": "Linux/UNIX"}},
+                    "RecommendedNumberOfInstancesToPurchase": str(combo % 7 + 1),
+                    "EstimatedMonthlySavingsAmount": "%.2f" %savings,
+                    "EstimatedMonthlySavingsPercentage": "%.2f" %(savings / 10.0),
+                    "UpfrontCost": "%.2f" %(savings * 6),
+                    "CurrencyCode": "USD"}
+
+        pages, token = self._page([None], self.groups, NextPageToken, make)
+        details = pages[0][1] if pages else []
+        total = sum([float(d["EstimatedMonthlySavingsAmount"]) for d in details])
+        res = {"Metadata": {"RecommendationId": name,
+                            "GenerationTimestamp": "2018-01-01T00:00:00Z"},
+               "Recommendations": [{
+                   "AccountScope": "PAYER",
+                   "LookbackPeriodInDays": LookbackPeriodInDays,
+                   "TermInYears": TermInYears,
+                   "PaymentOption": PaymentOption,
+                   "RecommendationDetails": details,
+                   "RecommendationSummary": {
+                       "TotalEstimatedMonthlySavingsAmount": "%.2f" %total,
+                       "TotalEstimatedMonthlySavingsPercentage": "%.2f" %(total / 100.0),
+                       "CurrencyCode": "USD"}}]}
+        if token is not None:
+            res["NextPageToken"] = token
+        return res
+
+    def get_dimension_values(self, TimePeriod, Dimension, Context="COST_AND_USAGE",
+                             SearchString="", NextPageToken=None, **kwargs):
+        self._call("GetDimensionValues")
+        group_by = [{"Type": "DIMENSION", "Key": Dimension}]
+        pages, token = self._page([None], self.groups, NextPageToken,
+                                  lambda bucket, combo: {"Value": self._keys(group_by, combo)[0],
+                                                         "Attributes": {}})
+        values = pages[0][1] if pages else []
+        res = {"DimensionValues": [v for v in values if SearchString in v["Value"]],
+               "ReturnSize": len(values), "TotalSize": self.groups}
+        if token is not None:
+            res["NextPageToken"] = token
+        return res
+
+    def get_tags(self, TimePeriod, TagKey=None, SearchString="", NextPageToken=None, **kwargs):
+        self._call("GetTags")
+        if TagKey is None:
+            names = ["env", "team", "project"]
+        else:
+            names = ["%s-%d" %(TagKey, n) for n in range(0, self.tags)]
+        offset = int(NextPageToken or 0)
+        stop = min(offset + self.page, len(names))
+        res = {"Tags": [n for n in names[offset:stop] if SearchString in n],
+               "ReturnSize": stop - offset, "TotalSize": len(names)}
+        if stop < len(names):
+            res["NextPageToken"] = str(stop)
+        return res
+
+# parses a "key=value,key=value" spec into FakeCostExplorer arguments
+def parse_spec(spec):
+    args = dict(FAKE_DEFAULTS)
+    for item in spec.split(","):
+        item = item.strip()
+        if item == "" or item == "1": # COSTREPORTER_FAKE_CE=1 means defaults
+            continue
+        key, value = item.split("=", 1)
+        if key not in FAKE_DEFAULTS:
+            raise ValueError("unknown fake Cost Explorer setting: %s" %key)
+        args[key] = type(FAKE_DEFAULTS[key])(value)
+    return args
+
+# builds a fake client from a spec.  the account is mixed into the seed so
+# that every profile of a multi-account run gets different data
+def from_spec(spec, account=""):
+    args = parse_spec(spec)
+    args["seed"] = args["seed"] ^ (zlib.crc32(account.encode("utf-8")) & 0xffff)
+    return FakeCostExplorer(**args)